@@ -1,11 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.utils import timezone
 from .models import (
     User, Organization, Donor, HealthFacility, HealthFacilityDistributor, Project, MedicationCategory,
-    Medication, StandardList, MedicationSubstitution, StockEntry,
+    Medication, StandardList, MedicationSubstitution, StockEntry, LotBalance, StockBalance,
     PrescriptionPhoto, Dispensation, DispensationItem, Inventory,
-    InventoryItem, ConsumptionData, StockoutPeriod, Alert
+    InventoryItem, ConsumptionData, StockoutPeriod, Alert, TherapeuticClass
 )
+from . import dashboard_stats
+from .analytics_cache import ALERTS, touch
 
 
 @admin.register(User)
@@ -114,12 +117,22 @@ class MedicationCategoryAdmin(admin.ModelAdmin):
     ordering = ['name']
 
 
+@admin.register(TherapeuticClass)
+class TherapeuticClassAdmin(admin.ModelAdmin):
+    """Administration pour les classes thérapeutiques de référence"""
+    list_display = ['code', 'name', 'match_terms', 'is_antibiotic', 'is_antimalarial']
+    list_filter = ['is_antibiotic', 'is_antimalarial']
+    search_fields = ['code', 'name']
+    ordering = ['code']
+
+
 @admin.register(Medication)
 class MedicationAdmin(admin.ModelAdmin):
     """Administration pour les médicaments"""
-    list_display = ['code', 'name', 'dosage', 'form', 'category', 'unit_price', 'is_active']
-    list_filter = ['category', 'therapeutic_class', 'is_active', 'created_at']
+    list_display = ['code', 'name', 'dosage', 'form', 'category', 'classification', 'unit_price', 'is_active']
+    list_filter = ['category', 'classification', 'is_antibiotic', 'is_antimalarial', 'is_active', 'created_at']
     search_fields = ['code', 'name', 'dosage', 'therapeutic_class']
+    readonly_fields = ['classification', 'is_antibiotic', 'is_antimalarial']
     filter_horizontal = ['allowed_facilities']
     ordering = ['code']
 
@@ -149,6 +162,37 @@ class StockEntryAdmin(admin.ModelAdmin):
     ordering = ['-delivery_date']
 
 
+@admin.register(LotBalance)
+class LotBalanceAdmin(admin.ModelAdmin):
+    """Administration pour les soldes de lots (lecture seule)"""
+    list_display = ['stock_entry', 'medication', 'project', 'expiry_date', 'quantity_received',
+                    'quantity_dispensed', 'quantity_adjusted', 'quantity_available']
+    list_filter = ['organization', 'project', 'expiry_date']
+    search_fields = ['medication__name', 'medication__code', 'stock_entry__batch_number']
+    ordering = ['expiry_date']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StockBalance)
+class StockBalanceAdmin(admin.ModelAdmin):
+    """Administration pour les soldes de stock (lecture seule)"""
+    list_display = ['medication', 'organization', 'project', 'quantity_available', 'updated_at']
+    list_filter = ['organization', 'project']
+    search_fields = ['medication__name', 'medication__code']
+    ordering = ['medication__name']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(PrescriptionPhoto)
 class PrescriptionPhotoAdmin(admin.ModelAdmin):
     """Administration pour les photos d'ordonnances"""
@@ -218,9 +262,12 @@ class AlertAdmin(admin.ModelAdmin):
     
     def mark_resolved(self, request, queryset):
         """Action pour marquer les alertes comme résolues"""
-        from datetime import datetime
-        queryset.update(is_active=False, resolved_at=datetime.now())
-        self.message_user(request, f"{queryset.count()} alertes marquées comme résolues.")
+        # update() ne déclenche pas les signaux : analyses en cache invalidées explicitement,
+        # organisations lues avant que le filtre de la liste (is_active) n'exclue les alertes
+        touch(ALERTS, set(queryset.values_list('organization_id', flat=True)))
+        resolved = queryset.update(is_active=False, resolved_at=timezone.now())
+        dashboard_stats.recount('active_alert_count')
+        self.message_user(request, f"{resolved} alertes marquées comme résolues.")
     mark_resolved.short_description = "Marquer comme résolues"
 
 
@@ -240,7 +287,6 @@ admin.site.index_title = "Tableau de bord PharmaConnect"
 # ========================================
 
 from django.contrib.admin import AdminSite
-from django.utils.timezone import now, timedelta
 
 class PharmaConnectAdminSite(AdminSite):
     """AdminSite personnalisé avec statistiques en temps réel"""
@@ -249,24 +295,8 @@ class PharmaConnectAdminSite(AdminSite):
         """Vue personnalisée pour le tableau de bord avec statistiques réelles"""
         extra_context = extra_context or {}
 
-        # Calculer les statistiques
-        extra_context.update({
-            'medication_count': Medication.objects.filter(is_active=True).count(),
-            'organization_count': Organization.objects.count(),
-            'health_facility_count': HealthFacility.objects.count(),
-            'active_project_count': Project.objects.filter(
-                start_date__lte=now(),
-                end_date__gte=now()
-            ).count(),
-            'dispensation_count': Dispensation.objects.filter(
-                dispensation_date__gte=now() - timedelta(days=30)
-            ).count(),
-            'inventory_count': Inventory.objects.filter(
-                inventory_date__gte=now() - timedelta(days=30)
-            ).count(),
-            'active_user_count': User.objects.filter(is_active=True).count(),
-            'active_alert_count': Alert.objects.filter(is_active=True).count(),
-        })
+        # Statistiques lues dans l'instantané (api.dashboard_stats)
+        extra_context.update(dashboard_stats.get_statistics())
 
         return super().index(request, extra_context)
 
@@ -284,20 +314,4 @@ def admin_statistics(request):
     if not request.path.startswith('/admin'):
         return {}
 
-    return {
-        'medication_count': Medication.objects.filter(is_active=True).count(),
-        'organization_count': Organization.objects.count(),
-        'health_facility_count': HealthFacility.objects.count(),
-        'active_project_count': Project.objects.filter(
-            start_date__lte=now(),
-            end_date__gte=now()
-        ).count(),
-        'dispensation_count': Dispensation.objects.filter(
-            dispensation_date__gte=now() - timedelta(days=30)
-        ).count(),
-        'inventory_count': Inventory.objects.filter(
-            inventory_date__gte=now() - timedelta(days=30)
-        ).count(),
-        'active_user_count': User.objects.filter(is_active=True).count(),
-        'active_alert_count': Alert.objects.filter(is_active=True).count(),
-    }
+    return dashboard_stats.get_statistics()
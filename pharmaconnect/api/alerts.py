@@ -0,0 +1,400 @@
+"""
+Génération des alertes par règles ensemblistes.
+
+Chaque règle calcule, en quelques requêtes groupées, l'ensemble des alertes
+qui devraient être actives dans le périmètre évalué. `generate_alerts`
+compare cet ensemble aux alertes actives existantes (clé : type,
+organisation, projet, médicament ; le titre, qui reprend le nom du
+médicament, est mis à jour comme le message), crée les nouvelles avec
+bulk_create et résout les obsolètes et les doublons en un seul UPDATE.
+
+Les écritures de stock, de dispensation, d'inventaire et de consommation
+alimentent une file de clés (organisation, projet, médicament) ;
+`process_alert_queue` ne réévalue que les clés modifiées.
+"""
+import math
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Q, Sum, Min, Count
+from django.utils import timezone
+
+from . import dashboard_stats
+from .models import (
+    Alert, AlertQueueEntry, ConsumptionData, Dispensation, DispensationItem, LotBalance, Medication,
+    Project
+)
+from .analytics_cache import touch, ALERTS
+from .stock_status import evaluate_stock_status, STOCKOUT, PRE_STOCKOUT, OVERSTOCK
+
+# Seuils des règles
+EXPIRY_RISK_DAYS = 60
+ANTIBIOTIC_WINDOW_DAYS = 30
+ANTIBIOTIC_MIN_PRESCRIPTIONS = 20
+ANTIBIOTIC_MAX_PERCENTAGE = 30  # Cible OMS : moins de 30 % des prescriptions
+MALARIA_BASELINE_WEEKS = 8
+MALARIA_MIN_BASELINE_WEEKS = 4
+SERVICE_WINDOW_DAYS = 30
+SERVICE_BASELINE_DAYS = 90
+SERVICE_OVERCONSUMPTION_RATIO = 1.5
+
+AlertCandidate = namedtuple('AlertCandidate', [
+    'alert_type', 'organization_id', 'project_id', 'medication_id',
+    'severity', 'title', 'message'
+])
+
+RuleReport = namedtuple('RuleReport', ['rule', 'candidates', 'created', 'updated', 'resolved', 'seconds'])
+
+
+def _candidate_key(alert_type, organization_id, project_id, medication_id):
+    return (alert_type, organization_id, project_id, medication_id)
+
+
+def scope_queryset(queryset, scope, prefix='', medication_path=None):
+    """
+    Restreint un queryset au périmètre (organization, health_facility, project,
+    medications). Le filtre sur les médicaments ne s'applique que si
+    `medication_path` est fourni (règles évaluées par médicament).
+    """
+    if scope.get('organization') is not None:
+        queryset = queryset.filter(**{f'{prefix}organization': scope['organization']})
+    if scope.get('health_facility') is not None:
+        queryset = queryset.filter(**{f'{prefix}project__health_facility': scope['health_facility']})
+    if scope.get('project') is not None:
+        queryset = queryset.filter(**{f'{prefix}project': scope['project']})
+    if scope.get('medications') is not None and medication_path:
+        queryset = queryset.filter(**{f'{medication_path}__in': scope['medications']})
+    return queryset
+
+
+def _medication_labels(medication_ids):
+    return dict(
+        Medication.objects.filter(id__in=medication_ids).values_list('id', 'name')
+    )
+
+
+# Règles
+
+def expiry_risk_rule(today, scope):
+    """Lots en stock périmés ou expirant dans moins de deux mois"""
+    risk_date = today + timedelta(days=EXPIRY_RISK_DAYS)
+    rows = scope_queryset(LotBalance.objects.all(), scope, medication_path='medication').filter(
+        quantity_available__gt=0, expiry_date__lt=risk_date
+    ).values('organization', 'project', 'medication', 'medication__name').annotate(
+        quantity=Sum('quantity_available'),
+        expired=Sum('quantity_available', filter=Q(expiry_date__lt=today)),
+        earliest=Min('expiry_date')
+    )
+
+    for row in rows:
+        if row['expired']:
+            severity = 'CRITICAL'
+        elif (row['earliest'] - today).days < 30:
+            severity = 'HIGH'
+        else:
+            severity = 'MEDIUM'
+        message = (
+            f"{row['quantity']} unité(s) à risque de péremption, "
+            f"dont {row['expired'] or 0} déjà périmée(s). "
+            f"Première péremption : {row['earliest']:%d/%m/%Y}."
+        )
+        yield AlertCandidate(
+            'EXPIRY_RISK', row['organization'], row['project'], row['medication'], severity,
+            f"Risque de péremption : {row['medication__name']}", message
+        )
+
+
+STOCK_STATUS_ALERTS = {
+    STOCKOUT: ('STOCKOUT', 'CRITICAL', "Rupture"),
+    PRE_STOCKOUT: ('PRE_STOCKOUT', 'HIGH', "Pré-rupture"),
+    OVERSTOCK: ('OVERSTOCK', 'LOW', "Surstock"),
+}
+
+
+def stock_status_rule(today, scope):
+    """Ruptures, pré-ruptures et surstocks (mois de stock comparés aux délais du projet)"""
+    statuses = [
+        item for item in evaluate_stock_status(**scope)
+        if item.status in STOCK_STATUS_ALERTS
+    ]
+    names = _medication_labels({item.medication_id for item in statuses})
+
+    for item in statuses:
+        alert_type, severity, label = STOCK_STATUS_ALERTS[item.status]
+        if item.months_of_stock is None:
+            message = f"Stock disponible : {item.quantity} (CMM : {item.cmm:.1f})."
+        else:
+            message = (
+                f"Stock disponible : {item.quantity} (CMM : {item.cmm:.1f}), "
+                f"soit {item.months_of_stock:.1f} mois pour un seuil minimum de "
+                f"{item.min_months:.1f} et maximum de {item.max_months:.1f} mois."
+            )
+        yield AlertCandidate(
+            alert_type, item.organization_id, item.project_id, item.medication_id, severity,
+            f"{label} : {names.get(item.medication_id, item.medication_id)}", message
+        )
+
+
+def antibiotic_overuse_rule(today, scope):
+    """Part des prescriptions contenant un antibiotique au-delà de la cible OMS"""
+    since = today - timedelta(days=ANTIBIOTIC_WINDOW_DAYS)
+    rows = scope_queryset(Dispensation.objects.all(), scope).filter(
+        destination='PATIENT', dispensation_date__date__gte=since
+    ).values('organization', 'project').annotate(
+        total=Count('id', distinct=True),
+        antibiotic=Count(
+            'id', distinct=True,
+            filter=Q(items__medication__is_antibiotic=True)
+        )
+    )
+
+    for row in rows:
+        if row['total'] < ANTIBIOTIC_MIN_PRESCRIPTIONS:
+            continue
+        percentage = row['antibiotic'] / row['total'] * 100
+        if percentage <= ANTIBIOTIC_MAX_PERCENTAGE:
+            continue
+        yield AlertCandidate(
+            'ANTIBIOTIC_OVERUSE', row['organization'], row['project'], None,
+            'HIGH' if percentage > 50 else 'MEDIUM',
+            "Surutilisation des antibiotiques",
+            f"{percentage:.1f} % des prescriptions des {ANTIBIOTIC_WINDOW_DAYS} derniers jours "
+            f"contiennent un antibiotique ({row['antibiotic']}/{row['total']}), "
+            f"pour une cible de {ANTIBIOTIC_MAX_PERCENTAGE} %."
+        )
+
+
+def malaria_epidemic_rule(today, scope):
+    """Consommation hebdomadaire d'antipaludiques au-delà de moyenne + 2 écarts-types"""
+    since = today - timedelta(weeks=MALARIA_BASELINE_WEEKS + 2)
+    rows = scope_queryset(ConsumptionData.objects.all(), scope).filter(
+        is_week_closed=True,
+        year__gte=since.isocalendar()[0],
+        medication__is_antimalarial=True
+    ).values('organization', 'project', 'year', 'week_number').annotate(
+        quantity=Sum('quantity_consumed')
+    ).order_by('organization', 'project', 'year', 'week_number')
+
+    series = {}
+    for row in rows:
+        series.setdefault((row['organization'], row['project']), []).append(
+            (row['year'], row['week_number'], row['quantity'])
+        )
+
+    for (org_id, project_id), weeks in series.items():
+        *baseline, (year, week, latest) = weeks[-(MALARIA_BASELINE_WEEKS + 1):]
+        if len(baseline) < MALARIA_MIN_BASELINE_WEEKS:
+            continue
+        values = [quantity for _, _, quantity in baseline]
+        mean = sum(values) / len(values)
+        deviation = math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+        threshold = mean + 2 * deviation
+        if latest <= threshold or latest <= mean:
+            continue
+        yield AlertCandidate(
+            'MALARIA_EPIDEMIC', org_id, project_id, None,
+            'CRITICAL' if latest > 2 * mean else 'HIGH',
+            "Alerte épidémique paludisme",
+            f"Consommation d'antipaludiques en S{week}/{year} : {latest}, "
+            f"seuil épidémique {threshold:.0f} (moyenne {mean:.0f} sur {len(values)} semaines)."
+        )
+
+
+def service_overconsumption_rule(today, scope):
+    """Consommation d'un service sur 30 jours supérieure à 1,5 fois sa moyenne des 3 mois précédents"""
+    recent_start = today - timedelta(days=SERVICE_WINDOW_DAYS)
+    baseline_start = recent_start - timedelta(days=SERVICE_BASELINE_DAYS)
+    rows = scope_queryset(
+        DispensationItem.objects.all(), scope, prefix='dispensation__', medication_path='medication'
+    ).filter(
+        dispensation__destination='SERVICE',
+        dispensation__dispensation_date__date__gte=baseline_start
+    ).values(
+        'dispensation__organization', 'dispensation__project',
+        'dispensation__service_name', 'medication', 'medication__name'
+    ).annotate(
+        recent=Sum('quantity_dispensed', filter=Q(dispensation__dispensation_date__date__gte=recent_start)),
+        baseline=Sum('quantity_dispensed', filter=Q(dispensation__dispensation_date__date__lt=recent_start))
+    )
+
+    # Une alerte par médicament (clé des alertes actives) : services en surconsommation regroupés
+    periods = SERVICE_BASELINE_DAYS / SERVICE_WINDOW_DAYS
+    overconsumed = {}
+    for row in rows:
+        if not row['recent'] or not row['baseline']:
+            continue
+        average = row['baseline'] / periods
+        ratio = row['recent'] / average
+        if ratio < SERVICE_OVERCONSUMPTION_RATIO:
+            continue
+        key = (row['dispensation__organization'], row['dispensation__project'], row['medication'])
+        overconsumed.setdefault(key, (row['medication__name'], []))[1].append((
+            row['dispensation__service_name'] or "Service non renseigné", row['recent'], ratio, average
+        ))
+
+    for (org_id, project_id, medication_id), (name, services) in overconsumed.items():
+        services.sort(key=lambda service: (-service[2], service[0]))
+        messages = [
+            f"{recent} unité(s) dispensées au service sur {SERVICE_WINDOW_DAYS} jours, "
+            f"soit {ratio:.1f} fois la moyenne des {SERVICE_BASELINE_DAYS} jours précédents ({average:.0f})."
+            for _, recent, ratio, average in services
+        ]
+        if len(services) == 1:
+            title, message = f"Surconsommation {services[0][0]} : {name}", messages[0]
+        else:
+            title = f"Surconsommation de {len(services)} services : {name}"
+            message = ' '.join(f"{service} : {text}" for (service, *_), text in zip(services, messages))
+        yield AlertCandidate(
+            'SERVICE_OVERCONSUMPTION', org_id, project_id, medication_id,
+            'HIGH' if services[0][2] >= 2 else 'MEDIUM', title, message
+        )
+
+
+# Nom de la règle -> (types d'alertes produits, fonction d'évaluation, alertes par médicament)
+RULES = {
+    'expiry_risk': (('EXPIRY_RISK',), expiry_risk_rule, True),
+    'stock_status': (('STOCKOUT', 'PRE_STOCKOUT', 'OVERSTOCK'), stock_status_rule, True),
+    'antibiotic_overuse': (('ANTIBIOTIC_OVERUSE',), antibiotic_overuse_rule, False),
+    'malaria_epidemic': (('MALARIA_EPIDEMIC',), malaria_epidemic_rule, False),
+    'service_overconsumption': (('SERVICE_OVERCONSUMPTION',), service_overconsumption_rule, True),
+}
+
+
+@transaction.atomic
+def apply_rule(name, today, scope, dry_run=False):
+    """Évalue une règle et synchronise les alertes actives correspondantes"""
+    alert_types, evaluate, per_medication = RULES[name]
+    if not per_medication:
+        scope = {key: value for key, value in scope.items() if key != 'medications'}
+    started = time.perf_counter()
+
+    candidates = {}
+    for candidate in evaluate(today, scope):
+        key = _candidate_key(
+            candidate.alert_type, candidate.organization_id, candidate.project_id, candidate.medication_id
+        )
+        candidates[key] = candidate
+
+    # Une alerte active par clé : la plus ancienne est conservée, les doublons résolus
+    existing = {}
+    duplicates = []
+    active = scope_queryset(
+        Alert.objects.filter(is_active=True, alert_type__in=alert_types), scope, medication_path='medication'
+    ).order_by('id')
+    for alert_id, alert_type, org_id, project_id, medication_id, title, severity, message in active.values_list(
+        'id', 'alert_type', 'organization', 'project', 'medication', 'title', 'severity', 'message'
+    ):
+        key = _candidate_key(alert_type, org_id, project_id, medication_id)
+        if key in existing:
+            duplicates.append((key, alert_id))
+        else:
+            existing[key] = (alert_id, (severity, title, message))
+
+    new_alerts = [
+        Alert(
+            organization_id=candidate.organization_id,
+            project_id=candidate.project_id,
+            medication_id=candidate.medication_id,
+            alert_type=candidate.alert_type,
+            severity=candidate.severity,
+            title=candidate.title,
+            message=candidate.message,
+        )
+        for key, candidate in candidates.items()
+        if key not in existing
+    ]
+    # Sévérité, titre ou message modifiés (quantités, mois de stock, médicament renommé)
+    changed_keys = {
+        key for key, candidate in candidates.items()
+        if key in existing and existing[key][1] != (candidate.severity, candidate.title, candidate.message)
+    }
+    changed = [
+        Alert(
+            id=existing[key][0], severity=candidates[key].severity, title=candidates[key].title,
+            message=candidates[key].message
+        )
+        for key in changed_keys
+    ]
+    stale = [(key, alert_id) for key, (alert_id, _) in existing.items() if key not in candidates] + duplicates
+    stale_ids = [alert_id for _, alert_id in stale]
+
+    if not dry_run:
+        Alert.objects.bulk_create(new_alerts, batch_size=1000)
+        Alert.objects.bulk_update(changed, ['severity', 'title', 'message'], batch_size=1000)
+        resolved = 0
+        if stale_ids:
+            resolved = Alert.objects.filter(id__in=stale_ids).update(is_active=False, resolved_at=timezone.now())
+        # Écritures groupées sans signaux : analyses en cache et statistiques explicites
+        dashboard_stats.adjust('active_alert_count', len(new_alerts) - resolved)
+        touch(ALERTS, {
+            key[1] for key in candidates if key not in existing or key in changed_keys
+        } | {key[1] for key, _ in stale})
+
+    return RuleReport(
+        name, len(candidates), len(new_alerts), len(changed), len(stale_ids),
+        time.perf_counter() - started
+    )
+
+
+def generate_alerts(rules=None, today=None, dry_run=False, **scope):
+    """Évalue les règles demandées (toutes par défaut) et retourne un rapport par règle"""
+    today = today or date.today()
+    return [apply_rule(name, today, scope, dry_run) for name in (rules or RULES)]
+
+
+def enqueue_alert_keys(keys, existing_only=False):
+    """
+    Ajoute des clés (organisation, projet, médicament) à la file ; les
+    doublons sont ignorés. `existing_only` écarte les clés dont le projet ou
+    le médicament a été supprimé entre-temps (suppressions en cascade).
+    """
+    keys = set(keys)
+    if existing_only and keys:
+        projects = set(Project.objects.filter(id__in={key[1] for key in keys}).values_list('id', flat=True))
+        medications = set(Medication.objects.filter(id__in={key[2] for key in keys}).values_list('id', flat=True))
+        keys = {key for key in keys if key[1] in projects and key[2] in medications}
+    AlertQueueEntry.objects.bulk_create(
+        [
+            AlertQueueEntry(organization_id=org_id, project_id=project_id, medication_id=medication_id)
+            for org_id, project_id, medication_id in keys
+        ],
+        ignore_conflicts=True
+    )
+
+
+def _claim_queue(batch_size):
+    """Retire de la file et retourne jusqu'à `batch_size` clés"""
+    with transaction.atomic():
+        entries = list(
+            AlertQueueEntry.objects.select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('id', 'organization', 'project', 'medication')[:batch_size]
+        )
+        AlertQueueEntry.objects.filter(id__in=[entry[0] for entry in entries]).delete()
+    return [entry[1:] for entry in entries]
+
+
+def process_alert_queue(batch_size=500, today=None):
+    """
+    Réévalue les règles pour un lot de clés de la file, projet par projet.
+
+    Les clés sont retirées de la file avant l'évaluation, de sorte qu'une
+    écriture concurrente sur la même clé la remette en file. En cas
+    d'erreur, les clés sont remises en file.
+    """
+    keys = _claim_queue(batch_size)
+    by_project = {}
+    for org_id, project_id, medication_id in keys:
+        by_project.setdefault((org_id, project_id), set()).add(medication_id)
+
+    try:
+        for (org_id, project_id), medications in by_project.items():
+            generate_alerts(
+                today=today, organization=org_id, project=project_id, medications=medications
+            )
+    except Exception:
+        enqueue_alert_keys(keys)
+        raise
+    return len(keys)
@@ -0,0 +1,160 @@
+"""
+Cache des réponses analytiques (résumé des stocks, analyses
+pharmacoépidémiologiques, statistiques des dispensations, tableau de bord
+des alertes).
+
+Une réponse est rangée sous la clé (vue, périmètre de l'utilisateur,
+paramètres normalisés, versions des données). Les versions sont des
+compteurs par domaine et par organisation (api.versions) incrémentés après
+validation de chaque écriture concernée : une donnée modifiée change la clé,
+la réponse n'est donc jamais périmée et aucune invalidation explicite n'est
+nécessaire. Les entrées des anciennes versions expirent d'elles-mêmes.
+
+Domaines :
+- stock : réceptions, mouvements des soldes (api.ledger), consommations,
+  ruptures, paramètres des projets ;
+- dispensations : dispensations et articles, classes thérapeutiques ;
+- alerts : alertes.
+
+Les caches de settings.ANALYTICS_CACHES sont lus dans l'ordre (mémoire
+locale puis fichiers partagés) ; l'en-tête X-Cache indique l'origine de la
+réponse et `cache_metrics` compte succès et échecs par vue dans le processus.
+"""
+import functools
+import hashlib
+import threading
+from collections import Counter
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from .models import DataVersion, Organization, Project
+from .versions import bump_version
+
+STOCK = 'stock'
+DISPENSATIONS = 'dispensations'
+ALERTS = 'alerts'
+DEFAULT_CACHES = ['analytics', 'analytics_shared']
+
+
+def version_key(domain, organization_id):
+    return f'analytics:{domain}:{organization_id}'
+
+
+def _bump(keys):
+    """Incrémente les compteurs en une requête ; ceux qui n'existent pas encore sont créés"""
+    versions = DataVersion.objects.filter(key__in=keys)
+    existing = set(versions.values_list('key', flat=True))
+    versions.update(version=F('version') + 1, updated_at=timezone.now())
+    for key in set(keys) - existing:
+        bump_version(key)
+
+
+def touch(domain, organization_ids):
+    """
+    Signale une modification des données du domaine pour ces organisations ;
+    appliqué après validation pour ne pas prolonger la transaction
+    """
+    keys = sorted({version_key(domain, organization_id) for organization_id in organization_ids
+                   if organization_id is not None})
+    if keys:
+        transaction.on_commit(lambda: _bump(keys))
+
+
+def touch_all(domain):
+    touch(domain, Organization.objects.values_list('id', flat=True))
+
+
+class CacheMetrics:
+    """Succès (par cache) et échecs par vue, dans le processus"""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, name, outcome):
+        with self._lock:
+            self._counts[(name, outcome)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        views = {}
+        for (name, outcome), count in counts.items():
+            views.setdefault(name, {'hits': {}, 'misses': 0})
+            if outcome == 'miss':
+                views[name]['misses'] = count
+            else:
+                views[name]['hits'][outcome] = count
+        for stats in views.values():
+            hits = sum(stats['hits'].values())
+            total = hits + stats['misses']
+            stats['hit_ratio'] = round(hits / total, 3) if total else None
+        return views
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+cache_metrics = CacheMetrics()
+
+
+def user_scope(user):
+    """(libellé du périmètre, organisations dont les données sont lues)"""
+    if user.access_level == 'COORDINATION':
+        return f'org:{user.organization_id}', [user.organization_id]
+    if user.access_level == 'FACILITY':
+        organizations = Project.objects.filter(
+            health_facility=user.health_facility_id
+        ).values_list('organization', flat=True).distinct()
+        return f'facility:{user.health_facility_id}', sorted(organizations)
+    return f'{user.access_level}:all', sorted(Organization.objects.values_list('id', flat=True))
+
+
+def response_key(name, request, domains, daily=False):
+    scope, organizations = user_scope(request.user)
+    keys = [version_key(domain, organization_id) for domain in domains for organization_id in organizations]
+    versions = dict(DataVersion.objects.filter(key__in=keys).values_list('key', 'version'))
+    params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+    parts = [name, scope, repr(params), repr([versions.get(key, 0) for key in keys])]
+    if daily:
+        parts.append(date.today().isoformat())
+    return 'analytics:response:' + hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def cached_analytics(name, domains, daily=False):
+    """
+    Met en cache la réponse de la vue (fonction @api_view ou action) ;
+    `daily` : la réponse dépend aussi de la date du jour (péremptions)
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request = next(arg for arg in args if isinstance(arg, Request))
+            aliases = getattr(settings, 'ANALYTICS_CACHES', DEFAULT_CACHES)
+            key = response_key(name, request, domains, daily)
+
+            for position, alias in enumerate(aliases):
+                data = caches[alias].get(key)
+                if data is not None:
+                    for upper in aliases[:position]:
+                        caches[upper].set(key, data)
+                    cache_metrics.record(name, alias)
+                    return Response(data, headers={'X-Cache': f'HIT {alias}'})
+
+            response = view(*args, **kwargs)
+            if response.status_code == 200:
+                for alias in aliases:
+                    caches[alias].set(key, response.data)
+            cache_metrics.record(name, 'miss')
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
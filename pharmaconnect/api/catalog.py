@@ -0,0 +1,166 @@
+"""
+Catalogue des médicaments d'une organisation tenu en mémoire par chaque
+processus.
+
+Un instantané contient la représentation MedicationSerializer de tous les
+médicaments de l'organisation, sous forme d'enregistrements compacts (tuple
+de valeurs partageant la même liste de champs) indexés par id, par code et
+par GTIN (api.gs1). Il est identifié par la version 'catalog:<organisation>'
+(api.versions), incrémentée par les signaux à chaque modification d'un
+médicament, d'une catégorie ou d'une formation sanitaire autorisée. Les
+instantanés des organisations les moins récemment consultées sont évincés
+(LRU).
+
+Les mises à jour en masse (queryset.update, bulk_create) ne déclenchent pas
+de signaux : elles doivent appeler invalidate_catalog.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .gs1 import barcode_gtin
+from .models import Medication
+from .versions import bump_version, get_version
+
+DEFAULT_CACHE_SIZE = 32  # organisations
+
+
+def catalog_key(organization_id):
+    return f'catalog:{organization_id}'
+
+
+def invalidate_catalog(organization_id):
+    """Invalide le catalogue de l'organisation dans tous les processus"""
+    if organization_id is not None:
+        bump_version(catalog_key(organization_id))
+
+
+class CatalogRecord:
+    """Médicament du catalogue : valeurs dans l'ordre des champs de l'instantané"""
+    __slots__ = ('id', 'code', 'gtin', 'values')
+
+    def __init__(self, medication_id, code, gtin, values):
+        self.id = medication_id
+        self.code = code
+        self.gtin = gtin
+        self.values = values
+
+
+class CatalogSnapshot:
+    __slots__ = ('organization_id', 'version', 'fields', 'by_id', 'by_code', 'by_gtin')
+
+    def __init__(self, organization_id, version, fields, records):
+        self.organization_id = organization_id
+        self.version = version
+        self.fields = fields
+        self.by_id = {record.id: record for record in records}
+        self.by_code = {record.code: record for record in records}
+        self.by_gtin = {record.gtin: record for record in records if record.gtin}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def representation(self, medication_id, fields=None):
+        """Représentation MedicationSerializer (ou ses seuls `fields`), None si absent"""
+        record = self.by_id.get(medication_id)
+        if record is None:
+            return None
+        data = dict(zip(self.fields, record.values))
+        if fields is not None:
+            return {field: data[field] for field in fields}
+        return data
+
+    def get_by_code(self, code):
+        record = self.by_code.get(code)
+        return self.representation(record.id) if record else None
+
+    def medication_id_for_gtin(self, gtin):
+        record = self.by_gtin.get(gtin)
+        return record.id if record else None
+
+
+def build_snapshot(organization_id, version):
+    # Import différé : api.serializers utilise ce module
+    from .serializers import MedicationSerializer
+
+    medications = Medication.objects.filter(organization_id=organization_id).select_related(
+        'category'
+    ).prefetch_related('allowed_facilities')
+    data = MedicationSerializer(medications, many=True).data
+    fields = tuple(data[0]) if data else ()
+    records = [
+        CatalogRecord(item['id'], item['code'], barcode_gtin(item['barcode_gs1']), tuple(item.values()))
+        for item in data
+    ]
+    return CatalogSnapshot(organization_id, version, fields, records)
+
+
+class CatalogCache:
+    """Instantanés par organisation, bornés en nombre (LRU)"""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, organization_id):
+        """Instantané à jour de l'organisation (une requête si inchangé)"""
+        version = get_version(catalog_key(organization_id))
+        with self._lock:
+            snapshot = self._snapshots.get(organization_id)
+            if snapshot is not None and snapshot.version == version:
+                self._snapshots.move_to_end(organization_id)
+                return snapshot
+
+        # Construit hors verrou ; la version est lue avant les données
+        snapshot = build_snapshot(organization_id, version)
+        with self._lock:
+            self._snapshots[organization_id] = snapshot
+            self._snapshots.move_to_end(organization_id)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+catalog_cache = CatalogCache(getattr(settings, 'CATALOG_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
+
+def get_catalog(organization_id):
+    return catalog_cache.get(organization_id)
+
+
+def medication_representations(medication_ids):
+    """
+    {id: représentation MedicationSerializer} de médicaments de toutes
+    organisations, lus dans leurs catalogues (liste `included` des réponses)
+    """
+    from .serializers import MedicationSerializer
+
+    by_organization = {}
+    for medication_id, organization_id in Medication.objects.filter(
+        id__in=set(medication_ids)
+    ).values_list('id', 'organization_id'):
+        by_organization.setdefault(organization_id, []).append(medication_id)
+
+    representations = {}
+    missing = by_organization.pop(None, [])
+    for organization_id, ids in by_organization.items():
+        catalog = get_catalog(organization_id)
+        for medication_id in ids:
+            data = catalog.representation(medication_id)
+            if data is None:
+                missing.append(medication_id)
+            else:
+                representations[medication_id] = data
+    if missing:
+        medications = Medication.objects.filter(id__in=missing).select_related(
+            'category'
+        ).prefetch_related('allowed_facilities')
+        for data in MedicationSerializer(medications, many=True).data:
+            representations[data['id']] = data
+    return representations
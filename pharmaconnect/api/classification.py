@@ -0,0 +1,67 @@
+"""
+Classification thérapeutique des médicaments : la classe saisie librement
+(Medication.therapeutic_class) est rattachée à l'enregistrement à une
+classe de référence (TherapeuticClass) d'après ses termes reconnus, sans
+tenir compte des accents ni de la casse. Les indicateurs de la classe
+(antibiotique, antipaludique) sont recopiés et indexés sur le médicament :
+les analyses et les alertes filtrent sur ces colonnes au lieu de chercher
+une sous-chaîne dans le libellé.
+"""
+from . import dispensation_facts
+from .analytics_cache import touch, DISPENSATIONS
+from .catalog import invalidate_catalog
+from .models import Medication, TherapeuticClass
+from .search import fold
+
+CLASSIFIED_FIELDS = ['classification', 'is_antibiotic', 'is_antimalarial']
+
+
+def match_class(text, classes):
+    """Première classe (par code) dont le nom ou un terme figure dans le texte, None sinon"""
+    folded = fold(text).strip()
+    if not folded:
+        return None
+    for therapeutic_class in classes:
+        terms = [term.strip() for term in fold(therapeutic_class.match_terms).split(',') if term.strip()]
+        if folded == fold(therapeutic_class.name).strip() or any(term in folded for term in terms):
+            return therapeutic_class
+    return None
+
+
+def apply_class(medication, therapeutic_class):
+    """Rattache le médicament à la classe (ou à aucune) et recopie ses indicateurs"""
+    medication.classification = therapeutic_class
+    medication.is_antibiotic = bool(therapeutic_class and therapeutic_class.is_antibiotic)
+    medication.is_antimalarial = bool(therapeutic_class and therapeutic_class.is_antimalarial)
+
+
+def classify(medication, classes=None):
+    if classes is None:
+        classes = TherapeuticClass.objects.all()
+    apply_class(medication, match_class(medication.therapeutic_class, classes))
+
+
+def classify_medications(organization_id=None):
+    """
+    Reclasse les médicaments (tous, ou ceux d'une organisation) après une
+    modification des classes de référence ; nombre de médicaments modifiés
+    """
+    classes = list(TherapeuticClass.objects.all())
+    medications = Medication.objects.only('organization', 'therapeutic_class', *CLASSIFIED_FIELDS)
+    if organization_id:
+        medications = medications.filter(organization_id=organization_id)
+
+    changed = []
+    for medication in medications:
+        before = (medication.classification_id, medication.is_antibiotic, medication.is_antimalarial)
+        classify(medication, classes)
+        if (medication.classification_id, medication.is_antibiotic, medication.is_antimalarial) != before:
+            changed.append(medication)
+    # bulk_update ne déclenche pas les signaux : catalogue, faits et analyses explicites
+    Medication.objects.bulk_update(changed, CLASSIFIED_FIELDS, batch_size=1000)
+    organizations = {medication.organization_id for medication in changed}
+    for changed_organization_id in organizations:
+        invalidate_catalog(changed_organization_id)
+    dispensation_facts.mark_medication_days([medication.pk for medication in changed])
+    touch(DISPENSATIONS, organizations)
+    return len(changed)
@@ -0,0 +1,104 @@
+"""
+Consommation moyenne mensuelle (CMM) calculée depuis ConsumptionData.
+
+Toutes les semaines clôturées du périmètre sont lues en une requête, les
+périodes de rupture en une seconde, puis les CMM glissantes de chaque
+(organisation, projet, médicament) sont calculées en un seul passage. Les
+semaines qui chevauchent une période de rupture sont exclues : la
+consommation y reflète l'absence de stock et non le besoin.
+"""
+from collections import namedtuple
+from datetime import date, timedelta
+
+from django.db.models import Q
+
+from .models import ConsumptionData, StockoutPeriod
+
+WEEKS_PER_MONTH = 52 / 12
+DEFAULT_WINDOWS = (3, 6, 12)
+
+# total, nombre de semaines retenues et CMM par fenêtre (en mois)
+CMMResult = namedtuple('CMMResult', ['total', 'weeks', 'cmm'])
+
+
+def _window_start(months, reference):
+    """Lundi de la première semaine de la fenêtre des `months` derniers mois"""
+    monday = reference - timedelta(days=reference.weekday())
+    return monday - timedelta(weeks=round(months * WEEKS_PER_MONTH))
+
+
+def _stockout_periods(queryset, since):
+    """Périodes de rupture par (projet, médicament) recoupant la fenêtre"""
+    periods = {}
+    rows = StockoutPeriod.objects.filter(
+        Q(end_date__isnull=True) | Q(end_date__gte=since),
+        project__in=queryset.values('project'),
+        medication__in=queryset.values('medication'),
+    ).values_list('project', 'medication', 'start_date', 'end_date')
+    for project_id, medication_id, start, end in rows:
+        periods.setdefault((project_id, medication_id), []).append((start, end or date.max))
+    return periods
+
+
+def compute_cmm(queryset=None, windows=DEFAULT_WINDOWS, reference=None, exclude_stockouts=True):
+    """
+    CMM glissantes par (organisation, projet, médicament).
+
+    Retourne {clé: CMMResult} où total, weeks et cmm sont indexés par la
+    durée de la fenêtre en mois. La moyenne porte sur les semaines
+    renseignées et non excluses de chaque fenêtre.
+    """
+    if queryset is None:
+        queryset = ConsumptionData.objects.all()
+    reference = reference or date.today()
+    starts = {months: _window_start(months, reference) for months in windows}
+    since = min(starts.values())
+    first_year = since.isocalendar()[0]
+
+    rows = queryset.filter(is_week_closed=True, year__gte=first_year).values_list(
+        'organization', 'project', 'medication', 'year', 'week_number', 'quantity_consumed'
+    )
+    periods = _stockout_periods(queryset, since) if exclude_stockouts else {}
+
+    totals = {}
+    counts = {}
+    for org_id, project_id, medication_id, year, week, quantity in rows.iterator():
+        try:
+            week_start = date.fromisocalendar(year, week, 1)
+        except ValueError:
+            # Semaine 53 d'une année qui n'en compte que 52
+            continue
+        if week_start < since:
+            continue
+        week_end = week_start + timedelta(days=6)
+        if any(
+            start <= week_end and week_start <= end
+            for start, end in periods.get((project_id, medication_id), ())
+        ):
+            continue
+
+        key = (org_id, project_id, medication_id)
+        key_totals = totals.setdefault(key, dict.fromkeys(windows, 0))
+        key_counts = counts.setdefault(key, dict.fromkeys(windows, 0))
+        for months, start in starts.items():
+            if week_start >= start:
+                key_totals[months] += quantity
+                key_counts[months] += 1
+
+    return {
+        key: CMMResult(
+            key_totals,
+            counts[key],
+            {
+                months: (key_totals[months] / weeks * WEEKS_PER_MONTH) if weeks else 0
+                for months, weeks in counts[key].items()
+            }
+        )
+        for key, key_totals in totals.items()
+    }
+
+
+def monthly_consumption(queryset=None, months=3, reference=None):
+    """CMM sur les `months` derniers mois, indexée par (organisation, projet, médicament)"""
+    results = compute_cmm(queryset, windows=(months,), reference=reference)
+    return {key: result.cmm[months] for key, result in results.items()}
@@ -0,0 +1,80 @@
+"""
+Statistiques du tableau de bord de l'administration, lues dans la table
+DashboardStatistic (une requête) au lieu de huit COUNT à chaque page.
+
+Chaque compteur est recompté par la commande refresh_admin_statistics, à
+planifier. Entre deux passages, après validation des écritures :
+- créations et suppressions ajustent les compteurs (+1/-1), de même que
+  les changements de statut (is_active) des médicaments, utilisateurs et
+  alertes ;
+- les projets, dont l'activité dépend de leurs dates, et les inventaires,
+  peu nombreux, sont recomptés.
+Les dispensations sortant de la fenêtre de 30 jours ne sont décomptées
+qu'au passage suivant de la commande.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import (
+    DashboardStatistic, Medication, Organization, HealthFacility, Project, Dispensation, Inventory,
+    User, Alert
+)
+
+WINDOW_DAYS = 30
+
+
+def window_start():
+    """Début de la fenêtre des dispensations et inventaires récents"""
+    return timezone.now() - timedelta(days=WINDOW_DAYS)
+
+
+STATISTICS = {
+    'medication_count': lambda: Medication.objects.filter(is_active=True),
+    'organization_count': lambda: Organization.objects.all(),
+    'health_facility_count': lambda: HealthFacility.objects.all(),
+    'active_project_count': lambda: Project.objects.filter(
+        start_date__lte=timezone.now(),
+        end_date__gte=timezone.now()
+    ),
+    'dispensation_count': lambda: Dispensation.objects.filter(dispensation_date__gte=window_start()),
+    'inventory_count': lambda: Inventory.objects.filter(inventory_date__gte=window_start()),
+    'active_user_count': lambda: User.objects.filter(is_active=True),
+    'active_alert_count': lambda: Alert.objects.filter(is_active=True),
+}
+
+
+def refresh_statistics(names=None):
+    """Recompte les compteurs (tous par défaut) ; {nom: valeur}"""
+    values = {}
+    refreshed_at = timezone.now()
+    for name in names or STATISTICS:
+        values[name] = STATISTICS[name]().count()
+        DashboardStatistic.objects.update_or_create(
+            name=name, defaults={'value': values[name], 'refreshed_at': refreshed_at}
+        )
+    return values
+
+
+def get_statistics():
+    """{nom: valeur} de tous les compteurs ; ceux jamais calculés le sont"""
+    values = dict(DashboardStatistic.objects.values_list('name', 'value'))
+    missing = [name for name in STATISTICS if name not in values]
+    if missing:
+        values.update(refresh_statistics(missing))
+    return {name: values[name] for name in STATISTICS}
+
+
+def adjust(name, delta):
+    """Ajoute `delta` au compteur après validation"""
+    if delta:
+        transaction.on_commit(
+            lambda: DashboardStatistic.objects.filter(name=name).update(value=F('value') + delta)
+        )
+
+
+def recount(name):
+    """Recompte le compteur après validation"""
+    transaction.on_commit(lambda: refresh_statistics([name]))
@@ -0,0 +1,196 @@
+"""
+Faits de dispensation journaliers (DispensationDailyFact) : une ligne par
+(organisation, projet, jour, destination, statut, tranche d'âge, sexe,
+CPN, nombre d'antibiotiques distincts, présence d'antipaludique) portant le nombre
+de prescriptions, d'articles et d'unités dispensées. Les analyses
+(pharmacoepidemio_analysis, statistiques des dispensations) lisent ces
+agrégats au lieu de rejoindre dispensations, articles et médicaments.
+
+Les indicateurs dépendent de l'ensemble des articles d'une dispensation :
+plutôt que des incréments, chaque écriture marque son jour
+(organisation, projet, jour) et les jours marqués sont recalculés depuis
+les tables sources après validation, une fois par transaction. Les
+écritures qui contournent les signaux (bulk_create) doivent appeler
+`mark_days` ; `rebuild_facts` recalcule tout.
+"""
+import threading
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Least, TruncDate, TruncWeek
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .analytics_cache import touch, touch_all, DISPENSATIONS
+from .models import Dispensation, DispensationDailyFact, DispensationItem, Project
+
+# Classes thérapeutiques suivies : indicateurs du médicament de l'article (api.classification)
+ANTIBIOTIC = Q(medication__is_antibiotic=True)
+ANTIMALARIAL = Q(medication__is_antimalarial=True)
+
+# Antibiotiques distincts par prescription : au-delà, comptés avec le plafond
+MAX_ANTIBIOTIC_COUNT = 5
+MULTITHERAPY_MIN_ANTIBIOTICS = 2
+
+# Tranches d'âge : (âge maximal exclu, libellé) ; au-delà, '50+'
+AGE_BANDS = [(5, '0-4'), (15, '5-14'), (50, '15-49')]
+UNDER_FIVE = '0-4'
+
+DIMENSIONS = [
+    'organization', 'project', 'health_facility', 'day', 'destination', 'status',
+    'age_band', 'patient_sex', 'is_antenatal', 'antibiotic_count', 'has_antimalarial',
+]
+
+_pending = threading.local()
+
+
+def day_key(dispensation):
+    """(organisation, projet, jour local) d'une dispensation"""
+    return (
+        dispensation.organization_id, dispensation.project_id,
+        timezone.localdate(dispensation.dispensation_date)
+    )
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def fact_rows(dispensations):
+    """Agrégats des dispensations données, groupés par DIMENSIONS"""
+    items = DispensationItem.objects.filter(dispensation=OuterRef('pk'))
+    antibiotics = items.filter(ANTIBIOTIC).order_by().values('dispensation').annotate(
+        count=Count('medication', distinct=True)
+    ).values('count')
+    age_band = Case(
+        *[When(patient_age__lt=limit, then=Value(label)) for limit, label in AGE_BANDS],
+        When(patient_age__isnull=False, then=Value('50+')),
+        default=Value(''),
+    )
+    return dispensations.annotate(
+        day=TruncDate('dispensation_date'),
+        health_facility=F('project__health_facility'),
+        age_band=age_band,
+        is_antenatal=Q(patient_service__icontains='CPN'),
+        antibiotic_count=Least(Coalesce(Subquery(antibiotics), 0), Value(MAX_ANTIBIOTIC_COUNT)),
+        has_antimalarial=Exists(items.filter(ANTIMALARIAL)),
+    ).values(*DIMENSIONS).annotate(
+        prescriptions=Count('id', distinct=True),
+        item_count=Count('items'),
+        quantity=Coalesce(Sum('items__quantity_dispensed'), 0),
+    ).order_by()
+
+
+def _facts(rows):
+    for row in rows:
+        yield DispensationDailyFact(
+            organization_id=row['organization'], project_id=row['project'],
+            health_facility_id=row['health_facility'], day=row['day'],
+            destination=row['destination'], status=row['status'], age_band=row['age_band'],
+            patient_sex=row['patient_sex'], is_antenatal=row['is_antenatal'],
+            antibiotic_count=row['antibiotic_count'], has_antimalarial=row['has_antimalarial'],
+            prescriptions=row['prescriptions'], items=row['item_count'], quantity_dispensed=row['quantity'],
+        )
+
+
+def refresh_days(keys):
+    """Recalcule les faits des jours (organisation, projet, jour) donnés"""
+    for organization_id, project_id, day in sorted(keys):
+        start, end = _day_bounds(day)
+        with transaction.atomic():
+            # Verrou du projet : le dernier recalcul d'un jour voit toutes les écritures validées
+            list(Project.objects.select_for_update().filter(pk=project_id).values_list('pk'))
+            DispensationDailyFact.objects.filter(
+                organization_id=organization_id, project_id=project_id, day=day
+            ).delete()
+            DispensationDailyFact.objects.bulk_create(_facts(fact_rows(Dispensation.objects.filter(
+                organization_id=organization_id, project_id=project_id,
+                dispensation_date__gte=start, dispensation_date__lt=end,
+            ))))
+
+
+def _flush():
+    keys = _pending.__dict__.pop('keys', None)
+    if keys:
+        refresh_days(keys)
+
+
+def mark_days(keys):
+    """
+    Marque des jours (organisation, projet, jour) à recalculer après
+    validation ; les marques d'une même transaction sont recalculées ensemble
+    """
+    keys = set(keys)
+    if keys:
+        _pending.__dict__.setdefault('keys', set()).update(keys)
+        # Chaque marque enregistre le recalcul : le premier exécuté traite toutes les marques
+        transaction.on_commit(_flush)
+
+
+def mark_medication_days(medication_ids):
+    """Marque les jours des dispensations des médicaments (indicateurs modifiés)"""
+    if medication_ids:
+        mark_days(DispensationItem.objects.filter(medication__in=medication_ids).annotate(
+            day=TruncDate('dispensation__dispensation_date')
+        ).values_list('dispensation__organization', 'dispensation__project', 'day').distinct())
+
+
+def rebuild_facts(organization_id=None):
+    """Reconstruit tous les faits (ou ceux d'une organisation) ; nombre de lignes"""
+    dispensations = Dispensation.objects.all()
+    facts = DispensationDailyFact.objects.all()
+    if organization_id:
+        dispensations = dispensations.filter(organization_id=organization_id)
+        facts = facts.filter(organization_id=organization_id)
+    with transaction.atomic():
+        facts.delete()
+        created = DispensationDailyFact.objects.bulk_create(
+            _facts(fact_rows(dispensations).iterator(chunk_size=5000)), batch_size=5000
+        )
+    if organization_id:
+        touch(DISPENSATIONS, [organization_id])
+    else:
+        touch_all(DISPENSATIONS)
+    return len(created)
+
+
+def parse_day(value):
+    """Jour d'un paramètre de date (AAAA-MM-JJ ou date et heure) ; ValueError si invalide"""
+    day = parse_date(value)
+    if day is None:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(value)
+        day = timezone.localdate(moment) if timezone.is_aware(moment) else moment.date()
+    return day
+
+
+def filter_days(facts, start_date=None, end_date=None):
+    """Faits des jours compris entre les deux dates (incluses)"""
+    if start_date:
+        facts = facts.filter(day__gte=parse_day(start_date))
+    if end_date:
+        facts = facts.filter(day__lte=parse_day(end_date))
+    return facts
+
+
+ANTIBIOTIC_FACTS = Q(antibiotic_count__gte=1)
+MULTITHERAPY_FACTS = Q(antibiotic_count__gte=MULTITHERAPY_MIN_ANTIBIOTICS)
+
+
+def antibiotic_distribution(facts):
+    """[{antibiotic_count, total_prescriptions}] : prescriptions par nombre d'antibiotiques distincts"""
+    return list(facts.values('antibiotic_count').annotate(
+        total_prescriptions=Sum('prescriptions')
+    ).order_by('antibiotic_count'))
+
+
+def weekly_antibiotic_series(facts):
+    """Prescriptions, avec antibiotique et en multithérapie, par semaine (lundi)"""
+    return list(facts.annotate(week=TruncWeek('day')).values('week').annotate(
+        total_prescriptions=Sum('prescriptions'),
+        antibiotic_prescriptions=Coalesce(Sum('prescriptions', filter=ANTIBIOTIC_FACTS), 0),
+        multitherapy_prescriptions=Coalesce(Sum('prescriptions', filter=MULTITHERAPY_FACTS), 0),
+    ).order_by('week'))
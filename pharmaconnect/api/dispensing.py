@@ -0,0 +1,277 @@
+"""
+Allocation des quantités prescrites aux lots selon la règle FEFO
+(premier périmé, premier sorti).
+
+Pour chaque médicament, les lots non périmés du projet ayant un solde
+disponible (LotBalance) sont parcourus par date de péremption croissante ;
+la quantité est répartie sur autant de lots que nécessaire.
+
+Contrôle de concurrence optimiste : les soldes sont lus sans verrou, puis
+chaque sortie est un UPDATE conditionnel sur le solde restant
+(api.ledger). Les dispensations portant sur des lots différents avancent en
+parallèle ; si un lot a été entamé entre-temps, l'allocation est annulée
+(point de sauvegarde) puis recalculée sur les soldes à jour.
+
+`create_dispensations` enregistre en une transaction des dispensations
+complètes (articles compris) : références vérifiées en quelques requêtes
+groupées, écritures par bulk_create, un résultat par dispensation.
+"""
+from collections import namedtuple
+from datetime import date
+
+from django.db import transaction
+
+from . import dashboard_stats, dispensation_facts, ledger
+from .ledger import InsufficientLotStock
+from .alerts import enqueue_alert_keys
+from .analytics_cache import touch, DISPENSATIONS
+from .catalog import get_catalog
+from .models import Dispensation, DispensationItem, LotBalance, PrescriptionPhoto, StockEntry
+
+Allocation = namedtuple('Allocation', ['stock_entry_id', 'medication_id', 'quantity', 'expiry_date', 'unit_price'])
+Shortage = namedtuple('Shortage', ['medication_id', 'requested', 'available'])
+
+MAX_ATTEMPTS = 5
+
+
+class AllocationConflict(Exception):
+    """Lots modifiés par d'autres dispensations à chaque tentative"""
+
+
+class InsufficientStock(Exception):
+    """Stock non périmé insuffisant pour au moins un médicament"""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(', '.join(
+            f"médicament {shortage.medication_id} : {shortage.available}/{shortage.requested}"
+            for shortage in shortages
+        ))
+
+
+def merge_lines(lines):
+    """{médicament: quantité} à partir de lignes (médicament, quantité), doublons cumulés"""
+    requested = {}
+    for medication_id, quantity in lines:
+        requested[medication_id] = requested.get(medication_id, 0) + quantity
+    return requested
+
+
+def allocate_fefo(project_id, lines, today=None, allow_partial=False):
+    """
+    Répartit les lignes (médicament, quantité) sur les lots du projet.
+
+    Retourne (allocations, manques). Sans `allow_partial`, lève
+    InsufficientStock si un médicament ne peut être servi en totalité.
+    """
+    requested = merge_lines(lines)
+    today = today or date.today()
+
+    lots = {}
+    rows = LotBalance.objects.filter(
+        project_id=project_id,
+        medication_id__in=requested,
+        expiry_date__gte=today,
+        quantity_available__gt=0,
+    ).order_by('medication_id', 'expiry_date', 'stock_entry_id').values_list(
+        'stock_entry_id', 'medication_id', 'quantity_available', 'expiry_date', 'stock_entry__unit_price'
+    )
+    for row in rows:
+        lots.setdefault(row[1], []).append(row)
+
+    allocations = []
+    shortages = []
+    for medication_id, quantity in requested.items():
+        remaining = quantity
+        for stock_entry_id, _, available, expiry_date, unit_price in lots.get(medication_id, ()):
+            taken = min(remaining, available)
+            allocations.append(Allocation(stock_entry_id, medication_id, taken, expiry_date, unit_price))
+            remaining -= taken
+            if not remaining:
+                break
+        if remaining:
+            shortages.append(Shortage(medication_id, quantity, quantity - remaining))
+
+    if shortages and not allow_partial:
+        raise InsufficientStock(shortages)
+    return allocations, shortages
+
+
+def withdraw_fefo(dispensation, lines, today=None, allow_partial=False):
+    """
+    Alloue les lignes en FEFO et sort les quantités des soldes ; l'allocation
+    est recalculée si un lot a été entamé entre-temps. Retourne (articles non
+    enregistrés, manques). À appeler dans une transaction.
+    """
+    for _ in range(MAX_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                allocations, shortages = allocate_fefo(dispensation.project_id, lines, today, allow_partial)
+                items = [
+                    DispensationItem(
+                        dispensation=dispensation,
+                        medication_id=allocation.medication_id,
+                        stock_entry_id=allocation.stock_entry_id,
+                        quantity_dispensed=allocation.quantity,
+                        unit_price=allocation.unit_price,
+                    )
+                    for allocation in allocations
+                ]
+                # bulk_create ne déclenche pas les signaux : sorties explicites
+                ledger.record_dispensed_items(dispensation, items)
+            return items, shortages
+        except InsufficientLotStock:
+            continue
+    raise AllocationConflict(f"Allocation impossible après {MAX_ATTEMPTS} tentatives")
+
+
+@transaction.atomic
+def dispense_fefo(dispensation, lines, today=None, allow_partial=False):
+    """
+    Crée les articles de la dispensation alloués en FEFO, met à jour les
+    soldes, la file des alertes et le statut de la dispensation (livraison
+    partielle s'il reste des manques). Retourne (articles, manques).
+    """
+    items, shortages = withdraw_fefo(dispensation, lines, today, allow_partial)
+    items = DispensationItem.objects.bulk_create(items)
+    dispensation.status = 'PARTIAL' if shortages else 'DELIVERED'
+    dispensation.save(update_fields=['status'])
+    enqueue_alert_keys({
+        (dispensation.organization_id, dispensation.project_id, medication_id)
+        for medication_id in merge_lines(lines)
+    })
+    return items, shortages
+
+
+def _reference_errors(record, projects, photos, lots, catalogs):
+    """Erreurs de références d'une dispensation (projet, photo, médicaments, lots)"""
+    errors = {}
+    project = projects.get(record['project'])
+    if project is None:
+        errors['project'] = ["Projet inconnu ou hors de votre périmètre"]
+    elif project.organization_id != record['organization']:
+        errors['organization'] = ["Le projet n'appartient pas à cette organisation"]
+    if record['prescription_photo'] not in photos:
+        errors['prescription_photo'] = ["Photo d'ordonnance inconnue"]
+
+    catalog = catalogs.get(record['organization'])
+    item_errors = []
+    for item in record['items']:
+        item_error = {}
+        if catalog is None or item['medication'] not in catalog.by_id:
+            item_error['medication'] = ["Médicament inconnu"]
+        stock_entry_id = item.get('stock_entry')
+        if stock_entry_id is not None:
+            lot = lots.get(stock_entry_id)
+            if lot is None or lot.project_id != record['project'] or lot.medication_id != item['medication']:
+                item_error['stock_entry'] = ["Lot inconnu pour ce projet et ce médicament"]
+        item_errors.append(item_error)
+    if any(item_errors):
+        errors['items'] = item_errors
+    return errors
+
+
+def _withdraw_record(dispensation, record, lots, today):
+    """Articles d'une dispensation : lots imposés d'abord, puis FEFO pour les autres lignes"""
+    items = [
+        DispensationItem(
+            dispensation=dispensation,
+            medication_id=item['medication'],
+            stock_entry_id=item['stock_entry'],
+            quantity_dispensed=item['quantity'],
+            unit_price=item.get('unit_price', lots[item['stock_entry']].unit_price),
+        )
+        for item in record['items'] if item.get('stock_entry') is not None
+    ]
+    ledger.record_dispensed_items(dispensation, items)
+
+    lines = [(item['medication'], item['quantity']) for item in record['items'] if item.get('stock_entry') is None]
+    shortages = []
+    if lines:
+        allocated, shortages = withdraw_fefo(dispensation, lines, today, record['allow_partial'])
+        items.extend(allocated)
+    return items, shortages
+
+
+def create_dispensations(records, user, projects, today=None, all_or_nothing=False):
+    """
+    Enregistre des dispensations avec leurs articles.
+
+    `records` : liste de (indice, données validées par
+    BulkDispensationSerializer) ; `projects` : projets accessibles à
+    l'utilisateur. Chaque dispensation est acceptée ou rejetée
+    indépendamment ; avec `all_or_nothing`, un seul rejet annule tout.
+    Retourne {indice: résultat}.
+    """
+    records = list(records)
+    projects = projects.in_bulk({record['project'] for _, record in records})
+    photos = set(PrescriptionPhoto.objects.filter(
+        id__in={record['prescription_photo'] for _, record in records}
+    ).values_list('id', flat=True))
+    lots = StockEntry.objects.only('id', 'project_id', 'medication_id', 'unit_price').in_bulk({
+        item['stock_entry'] for _, record in records for item in record['items']
+        if item.get('stock_entry') is not None
+    })
+    catalogs = {
+        project.organization_id: get_catalog(project.organization_id) for project in projects.values()
+    }
+
+    results = {}
+    accepted = []
+    with transaction.atomic():
+        for index, record in records:
+            errors = _reference_errors(record, projects, photos, lots, catalogs)
+            if errors:
+                results[index] = {'index': index, 'result': 'rejected', 'errors': errors}
+                continue
+
+            fields = {
+                key: value for key, value in record.items()
+                if key not in ('items', 'allow_partial', 'organization', 'project', 'prescription_photo')
+            }
+            dispensation = Dispensation(
+                **fields,
+                organization_id=record['organization'],
+                project_id=record['project'],
+                prescription_photo_id=record['prescription_photo'],
+                created_by=user,
+            )
+            try:
+                with transaction.atomic():
+                    items, shortages = _withdraw_record(dispensation, record, lots, today)
+            except InsufficientStock as error:
+                results[index] = {
+                    'index': index, 'result': 'rejected', 'errors': {'items': ["Stock insuffisant"]},
+                    'shortages': [shortage._asdict() for shortage in error.shortages],
+                }
+                continue
+            except (InsufficientLotStock, AllocationConflict) as error:
+                results[index] = {'index': index, 'result': 'rejected', 'errors': {'items': [str(error)]}}
+                continue
+
+            dispensation.status = 'PARTIAL' if shortages else 'DELIVERED'
+            accepted.append((index, dispensation, items, shortages))
+
+        if all_or_nothing and len(accepted) < len(records):
+            transaction.set_rollback(True)
+            for index, *_ in accepted:
+                results[index] = {'index': index, 'result': 'not_created'}
+            return results
+
+        Dispensation.objects.bulk_create([dispensation for _, dispensation, _, _ in accepted])
+        DispensationItem.objects.bulk_create([item for _, _, items, _ in accepted for item in items])
+        enqueue_alert_keys({
+            (dispensation.organization_id, dispensation.project_id, item.medication_id)
+            for _, dispensation, items, _ in accepted for item in items
+        })
+        # bulk_create ne déclenche pas les signaux : faits, analyses en cache et statistiques explicites
+        dispensation_facts.mark_days({dispensation_facts.day_key(dispensation) for _, dispensation, _, _ in accepted})
+        touch(DISPENSATIONS, {dispensation.organization_id for _, dispensation, _, _ in accepted})
+        dashboard_stats.adjust('dispensation_count', len(accepted))
+
+    for index, dispensation, items, shortages in accepted:
+        results[index] = {
+            'index': index, 'result': 'created', 'id': dispensation.pk, 'status': dispensation.status,
+            'items': len(items), 'shortages': [shortage._asdict() for shortage in shortages],
+        }
+    return results
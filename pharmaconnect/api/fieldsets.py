@@ -0,0 +1,235 @@
+"""
+Forme des réponses choisie par le client : ?fields= et ?expand=.
+
+- ?fields=id,quantity_delivered,medication_details.name : seuls les champs
+  nommés sont rendus ; un chemin pointé restreint un objet imbriqué
+  (articles, détails du médicament).
+- ?expand= : les objets imbriqués coûteux (Meta.expandable_fields :
+  détails du médicament, articles...) ne sont rendus que s'ils sont nommés,
+  par exemple ?expand=items,items.medication_details. Sans ce paramètre ils
+  sont tous rendus, comme auparavant.
+- ?include=medications (listes) : les lignes ne portent que l'identifiant
+  `medication` ; chaque médicament de la page figure une seule fois dans
+  `included.medications` ({id: détails}) au lieu d'être répété par ligne.
+
+Les vues adaptent leur requête à la forme demandée : jointures
+(select_related), préchargements (prefetch_related) et colonnes (.only())
+sont déduits des sources des champs conservés. Une propriété du modèle
+doit déclarer ses colonnes dans Meta.source_columns du sérialiseur, faute
+de quoi la requête n'est pas restreinte.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+from .catalog import medication_representations
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+INCLUDE_PARAM = 'include'
+
+# Objets regroupés dans `included` : clé des identifiants dans les lignes, chargement
+SIDE_LOADERS = {
+    'medications': ('medication', medication_representations),
+}
+
+
+def parse_paths(value):
+    """Ensemble des chemins d'une liste séparée par des virgules"""
+    return {path.strip() for path in value.split(',') if path.strip()}
+
+
+def field_path(field):
+    """Chemin pointé d'un champ ou d'un sérialiseur depuis la racine"""
+    names = []
+    while field.parent is not None:
+        if field.field_name:
+            names.append(field.field_name)
+        field = field.parent
+    return '.'.join(reversed(names))
+
+
+def collect_ids(data, key):
+    """Identifiants `key` des lignes sérialisées, objets imbriqués compris"""
+    ids = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if isinstance(value.get(key), int):
+                ids.add(value[key])
+            stack.extend(item for item in value.values() if isinstance(item, (dict, list)))
+        elif isinstance(value, list):
+            stack.extend(value)
+    return ids
+
+
+def requested_subfields(field):
+    """Sous-champs demandés sous le chemin du champ ; None pour tous"""
+    requested = field.context.get('sparse_fields')
+    if requested is None:
+        return None
+    prefix = field_path(field)
+    prefix = f'{prefix}.' if prefix else ''
+    names = {path[len(prefix):].split('.')[0] for path in requested if path.startswith(prefix)}
+    return names or None
+
+
+class SparseFieldsMixin:
+    """Sérialiseur dont les champs suivent ?fields= et ?expand= (contexte de la vue)"""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        included = self.context.get('included')
+        if included:
+            # Détails regroupés dans `included` (champ portant side_load)
+            for name, field in list(fields.items()):
+                if getattr(field, 'side_load', None) in included:
+                    del fields[name]
+
+        requested = self.context.get('sparse_fields')
+        expand = self.context.get('expand')
+        if requested is None and expand is None:
+            return fields
+
+        prefix = field_path(self)
+        prefix = f'{prefix}.' if prefix else ''
+        if expand is not None:
+            named = expand | (requested or set())
+            for name in getattr(self.Meta, 'expandable_fields', ()):
+                path = prefix + name
+                if path not in named and not any(other.startswith(path + '.') for other in named):
+                    fields.pop(name, None)
+
+        names = requested_subfields(self)
+        if names:
+            fields = type(fields)((name, field) for name, field in fields.items() if name in names)
+        return fields
+
+
+def _add_source(model, attrs, parent, columns, select, prefetch):
+    """
+    Colonnes, jointures et préchargements nécessaires à une source
+    (['organization', 'name']...) ; False si elle est inconnue
+    """
+    path = []
+    current = model
+    for position, attr in enumerate(attrs):
+        try:
+            field = current._meta.get_field(attr)
+        except FieldDoesNotExist:
+            if current is model:
+                return False  # propriété du modèle : colonnes inconnues
+            # Méthode d'un modèle lié (get_full_name...) : toutes ses colonnes
+            columns.update('__'.join(path + [column.name]) for column in current._meta.concrete_fields)
+            return True
+
+        name = '__'.join(path + [field.name])
+        if field.many_to_many or field.one_to_many:
+            prefetch.add(name)
+            return True
+        if not field.is_relation:
+            columns.add(name)
+            return True
+        if field.concrete:
+            columns.add(name)
+        last = position == len(attrs) - 1
+        if last or attr == getattr(field, 'attname', None) or (not path and field.name == parent):
+            # Identifiant seul, ou parent déjà en cache (préchargement)
+            return field.concrete
+        select.add(name)
+        path.append(field.name)
+        current = field.related_model
+    return True
+
+
+def shape_queryset(queryset, serializer, parent=None):
+    """
+    Restreint le queryset aux colonnes, jointures et préchargements utilisés
+    par les champs du sérialiseur. `parent` : relation vers l'objet parent
+    d'un préchargement, déjà en cache.
+    """
+    model = queryset.model
+    columns = {model._meta.pk.name}
+    if parent:
+        columns.add(parent)
+    select = set()
+    prefetch = set()
+    nested = []
+    source_columns = getattr(getattr(serializer, 'Meta', None), 'source_columns', {})
+
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.ListSerializer) and isinstance(field.child, serializers.ModelSerializer):
+            relation = model._meta.get_field(field.source)
+            related = relation.related_model
+            nested.append(Prefetch(field.source, queryset=shape_queryset(
+                related._default_manager.all(), field.child, parent=relation.field.name
+            )))
+            continue
+
+        if name in source_columns:
+            sources = [path.split('.') for path in source_columns[name]]
+        elif getattr(field, 'source_columns', None) is not None:
+            sources = [path.split('.') for path in field.source_columns]
+        elif field.source == '*':
+            return queryset
+        else:
+            sources = [field.source_attrs]
+        for attrs in sources:
+            if not _add_source(model, attrs, parent, columns, select, prefetch):
+                return queryset
+
+    for term in queryset.query.order_by:
+        if isinstance(term, str):
+            columns.add(term.lstrip('-'))
+
+    queryset = queryset.select_related(None).prefetch_related(None).prefetch_related(*prefetch, *nested)
+    if select:
+        # select_related() sans argument suivrait toutes les relations
+        queryset = queryset.select_related(*select)
+    return queryset.only(*columns)
+
+
+class SparseFieldsViewSetMixin:
+    """Vue dont les lectures (liste, détail) suivent ?fields= et ?expand="""
+    sparse_actions = ('list', 'retrieve')
+
+    def _sparse_params(self):
+        if getattr(self, 'action', None) not in self.sparse_actions:
+            return None, None
+        params = self.request.query_params
+        requested = parse_paths(params[FIELDS_PARAM]) if FIELDS_PARAM in params else None
+        expand = parse_paths(params[EXPAND_PARAM]) if EXPAND_PARAM in params else None
+        return requested or None, expand
+
+    def _included(self):
+        if getattr(self, 'action', None) != 'list' or INCLUDE_PARAM not in self.request.query_params:
+            return set()
+        return parse_paths(self.request.query_params[INCLUDE_PARAM]) & set(SIDE_LOADERS)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['sparse_fields'], context['expand'] = self._sparse_params()
+        context['included'] = self._included()
+        return context
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self._sparse_params() != (None, None) or self._included():
+            queryset = shape_queryset(queryset, self.get_serializer())
+        return queryset
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        included = self._included()
+        if included:
+            response.data['included'] = {
+                name: {
+                    str(object_id): value
+                    for object_id, value in SIDE_LOADERS[name][1](collect_ids(data, SIDE_LOADERS[name][0])).items()
+                }
+                for name in sorted(included)
+            }
+        return response
@@ -0,0 +1,150 @@
+"""
+Décodage des chaînes d'éléments GS1 lues sur les boîtes (DataMatrix, GS1-128).
+
+Formats acceptés :
+- texte lisible : (01)03400930000000(17)261231(10)LOT42 ;
+- flux brut du lecteur : identifiant de symbologie optionnel (]d2, ]C1...),
+  éléments de longueur variable terminés par le séparateur GS (FNC1) ;
+- GTIN seul (EAN-8, EAN-13, UPC-A ou GTIN-14).
+"""
+import calendar
+import re
+from collections import namedtuple
+from datetime import date
+
+GS = '\x1d'
+
+# Identifiants d'application (AI) de longueur fixe
+FIXED_LENGTH = {
+    '00': 18, '01': 14, '02': 14, '11': 6, '12': 6, '13': 6,
+    '15': 6, '16': 6, '17': 6, '20': 2,
+}
+# AI de longueur variable (longueur maximale)
+VARIABLE_LENGTH = {
+    '10': 20, '21': 20, '22': 20, '30': 8, '37': 8,
+    '240': 30, '241': 30, '250': 30, '251': 30,
+    '90': 30, '91': 90, '92': 90, '93': 90, '94': 90,
+    '95': 90, '96': 90, '97': 90, '98': 90, '99': 90,
+}
+DATE_AIS = ('11', '12', '13', '15', '16', '17')
+
+SYMBOLOGY_IDENTIFIER = re.compile(r'^\][A-Za-z][0-9]')
+HUMAN_READABLE = re.compile(r'\((\d{2,4})\)([^(]*)')
+HUMAN_READABLE_STRING = re.compile(r'(\(\d{2,4}\)[^(]*)+')
+
+ScanData = namedtuple('ScanData', ['gtin', 'batch_number', 'expiry_date', 'serial_number', 'elements'])
+
+
+class GS1Error(ValueError):
+    """Chaîne GS1 illisible"""
+
+
+def gtin_check_digit(digits):
+    """Clé de contrôle (modulo 10) des chiffres d'un GTIN sans sa clé"""
+    total = sum(int(digit) * (3 if index % 2 == 0 else 1) for index, digit in enumerate(reversed(digits)))
+    return str((10 - total % 10) % 10)
+
+
+def normalize_gtin(value):
+    """GTIN sur 14 chiffres, ou None si la valeur n'est pas un GTIN valide"""
+    value = (value or '').strip()
+    if not value.isdigit() or len(value) not in (8, 12, 13, 14):
+        return None
+    value = value.zfill(14)
+    if gtin_check_digit(value[:-1]) != value[-1]:
+        return None
+    return value
+
+
+def _parse_date(value):
+    """AAMMJJ ; un jour 00 désigne le dernier jour du mois"""
+    if not re.fullmatch(r'\d{6}', value):
+        raise GS1Error(f"Date GS1 invalide : {value}")
+    year, month, day = 2000 + int(value[:2]), int(value[2:4]), int(value[4:])
+    try:
+        if day == 0:
+            day = calendar.monthrange(year, month)[1]
+        return date(year, month, day)
+    except ValueError:
+        raise GS1Error(f"Date GS1 invalide : {value}")
+
+
+def _identifier(data, position):
+    for length in (2, 3, 4):
+        ai = data[position:position + length]
+        if ai in FIXED_LENGTH or ai in VARIABLE_LENGTH:
+            return ai
+    raise GS1Error(f"Identifiant d'application inconnu en position {position}")
+
+
+def _raw_elements(data):
+    elements = {}
+    position = 0
+    while position < len(data):
+        if data[position] == GS:
+            position += 1
+            continue
+        ai = _identifier(data, position)
+        position += len(ai)
+        if ai in FIXED_LENGTH:
+            end = position + FIXED_LENGTH[ai]
+            if end > len(data):
+                raise GS1Error(f"Élément ({ai}) tronqué")
+        else:
+            separator = data.find(GS, position)
+            end = len(data) if separator == -1 else separator
+            if end - position > VARIABLE_LENGTH[ai]:
+                raise GS1Error(f"Élément ({ai}) trop long")
+        elements[ai] = data[position:end]
+        position = end
+    return elements
+
+
+def parse_elements(data):
+    """{AI: valeur} d'une chaîne GS1 (texte lisible ou flux brut)"""
+    data = SYMBOLOGY_IDENTIFIER.sub('', (data or '').strip())
+    if not data:
+        raise GS1Error("Code vide")
+    if data.startswith('('):
+        if not HUMAN_READABLE_STRING.fullmatch(data):
+            raise GS1Error("Chaîne GS1 mal formée")
+        elements = {}
+        for ai, value in HUMAN_READABLE.findall(data):
+            if ai not in FIXED_LENGTH and ai not in VARIABLE_LENGTH:
+                raise GS1Error(f"Identifiant d'application inconnu : ({ai})")
+            elements[ai] = value.strip()
+        return elements
+    if data.isdigit() and len(data) in (8, 12, 13, 14):
+        return {'01': data.zfill(14)}
+    return _raw_elements(data)
+
+
+def parse_scan(data):
+    """Décode un code scanné en ScanData ; lève GS1Error si illisible"""
+    elements = parse_elements(data)
+    gtin = None
+    if '01' in elements or '02' in elements:
+        gtin = normalize_gtin(elements.get('01') or elements.get('02'))
+        if gtin is None:
+            raise GS1Error("GTIN invalide (clé de contrôle)")
+    for ai in DATE_AIS:
+        if ai in elements:
+            _parse_date(elements[ai])  # validation
+    return ScanData(
+        gtin=gtin,
+        batch_number=elements.get('10'),
+        expiry_date=_parse_date(elements['17']) if '17' in elements else None,
+        serial_number=elements.get('21'),
+        elements=elements,
+    )
+
+
+def barcode_gtin(barcode):
+    """GTIN d'un code-barres enregistré (GTIN seul ou chaîne GS1 complète)"""
+    gtin = normalize_gtin(barcode)
+    if gtin is not None or not barcode:
+        return gtin
+    try:
+        return parse_scan(barcode).gtin
+    except GS1Error:
+        return None
@@ -0,0 +1,67 @@
+"""
+Analyse des écarts d'un inventaire (écart = stock théorique - stock
+physique) calculée en base : compteurs, totaux et valorisation des écarts en
+une seule requête d'agrégation conditionnelle.
+
+Les écarts sont valorisés au prix unitaire du lot (StockEntry.unit_price),
+à défaut à celui du médicament : un écart positif est un manquant, un écart
+négatif un excédent.
+"""
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+VARIANCE = F('theoretical_stock') - F('physical_stock')
+UNIT_PRICE = Coalesce('stock_entry__unit_price', 'medication__unit_price', Value(Decimal('0')))
+VARIANCE_VALUE = ExpressionWrapper(VARIANCE * UNIT_PRICE, output_field=DecimalField(max_digits=18, decimal_places=2))
+SHORTAGE = Q(theoretical_stock__gt=F('physical_stock'))
+SURPLUS = Q(theoretical_stock__lt=F('physical_stock'))
+
+ROW_FIELDS = [
+    'id', 'medication', 'stock_entry', 'expiry_date', 'theoretical_stock', 'physical_stock',
+    'variance', 'unit_price', 'variance_value',
+]
+
+
+def _percentage(part, total):
+    return (part / total * 100) if total > 0 else 0
+
+
+def analyze_items(items):
+    """Compteurs, totaux et valorisation des écarts des articles donnés"""
+    zero = Value(Decimal('0'))
+    totals = items.aggregate(
+        total_items=Count('id'),
+        positive_variances=Count('id', filter=SHORTAGE),
+        negative_variances=Count('id', filter=SURPLUS),
+        total_variance=Coalesce(Sum(VARIANCE), 0),
+        variance_value=Coalesce(Sum(VARIANCE_VALUE), zero),
+        shortage_value=Coalesce(Sum(VARIANCE_VALUE, filter=SHORTAGE), zero),
+        surplus_value=Coalesce(Sum(VARIANCE_VALUE, filter=SURPLUS), zero),
+    )
+    return {
+        'total_items': totals['total_items'],
+        'positive_variances': totals['positive_variances'],
+        'negative_variances': totals['negative_variances'],
+        'positive_variance_percentage': _percentage(totals['positive_variances'], totals['total_items']),
+        'negative_variance_percentage': _percentage(totals['negative_variances'], totals['total_items']),
+        'total_variance': totals['total_variance'],
+        'variance_value': totals['variance_value'],
+        'shortage_value': totals['shortage_value'],
+        'surplus_value': -totals['surplus_value'],
+    }
+
+
+def variance_rows(items):
+    """
+    Articles en écart sous forme de dictionnaires (sans sérialiseur),
+    lus par lots : écart, pourcentage et valeur de l'écart compris
+    """
+    rows = items.exclude(theoretical_stock=F('physical_stock')).annotate(
+        variance=VARIANCE, unit_price=UNIT_PRICE, variance_value=VARIANCE_VALUE
+    ).order_by('id').values(*ROW_FIELDS)
+    for row in rows.iterator(chunk_size=2000):
+        physical_stock = row['physical_stock']
+        row['variance_percentage'] = (row['variance'] / physical_stock * 100) if physical_stock > 0 else 0
+        yield row
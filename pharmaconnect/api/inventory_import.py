@@ -0,0 +1,302 @@
+"""
+Import d'une feuille de comptage (CSV ou XLSX) dans un inventaire : une
+ligne par article (code du médicament, numéro de lot, stock physique,
+date de péremption).
+
+La feuille est lue en flux (csv ligne à ligne, openpyxl en lecture seule)
+et traitée par paquets de CHUNK_SIZE lignes : médicaments résolus par code
+dans le catalogue en mémoire (api.catalog), lots et stock théorique lus
+ensemble en une requête sur les soldes de lots (StockBalance pour un
+article sans lot), articles écrits par bulk_create et écarts reportés au
+grand livre par UPDATE groupés (api.ledger). Seuls le paquet courant, les
+clés des articles déjà saisis et le rapport d'erreurs (limité à
+MAX_REPORTED_ERRORS lignes) sont tenus en mémoire.
+"""
+import csv
+import itertools
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db import transaction
+
+from . import ledger
+from .alerts import enqueue_alert_keys
+from .catalog import get_catalog
+from .models import InventoryItem, LotBalance, StockBalance
+from .search import fold
+
+CHUNK_SIZE = 2000
+MAX_REPORTED_ERRORS = 1000
+
+# En-têtes reconnues (minuscules sans accents, séparateurs remplacés par "_")
+COLUMNS = {
+    'code': {'code', 'code_medicament', 'medication_code', 'medicament', 'medication'},
+    'batch_number': {'lot', 'numero_lot', 'n_lot', 'no_lot', 'batch', 'batch_number'},
+    'physical_stock': {
+        'physical_stock', 'stock_physique', 'quantite', 'quantite_comptee', 'quantity', 'qte',
+    },
+    'expiry_date': {'expiry_date', 'date_peremption', 'peremption', 'date_expiration', 'expiration'},
+}
+REQUIRED_COLUMNS = ['code', 'physical_stock']
+DAY_FIRST_DATE = re.compile(r'(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})$')
+REQUIRED = 'Ce champ est obligatoire.'
+
+
+class ImportFormatError(Exception):
+    """Fichier illisible ou colonnes obligatoires absentes"""
+
+
+def _header_key(value):
+    return re.sub(r'[^a-z0-9]+', '_', fold(str(value or ''))).strip('_')
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _decoded_lines(upload):
+    """Lignes du fichier en UTF-8, à défaut en Latin-1 (exports de tableurs)"""
+    for number, line in enumerate(upload):
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError:
+            text = line.decode('latin-1')
+        yield text.lstrip('\ufeff') if number == 0 else text
+
+
+def _csv_rows(upload):
+    lines = _decoded_lines(upload)
+    first = next(lines, '')
+    delimiter = max(';,\t', key=first.count)
+    try:
+        yield from csv.reader(itertools.chain([first], lines), delimiter=delimiter)
+    except csv.Error as error:
+        raise ImportFormatError(f"Fichier CSV illisible : {error}")
+
+
+def _xlsx_rows(upload):
+    try:
+        from openpyxl import load_workbook
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        raise ImportFormatError("Lecture des fichiers XLSX indisponible (openpyxl non installé)")
+    try:
+        workbook = load_workbook(upload, read_only=True, data_only=True)
+    except (InvalidFileException, zipfile.BadZipFile, KeyError, OSError):
+        raise ImportFormatError("Fichier XLSX illisible")
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_sheet(upload):
+    """
+    Lignes (numéro, {colonne: valeur}) de la feuille, en flux ; lève
+    ImportFormatError si le format ou les en-têtes ne conviennent pas
+    """
+    name = (upload.name or '').lower()
+    if name.endswith('.xlsx'):
+        rows = _xlsx_rows(upload)
+    elif name.endswith(('.csv', '.txt')):
+        rows = _csv_rows(upload)
+    else:
+        raise ImportFormatError("Format non pris en charge (CSV ou XLSX)")
+
+    header = [_header_key(value) for value in next(rows, None) or []]
+    positions = {}
+    for column, aliases in COLUMNS.items():
+        position = next((index for index, key in enumerate(header) if key in aliases), None)
+        if position is not None:
+            positions[column] = position
+    missing = [column for column in REQUIRED_COLUMNS if column not in positions]
+    if missing:
+        raise ImportFormatError(f"Colonnes obligatoires absentes : {', '.join(missing)}")
+
+    def values():
+        for number, row in enumerate(rows, start=2):
+            row = list(row)
+            if not any(_text(value) for value in row):
+                continue
+            yield number, {
+                column: row[position] if position < len(row) else None
+                for column, position in positions.items()
+            }
+
+    return values()
+
+
+def _quantity(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if not isinstance(value, (int, float, Decimal)):
+        value = Decimal(_text(value).replace('\u00a0', '').replace(' ', '').replace(',', '.'))
+    if value < 0 or value != int(value):
+        raise ValueError(value)
+    return int(value)
+
+
+def _expiry_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = _text(value)
+    match = DAY_FIRST_DATE.match(text)
+    if match:
+        day, month, year = map(int, match.groups())
+        return date(year, month, day)
+    return date.fromisoformat(text)
+
+
+class ImportReport:
+    """Compteurs de l'import et lignes rejetées (les MAX_REPORTED_ERRORS premières)"""
+
+    def __init__(self):
+        self.created = 0
+        self.rejected = 0
+        self.not_created = 0
+        self.errors = []
+
+    def reject(self, number, errors):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'rejected': self.rejected,
+            'not_created': self.not_created,
+            'errors': self.errors,
+            'errors_truncated': self.rejected > len(self.errors),
+        }
+
+
+def _parse_row(values, catalog):
+    """(médicament, lot, stock physique, péremption) d'une ligne, et ses erreurs"""
+    errors = {}
+    code = _text(values.get('code'))
+    record = catalog.by_code.get(code) if code else None
+    if not code:
+        errors['code'] = [REQUIRED]
+    elif record is None:
+        errors['code'] = [f"Médicament inconnu : {code}"]
+
+    physical_stock = None
+    if not _text(values.get('physical_stock')):
+        errors['physical_stock'] = [REQUIRED]
+    else:
+        try:
+            physical_stock = _quantity(values['physical_stock'])
+        except (ValueError, ArithmeticError):
+            errors['physical_stock'] = ["Quantité entière positive ou nulle attendue."]
+
+    expiry_date = None
+    if _text(values.get('expiry_date')):
+        try:
+            expiry_date = _expiry_date(values['expiry_date'])
+        except ValueError:
+            errors['expiry_date'] = ["Date invalide (AAAA-MM-JJ ou JJ/MM/AAAA)."]
+
+    batch_number = _text(values.get('batch_number'))
+    return (record.id if record else None, batch_number, physical_stock, expiry_date), errors
+
+
+def _import_chunk(inventory, catalog, rows, seen, report):
+    """Rapproche et enregistre un paquet de lignes ; articles créés"""
+    parsed = []
+    for number, values in rows:
+        fields, errors = _parse_row(values, catalog)
+        if errors:
+            report.reject(number, errors)
+        else:
+            parsed.append((number, *fields))
+
+    # Lots et soldes théoriques du paquet : une requête pour les lots, une pour les médicaments
+    batches = {(medication_id, batch) for _, medication_id, batch, _, _ in parsed if batch}
+    lots = {}
+    if batches:
+        # Par projet et médicament : index lotbalance_proj_med_exp_idx
+        lot_rows = LotBalance.objects.filter(
+            project_id=inventory.project_id,
+            medication_id__in={medication_id for medication_id, _ in batches},
+            stock_entry__batch_number__in={batch for _, batch in batches},
+        ).values_list('medication_id', 'stock_entry__batch_number', 'stock_entry_id', 'expiry_date',
+                      'quantity_available')
+        for medication_id, batch, stock_entry_id, expiry_date, available in lot_rows:
+            lots.setdefault((medication_id, batch), []).append((stock_entry_id, expiry_date, available))
+    medications = {medication_id for _, medication_id, batch, _, _ in parsed if not batch}
+    balances = dict(StockBalance.objects.filter(
+        organization_id=inventory.organization_id, project_id=inventory.project_id,
+        medication_id__in=medications,
+    ).values_list('medication_id', 'quantity_available')) if medications else {}
+
+    items = []
+    for number, medication_id, batch, physical_stock, expiry_date in parsed:
+        stock_entry_id = None
+        if batch:
+            candidates = lots.get((medication_id, batch), [])
+            if len(candidates) > 1 and expiry_date:
+                candidates = [lot for lot in candidates if lot[1] == expiry_date]
+            if not candidates:
+                report.reject(number, {'batch_number': [f"Lot introuvable pour ce médicament : {batch}"]})
+                continue
+            if len(candidates) > 1:
+                report.reject(number, {'batch_number': ["Lot ambigu : préciser la date de péremption."]})
+                continue
+            stock_entry_id, lot_expiry_date, available = candidates[0]
+            expiry_date = expiry_date or lot_expiry_date
+        else:
+            available = balances.get(medication_id, 0)
+
+        key = (medication_id, stock_entry_id)
+        if key in seen:
+            previous = seen[key]
+            message = f"Article déjà compté ligne {previous}." if previous else "Article déjà saisi dans l'inventaire."
+            report.reject(number, {'non_field_errors': [message]})
+            continue
+        seen[key] = number
+        items.append(InventoryItem(
+            inventory_id=inventory.pk, medication_id=medication_id, stock_entry_id=stock_entry_id,
+            theoretical_stock=max(available, 0), physical_stock=physical_stock, expiry_date=expiry_date,
+        ))
+
+    InventoryItem.objects.bulk_create(items)
+    # bulk_create ne déclenche pas les signaux : soldes et alertes explicites
+    ledger.record_adjusted_items(inventory, items)
+    enqueue_alert_keys({
+        (inventory.organization_id, inventory.project_id, item.medication_id) for item in items
+    })
+    return len(items)
+
+
+def import_count_sheet(inventory, upload, all_or_nothing=False):
+    """
+    Importe la feuille de comptage dans l'inventaire en une transaction ;
+    avec `all_or_nothing`, une seule ligne rejetée annule tout. Lève
+    ImportFormatError si le fichier est illisible.
+    """
+    rows = read_sheet(upload)
+    catalog = get_catalog(inventory.organization_id)
+    # Articles déjà saisis : 0 à la place du numéro de ligne
+    seen = dict.fromkeys(
+        InventoryItem.objects.filter(inventory=inventory).values_list('medication_id', 'stock_entry_id'), 0
+    )
+    report = ImportReport()
+    with transaction.atomic():
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            report.created += _import_chunk(inventory, catalog, chunk, seen, report)
+        if all_or_nothing and report.rejected:
+            transaction.set_rollback(True)
+            report.created, report.not_created = 0, report.created
+    return report
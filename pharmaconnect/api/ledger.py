@@ -0,0 +1,396 @@
+"""
+Grand livre des stocks : soldes par lot (LotBalance) et par
+(organisation, projet, médicament) (StockBalance).
+
+Les soldes sont maintenus par incréments SQL (F()) dans la transaction de
+l'écriture qui les provoque (réception, dispensation, inventaire). Les
+sorties sont conditionnelles (UPDATE ... WHERE quantity_available >= n) :
+deux dispensations simultanées sur un même lot ne peuvent pas le rendre
+négatif, sans verrou tenu entre la lecture et l'écriture. Les
+écritures qui contournent les signaux (bulk_create, update) doivent appeler
+explicitement les fonctions de ce module ; `rebuild_balances` recalcule tout
+depuis les tables sources.
+"""
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Now
+
+from .analytics_cache import touch, touch_all, STOCK
+from .models import (
+    StockEntry, DispensationItem, InventoryItem, LotBalance, StockBalance
+)
+
+
+class InsufficientLotStock(Exception):
+    """Solde du lot insuffisant au moment de la sortie"""
+
+    def __init__(self, stock_entry_id, quantity):
+        self.stock_entry_id = stock_entry_id
+        self.quantity = quantity
+        super().__init__(f"Solde insuffisant sur le lot {stock_entry_id} pour sortir {quantity} unité(s)")
+
+
+def _shift_stock_balance(organization_id, project_id, medication_id, delta):
+    """Ajoute `delta` au solde (organisation, projet, médicament)"""
+    if not delta:
+        return
+    keys = {
+        'organization_id': organization_id,
+        'project_id': project_id,
+        'medication_id': medication_id,
+    }
+    updated = StockBalance.objects.filter(**keys).update(
+        quantity_available=F('quantity_available') + delta,
+        updated_at=Now()
+    )
+    if not updated:
+        balance, created = StockBalance.objects.get_or_create(
+            **keys, defaults={'quantity_available': delta}
+        )
+        if not created:
+            StockBalance.objects.filter(pk=balance.pk).update(
+                quantity_available=F('quantity_available') + delta,
+                updated_at=Now()
+            )
+
+
+def _shift_lot(stock_entry_id, dispensed=0, adjusted=0):
+    """Applique un mouvement à un lot puis au solde agrégé correspondant"""
+    keys = LotBalance.objects.filter(stock_entry_id=stock_entry_id).values_list(
+        'organization_id', 'project_id', 'medication_id'
+    ).first()
+    if keys is None:
+        # Lot supprimé (suppression en cascade) : rien à reporter
+        return False
+
+    delta = adjusted - dispensed
+    lots = LotBalance.objects.filter(stock_entry_id=stock_entry_id)
+    if dispensed > 0:
+        lots = lots.filter(quantity_available__gte=-delta)
+    updated = lots.update(
+        quantity_dispensed=F('quantity_dispensed') + dispensed,
+        quantity_adjusted=F('quantity_adjusted') + adjusted,
+        quantity_available=F('quantity_available') + delta,
+        updated_at=Now()
+    )
+    if not updated:
+        if dispensed > 0:
+            raise InsufficientLotStock(stock_entry_id, -delta)
+        return False
+    _shift_stock_balance(*keys, delta)
+    return True
+
+
+@transaction.atomic
+def record_reception(stock_entry):
+    """Ouvre le solde d'un nouveau lot"""
+    LotBalance.objects.create(
+        stock_entry=stock_entry,
+        organization_id=stock_entry.organization_id,
+        project_id=stock_entry.project_id,
+        medication_id=stock_entry.medication_id,
+        expiry_date=stock_entry.expiry_date,
+        quantity_received=stock_entry.quantity_delivered,
+        quantity_available=stock_entry.quantity_delivered,
+    )
+    _shift_stock_balance(
+        stock_entry.organization_id, stock_entry.project_id,
+        stock_entry.medication_id, stock_entry.quantity_delivered
+    )
+
+
+@transaction.atomic
+def update_reception(stock_entry, previous):
+    """Reporte la modification d'une entrée en stock sur les soldes"""
+    lot = LotBalance.objects.select_for_update().filter(stock_entry=stock_entry).first()
+    if lot is None or previous is None:
+        rebuild_lot(stock_entry)
+        return
+
+    delta = stock_entry.quantity_delivered - previous['quantity_delivered']
+    new_keys = (stock_entry.organization_id, stock_entry.project_id, stock_entry.medication_id)
+    old_keys = (lot.organization_id, lot.project_id, lot.medication_id)
+
+    LotBalance.objects.filter(pk=lot.pk).update(
+        organization_id=stock_entry.organization_id,
+        project_id=stock_entry.project_id,
+        medication_id=stock_entry.medication_id,
+        expiry_date=stock_entry.expiry_date,
+        quantity_received=F('quantity_received') + delta,
+        quantity_available=F('quantity_available') + delta,
+        updated_at=Now()
+    )
+    if new_keys == old_keys:
+        _shift_stock_balance(*new_keys, delta)
+    else:
+        _shift_stock_balance(*old_keys, -lot.quantity_available)
+        _shift_stock_balance(*new_keys, lot.quantity_available + delta)
+
+
+@transaction.atomic
+def remove_reception(stock_entry):
+    """Retire un lot supprimé des soldes"""
+    lot = LotBalance.objects.filter(stock_entry=stock_entry).first()
+    if lot is None:
+        return
+    _shift_stock_balance(lot.organization_id, lot.project_id, lot.medication_id, -lot.quantity_available)
+    # Supprimé avant la cascade pour que les articles dispensés ne
+    # reportent pas une seconde fois leur mouvement sur le solde agrégé
+    lot.delete()
+
+
+def record_dispensed(stock_entry_id, quantity):
+    """
+    Sortie de `quantity` unités d'un lot (négatif pour une annulation) ;
+    lève InsufficientLotStock si le solde du lot ne la couvre pas
+    """
+    if stock_entry_id and quantity:
+        _shift_lot(stock_entry_id, dispensed=quantity)
+
+
+@transaction.atomic
+def record_dispensed_items(dispensation, items):
+    """
+    Sorties d'articles d'une dispensation créés sans signaux (bulk_create).
+    Les lots doivent appartenir au projet de la dispensation. Lève
+    InsufficientLotStock dès qu'un lot ne couvre plus sa sortie : la
+    transaction de l'appelant doit alors être annulée.
+    """
+    totals = {}
+    # Toujours dans le même ordre pour éviter les interblocages entre transactions
+    for item in sorted(items, key=lambda item: item.stock_entry_id):
+        updated = LotBalance.objects.filter(
+            stock_entry_id=item.stock_entry_id,
+            quantity_available__gte=item.quantity_dispensed
+        ).update(
+            quantity_dispensed=F('quantity_dispensed') + item.quantity_dispensed,
+            quantity_available=F('quantity_available') - item.quantity_dispensed,
+            updated_at=Now()
+        )
+        if not updated:
+            raise InsufficientLotStock(item.stock_entry_id, item.quantity_dispensed)
+        totals[item.medication_id] = totals.get(item.medication_id, 0) + item.quantity_dispensed
+    for medication_id, quantity in totals.items():
+        _shift_stock_balance(dispensation.organization_id, dispensation.project_id, medication_id, -quantity)
+    touch(STOCK, [dispensation.organization_id])
+
+
+def record_adjustment(stock_entry_id, quantity):
+    """Écart d'inventaire sur un lot (physique - théorique)"""
+    if stock_entry_id and quantity:
+        _shift_lot(stock_entry_id, adjusted=quantity)
+
+
+def _by_key(field, deltas):
+    """
+    Incrément propre à chaque clé : CASE WHEN field IN (clés) THEN delta,
+    une branche par valeur d'écart (souvent peu nombreuses) plutôt que par clé
+    """
+    keys_by_delta = {}
+    for key, delta in deltas:
+        keys_by_delta.setdefault(delta, []).append(key)
+    return Case(
+        *[When(**{f'{field}__in': keys}, then=Value(delta)) for delta, keys in keys_by_delta.items()],
+        default=Value(0), output_field=IntegerField()
+    )
+
+
+@transaction.atomic
+def record_adjusted_items(inventory, items, batch_size=500):
+    """
+    Écarts d'articles d'inventaire créés sans signaux (bulk_create) : un
+    UPDATE groupé par paquet de lots puis de médicaments. Les lots doivent
+    appartenir au projet de l'inventaire ; les articles sans lot sont sans
+    effet sur les soldes.
+    """
+    lots = {}
+    totals = {}
+    for item in items:
+        adjustment = item.physical_stock - item.theoretical_stock
+        if item.stock_entry_id and adjustment:
+            lots[item.stock_entry_id] = lots.get(item.stock_entry_id, 0) + adjustment
+            totals[item.medication_id] = totals.get(item.medication_id, 0) + adjustment
+
+    # Toujours dans le même ordre pour éviter les interblocages entre transactions
+    lots = sorted(lots.items())
+    for start in range(0, len(lots), batch_size):
+        batch = lots[start:start + batch_size]
+        delta = _by_key('stock_entry_id', batch)
+        LotBalance.objects.filter(stock_entry_id__in=[key for key, _ in batch]).update(
+            quantity_adjusted=F('quantity_adjusted') + delta,
+            quantity_available=F('quantity_available') + delta,
+            updated_at=Now()
+        )
+
+    balances = StockBalance.objects.filter(
+        organization_id=inventory.organization_id, project_id=inventory.project_id
+    )
+    existing = set(balances.filter(medication_id__in=list(totals)).values_list('medication_id', flat=True))
+    totals = sorted((key, delta) for key, delta in totals.items() if delta)
+    for start in range(0, len(totals), batch_size):
+        batch = [(key, delta) for key, delta in totals[start:start + batch_size] if key in existing]
+        if batch:
+            balances.filter(medication_id__in=[key for key, _ in batch]).update(
+                quantity_available=F('quantity_available') + _by_key('medication_id', batch),
+                updated_at=Now()
+            )
+    for medication_id, delta in totals:
+        if medication_id not in existing:
+            _shift_stock_balance(inventory.organization_id, inventory.project_id, medication_id, delta)
+    touch(STOCK, [inventory.organization_id])
+
+
+def _lot_movements(entries):
+    """Sorties et ajustements par lot, en deux requêtes groupées"""
+    dispensed = dict(
+        DispensationItem.objects.filter(stock_entry__in=entries)
+        .values('stock_entry')
+        .annotate(total=Sum('quantity_dispensed'))
+        .values_list('stock_entry', 'total')
+    )
+    adjusted = dict(
+        InventoryItem.objects.filter(stock_entry__in=entries)
+        .values('stock_entry')
+        .annotate(total=Sum(F('physical_stock') - F('theoretical_stock')))
+        .values_list('stock_entry', 'total')
+    )
+    return dispensed, adjusted
+
+
+def compute_balances(organization_id=None):
+    """
+    Calcule les soldes attendus depuis les tables sources.
+
+    Retourne (lots, balances) : soldes de lots indexés par entrée en stock et
+    soldes agrégés indexés par (organisation, projet, médicament).
+    """
+    entries = StockEntry.objects.all()
+    if organization_id:
+        entries = entries.filter(organization_id=organization_id)
+
+    dispensed, adjusted = _lot_movements(entries)
+
+    lots = {}
+    balances = {}
+    rows = entries.values_list(
+        'id', 'organization_id', 'project_id', 'medication_id',
+        'expiry_date', 'quantity_delivered'
+    )
+    for entry_id, org_id, project_id, medication_id, expiry_date, received in rows.iterator():
+        out = dispensed.get(entry_id) or 0
+        adjustment = adjusted.get(entry_id) or 0
+        available = received - out + adjustment
+        lots[entry_id] = LotBalance(
+            stock_entry_id=entry_id,
+            organization_id=org_id,
+            project_id=project_id,
+            medication_id=medication_id,
+            expiry_date=expiry_date,
+            quantity_received=received,
+            quantity_dispensed=out,
+            quantity_adjusted=adjustment,
+            quantity_available=available,
+        )
+        key = (org_id, project_id, medication_id)
+        balances[key] = balances.get(key, 0) + available
+
+    return lots, balances
+
+
+@transaction.atomic
+def rebuild_lot(stock_entry):
+    """Recalcule le solde d'un seul lot depuis les tables sources"""
+    previous = LotBalance.objects.filter(stock_entry=stock_entry).first()
+    if previous is not None:
+        _shift_stock_balance(
+            previous.organization_id, previous.project_id,
+            previous.medication_id, -previous.quantity_available
+        )
+        previous.delete()
+
+    dispensed, adjusted = _lot_movements([stock_entry.pk])
+    out = dispensed.get(stock_entry.pk) or 0
+    adjustment = adjusted.get(stock_entry.pk) or 0
+    available = stock_entry.quantity_delivered - out + adjustment
+    LotBalance.objects.create(
+        stock_entry=stock_entry,
+        organization_id=stock_entry.organization_id,
+        project_id=stock_entry.project_id,
+        medication_id=stock_entry.medication_id,
+        expiry_date=stock_entry.expiry_date,
+        quantity_received=stock_entry.quantity_delivered,
+        quantity_dispensed=out,
+        quantity_adjusted=adjustment,
+        quantity_available=available,
+    )
+    _shift_stock_balance(
+        stock_entry.organization_id, stock_entry.project_id,
+        stock_entry.medication_id, available
+    )
+
+
+@transaction.atomic
+def rebuild_balances(organization_id=None):
+    """Reconstruit tous les soldes (ou ceux d'une organisation)"""
+    lots, balances = compute_balances(organization_id)
+
+    lot_balances = LotBalance.objects.all()
+    stock_balances = StockBalance.objects.all()
+    if organization_id:
+        lot_balances = lot_balances.filter(organization_id=organization_id)
+        stock_balances = stock_balances.filter(organization_id=organization_id)
+    lot_balances.delete()
+    stock_balances.delete()
+
+    LotBalance.objects.bulk_create(lots.values(), batch_size=1000)
+    StockBalance.objects.bulk_create(
+        [
+            StockBalance(
+                organization_id=org_id, project_id=project_id,
+                medication_id=medication_id, quantity_available=quantity
+            )
+            for (org_id, project_id, medication_id), quantity in balances.items()
+        ],
+        batch_size=1000
+    )
+    if organization_id:
+        touch(STOCK, [organization_id])
+    else:
+        touch_all(STOCK)
+    return len(lots), len(balances)
+
+
+def verify_balances(organization_id=None):
+    """Liste les écarts entre les soldes stockés et les soldes recalculés"""
+    lots, balances = compute_balances(organization_id)
+
+    lot_balances = LotBalance.objects.all()
+    stock_balances = StockBalance.objects.all()
+    if organization_id:
+        lot_balances = lot_balances.filter(organization_id=organization_id)
+        stock_balances = stock_balances.filter(organization_id=organization_id)
+
+    discrepancies = []
+    stored_lots = dict(lot_balances.values_list('stock_entry_id', 'quantity_available'))
+    for entry_id, lot in lots.items():
+        stored = stored_lots.pop(entry_id, None)
+        if stored != lot.quantity_available:
+            discrepancies.append(('lot', entry_id, stored, lot.quantity_available))
+    for entry_id, stored in stored_lots.items():
+        discrepancies.append(('lot', entry_id, stored, None))
+
+    stored_balances = {
+        (org_id, project_id, medication_id): quantity
+        for org_id, project_id, medication_id, quantity in stock_balances.values_list(
+            'organization_id', 'project_id', 'medication_id', 'quantity_available'
+        )
+    }
+    for key, expected in balances.items():
+        stored = stored_balances.pop(key, None)
+        if stored != expected:
+            discrepancies.append(('balance', key, stored, expected))
+    for key, stored in stored_balances.items():
+        if stored:
+            discrepancies.append(('balance', key, stored, 0))
+
+    return discrepancies
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.alerts import RULES, generate_alerts
+from api.models import Organization
+
+
+class Command(BaseCommand):
+    help = "Évalue les règles d'alertes et synchronise les alertes actives (à planifier via cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, help="Limiter à une organisation (id)")
+        parser.add_argument(
+            '--rule', action='append', dest='rules', choices=list(RULES),
+            help="Règle à évaluer (répétable, toutes par défaut)"
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Calculer sans écrire")
+
+    def handle(self, *args, **options):
+        scope = {}
+        if options['organization']:
+            try:
+                scope['organization'] = Organization.objects.get(id=options['organization'])
+            except Organization.DoesNotExist:
+                raise CommandError(f"Organisation {options['organization']} introuvable")
+
+        reports = generate_alerts(options['rules'], dry_run=options['dry_run'], **scope)
+
+        total = 0
+        for report in reports:
+            total += report.seconds
+            self.stdout.write(
+                f"{report.rule:<25} {report.candidates:>7} actives  "
+                f"+{report.created:<6} ~{report.updated:<6} -{report.resolved:<6} "
+                f"{report.seconds * 1000:>9.1f} ms"
+            )
+        prefix = "🔎 Simulation" if options['dry_run'] else "✅ Alertes synchronisées"
+        self.stdout.write(self.style.SUCCESS(f"{prefix} en {total:.2f} s"))
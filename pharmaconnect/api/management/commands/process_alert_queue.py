@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.alerts import process_alert_queue
+
+
+class Command(BaseCommand):
+    help = "Réévalue les alertes des clés (organisation, projet, médicament) modifiées depuis le dernier passage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Clés traitées par passage")
+        parser.add_argument('--loop', action='store_true', help="Tourner en continu (worker)")
+        parser.add_argument('--interval', type=float, default=5, help="Pause entre deux passages à vide (secondes)")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            processed = process_alert_queue(options['batch_size'])
+            if processed:
+                self.stdout.write(
+                    f"✅ {processed} clé(s) réévaluée(s) en {(time.perf_counter() - started) * 1000:.0f} ms"
+                )
+            if not options['loop']:
+                break
+            if processed < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.dispensation_facts import rebuild_facts
+
+
+class Command(BaseCommand):
+    help = "Reconstruit les faits de dispensation journaliers (analyses pharmacoépidémiologiques)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, help="Limiter à une organisation (id)")
+
+    def handle(self, *args, **options):
+        count = rebuild_facts(options['organization'])
+        self.stdout.write(self.style.SUCCESS(f"✅ {count} ligne(s) de faits reconstruite(s)"))
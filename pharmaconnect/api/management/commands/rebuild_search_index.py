@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'index de recherche des médicaments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, help="Limiter à une organisation (id)")
+
+    def handle(self, *args, **options):
+        count = rebuild_search_index(options['organization'])
+        self.stdout.write(self.style.SUCCESS(f"✅ {count} médicament(s) indexé(s)"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import ledger
+
+
+class Command(BaseCommand):
+    help = "Reconstruit (ou vérifie) les soldes de stock par lot et par médicament"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, help="Limiter à une organisation (id)")
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="Comparer les soldes stockés aux tables sources sans les modifier"
+        )
+
+    def handle(self, *args, **options):
+        organization_id = options['organization']
+
+        if options['verify']:
+            discrepancies = ledger.verify_balances(organization_id)
+            for kind, key, stored, expected in discrepancies:
+                self.stdout.write(f"❌ {kind} {key}: stocké={stored} attendu={expected}")
+            if discrepancies:
+                raise CommandError(f"{len(discrepancies)} écart(s) détecté(s)")
+            self.stdout.write(self.style.SUCCESS("✅ Soldes cohérents"))
+            return
+
+        lots, balances = ledger.rebuild_balances(organization_id)
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {lots} soldes de lots et {balances} soldes de stock reconstruits"
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from api.dashboard_stats import refresh_statistics
+
+
+class Command(BaseCommand):
+    help = "Recompte les statistiques du tableau de bord de l'administration"
+
+    def handle(self, *args, **options):
+        for name, value in refresh_statistics().items():
+            self.stdout.write(f"{name}: {value}")
+        self.stdout.write(self.style.SUCCESS("✅ Statistiques du tableau de bord recomptées"))
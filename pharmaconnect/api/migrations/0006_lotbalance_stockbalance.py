@@ -0,0 +1,51 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_healthfacility_address_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LotBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expiry_date', models.DateField()),
+                ('quantity_received', models.IntegerField(default=0)),
+                ('quantity_dispensed', models.IntegerField(default=0)),
+                ('quantity_adjusted', models.IntegerField(default=0)),
+                ('quantity_available', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.medication')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.project')),
+                ('stock_entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance', to='api.stockentry')),
+            ],
+            options={
+                'verbose_name': 'Solde de lot',
+                'verbose_name_plural': 'Soldes de lots',
+                'indexes': [models.Index(fields=['project', 'medication', 'expiry_date'], name='lotbalance_proj_med_exp_idx'), models.Index(fields=['organization', 'expiry_date'], name='lotbalance_org_exp_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity_available', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.medication')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.project')),
+            ],
+            options={
+                'verbose_name': 'Solde de stock',
+                'verbose_name_plural': 'Soldes de stock',
+                'unique_together': {('organization', 'project', 'medication')},
+            },
+        ),
+    ]
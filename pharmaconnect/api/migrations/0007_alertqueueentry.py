@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_lotbalance_stockbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertQueueEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.medication')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.project')),
+            ],
+            options={
+                'verbose_name': "Clé d'alerte à réévaluer",
+                'verbose_name_plural': "Clés d'alertes à réévaluer",
+                'unique_together': {('organization', 'project', 'medication')},
+            },
+        ),
+    ]
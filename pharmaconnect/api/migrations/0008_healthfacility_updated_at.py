@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_alertqueueentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='healthfacility',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_healthfacility_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MedicationSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=16)),
+                ('weight', models.PositiveSmallIntegerField(default=1)),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='api.medication')),
+                ('organization', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+            ],
+            options={
+                'verbose_name': 'Terme de recherche',
+                'verbose_name_plural': 'Termes de recherche',
+                'indexes': [models.Index(fields=['organization', 'term', 'weight', 'medication'], name='medsearch_org_term_idx')],
+                'unique_together': {('medication', 'term')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(fields=['organization', 'barcode_gs1'], name='medication_org_barcode_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockentry',
+            index=models.Index(fields=['medication', 'batch_number', 'expiry_date'], name='stockentry_med_batch_idx'),
+        ),
+    ]
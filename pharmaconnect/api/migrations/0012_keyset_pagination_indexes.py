@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_scan_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='consumptiondata',
+            index=models.Index(fields=['organization', 'year', 'week_number', 'id'], name='consumption_org_week_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dispensation',
+            index=models.Index(fields=['organization', 'dispensation_date', 'id'], name='dispensation_org_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockentry',
+            index=models.Index(fields=['organization', 'delivery_date', 'id'], name='stockentry_org_delivery_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_dashboard_statistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispensationDailyFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('destination', models.CharField(choices=[('PATIENT', 'Patient'), ('SERVICE', 'Service hôpital'), ('EXPIRED', 'Périmés/détériorés'), ('RETURN', 'Retour pharmacie')], max_length=20)),
+                ('status', models.CharField(choices=[('DELIVERED', 'Délivrée'), ('PENDING', 'En attente'), ('PARTIAL', 'Livraison partielle')], max_length=20)),
+                ('age_band', models.CharField(blank=True, max_length=10)),
+                ('patient_sex', models.CharField(blank=True, max_length=10)),
+                ('is_antenatal', models.BooleanField(default=False)),
+                ('has_antibiotic', models.BooleanField(default=False)),
+                ('has_antimalarial', models.BooleanField(default=False)),
+                ('prescriptions', models.PositiveIntegerField(default=0)),
+                ('items', models.PositiveIntegerField(default=0)),
+                ('quantity_dispensed', models.PositiveBigIntegerField(default=0)),
+                ('health_facility', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.healthfacility')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.project')),
+            ],
+            options={
+                'verbose_name': 'Fait de dispensation journalier',
+                'verbose_name_plural': 'Faits de dispensation journaliers',
+                'indexes': [models.Index(fields=['organization', 'day'], name='dispfact_org_day_idx'), models.Index(fields=['health_facility', 'day'], name='dispfact_facility_day_idx'), models.Index(fields=['project', 'day'], name='dispfact_project_day_idx')],
+            },
+        ),
+    ]
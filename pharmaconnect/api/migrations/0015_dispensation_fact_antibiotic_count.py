@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_dispensation_daily_facts'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='dispensationdailyfact',
+            name='has_antibiotic',
+        ),
+        migrations.AddField(
+            model_name='dispensationdailyfact',
+            name='antibiotic_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:34
+
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Classes suivies par les analyses ; les autres sont ajoutées dans l'administration
+CLASSES = [
+    ('J01', 'Antibiotiques', 'antibio,antibacter', True, False),
+    ('P01B', 'Antipaludiques', 'antipalu,antimalar', False, True),
+]
+
+
+def _fold(text):
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def classify_existing(apps, schema_editor):
+    """Crée les classes suivies et y rattache les médicaments d'après leur classe saisie"""
+    TherapeuticClass = apps.get_model('api', 'TherapeuticClass')
+    Medication = apps.get_model('api', 'Medication')
+    for code, name, match_terms, is_antibiotic, is_antimalarial in CLASSES:
+        therapeutic_class, _ = TherapeuticClass.objects.get_or_create(code=code, defaults={
+            'name': name, 'match_terms': match_terms,
+            'is_antibiotic': is_antibiotic, 'is_antimalarial': is_antimalarial,
+        })
+        terms = match_terms.split(',')
+        ids = [
+            medication_id
+            for medication_id, text in Medication.objects.filter(
+                classification__isnull=True
+            ).exclude(therapeutic_class='').values_list('id', 'therapeutic_class')
+            if any(term in _fold(text) for term in terms)
+        ]
+        Medication.objects.filter(id__in=ids).update(
+            classification=therapeutic_class, is_antibiotic=is_antibiotic, is_antimalarial=is_antimalarial
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_dispensation_fact_antibiotic_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TherapeuticClass',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=10, unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('match_terms', models.CharField(blank=True, max_length=255)),
+                ('is_antibiotic', models.BooleanField(default=False)),
+                ('is_antimalarial', models.BooleanField(default=False)),
+            ],
+            options={
+                'verbose_name': 'Classe thérapeutique',
+                'verbose_name_plural': 'Classes thérapeutiques',
+                'ordering': ['code'],
+            },
+        ),
+        migrations.AddField(
+            model_name='medication',
+            name='is_antibiotic',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='medication',
+            name='is_antimalarial',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='medication',
+            name='classification',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='medications', to='api.therapeuticclass'),
+        ),
+        migrations.RunPython(classify_existing, migrations.RunPython.noop),
+    ]
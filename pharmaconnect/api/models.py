@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from decimal import Decimal
 from datetime import datetime, timedelta
@@ -86,6 +86,7 @@ class HealthFacility(models.Model):
     )
     
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.name} ({self.code})"
@@ -171,6 +172,25 @@ class MedicationCategory(models.Model):
         return self.name
 
 
+class TherapeuticClass(models.Model):
+    """Classe thérapeutique de référence (codes de type ATC) et indicateurs suivis"""
+
+    class Meta:
+        verbose_name = "Classe thérapeutique"
+        verbose_name_plural = "Classes thérapeutiques"
+        ordering = ['code']
+
+    code = models.CharField(max_length=10, unique=True)  # Ex: J01 (code ATC)
+    name = models.CharField(max_length=100)
+    # Termes reconnus dans la classe saisie sur le médicament, sans accents, séparés par des virgules
+    match_terms = models.CharField(max_length=255, blank=True)  # Ex: antibio,antibacter
+    is_antibiotic = models.BooleanField(default=False)
+    is_antimalarial = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.code} - {self.name}"
+
+
 class Medication(models.Model):
     """Modèle pour les médicaments conforme au cahier des charges"""
     
@@ -178,6 +198,9 @@ class Medication(models.Model):
         verbose_name = "Médicament"
         verbose_name_plural = "Médicaments"
         unique_together = ['organization', 'code']  # Code unique par organisation
+        indexes = [
+            models.Index(fields=['organization', 'barcode_gs1'], name='medication_org_barcode_idx'),
+        ]
     
     # Champs principaux selon cahier des charges
     code = models.CharField(max_length=20)  # Ex: MA0103
@@ -194,6 +217,12 @@ class Medication(models.Model):
     # Classification
     category = models.ForeignKey(MedicationCategory, on_delete=models.CASCADE, related_name='medications')
     therapeutic_class = models.CharField(max_length=100, blank=True)  # Classe thérapeutique
+    # Classe de référence déduite de therapeutic_class (api.classification) et ses indicateurs
+    classification = models.ForeignKey(
+        TherapeuticClass, on_delete=models.SET_NULL, related_name='medications', null=True, blank=True
+    )
+    is_antibiotic = models.BooleanField(default=False, db_index=True)
+    is_antimalarial = models.BooleanField(default=False, db_index=True)
     pharmacotherapeutic = models.CharField(max_length=200, blank=True)  # Action pharmacothérapeutique
     
     # Posologie et administration
@@ -296,6 +325,12 @@ class StockEntry(models.Model):
     class Meta:
         verbose_name = "Entrée en stock"
         verbose_name_plural = "Entrées en stock"
+        indexes = [
+            # Résolution des scans GS1 (api.scans)
+            models.Index(fields=['medication', 'batch_number', 'expiry_date'], name='stockentry_med_batch_idx'),
+            # Pagination par curseur (api.pagination)
+            models.Index(fields=['organization', 'delivery_date', 'id'], name='stockentry_org_delivery_idx'),
+        ]
     organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
@@ -328,10 +363,60 @@ class StockEntry(models.Model):
         """Retourne True si le produit expire dans moins de 2 mois"""
         return self.expiry_risk_months < 2
 
+    def save(self, *args, **kwargs):
+        # Les soldes de stock (signaux api.ledger) sont mis à jour dans la même transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.medication.name} - {self.quantity_delivered} - {self.delivery_date}"
 
 
+class LotBalance(models.Model):
+    """Solde courant d'un lot (entrée en stock), maintenu par api.ledger"""
+
+    class Meta:
+        verbose_name = "Solde de lot"
+        verbose_name_plural = "Soldes de lots"
+        indexes = [
+            models.Index(fields=['project', 'medication', 'expiry_date'], name='lotbalance_proj_med_exp_idx'),
+            models.Index(fields=['organization', 'expiry_date'], name='lotbalance_org_exp_idx'),
+        ]
+
+    stock_entry = models.OneToOneField(StockEntry, on_delete=models.CASCADE, related_name='balance')
+    # Copies dénormalisées de l'entrée pour les agrégations sans jointure
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    expiry_date = models.DateField()
+    quantity_received = models.IntegerField(default=0)
+    quantity_dispensed = models.IntegerField(default=0)
+    quantity_adjusted = models.IntegerField(default=0)  # Écarts d'inventaire (physique - théorique)
+    quantity_available = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Lot {self.stock_entry_id} - {self.quantity_available}"
+
+
+class StockBalance(models.Model):
+    """Solde courant par organisation, projet et médicament, maintenu par api.ledger"""
+
+    class Meta:
+        verbose_name = "Solde de stock"
+        verbose_name_plural = "Soldes de stock"
+        unique_together = ['organization', 'project', 'medication']
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    quantity_available = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.medication_id} / {self.project_id} - {self.quantity_available}"
+
+
 class PrescriptionPhoto(models.Model):
     """Photos d'ordonnances"""
     
@@ -352,6 +437,10 @@ class Dispensation(models.Model):
     class Meta:
         verbose_name = "Dispensation"
         verbose_name_plural = "Dispensations"
+        indexes = [
+            # Pagination par curseur (api.pagination)
+            models.Index(fields=['organization', 'dispensation_date', 'id'], name='dispensation_org_date_idx'),
+        ]
     DESTINATION_CHOICES = [
         ('PATIENT', 'Patient'),
         ('SERVICE', 'Service hôpital'),
@@ -414,6 +503,11 @@ class DispensationItem(models.Model):
     quantity_dispensed = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     
+    def save(self, *args, **kwargs):
+        # Les soldes de stock (signaux api.ledger) sont mis à jour dans la même transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.medication.name} - {self.quantity_dispensed}"
 
@@ -464,6 +558,11 @@ class InventoryItem(models.Model):
             return (self.variance / self.physical_stock) * 100
         return 0
 
+    def save(self, *args, **kwargs):
+        # Les soldes de stock (signaux api.ledger) sont mis à jour dans la même transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.medication.name} - Inventaire {self.inventory.month}/{self.inventory.year}"
 
@@ -485,6 +584,10 @@ class ConsumptionData(models.Model):
 
     class Meta:
         unique_together = ['organization', 'project', 'medication', 'week_number', 'year']
+        indexes = [
+            # Pagination par curseur (api.pagination)
+            models.Index(fields=['organization', 'year', 'week_number', 'id'], name='consumption_org_week_idx'),
+        ]
 
     def __str__(self):
         return f"{self.medication.name} - S{self.week_number}/{self.year}"
@@ -548,3 +651,104 @@ class Alert(models.Model):
 
     def __str__(self):
         return f"{self.title} - {self.severity}"
+
+
+class AlertQueueEntry(models.Model):
+    """File des clés (organisation, projet, médicament) dont les alertes sont à réévaluer"""
+
+    class Meta:
+        verbose_name = "Clé d'alerte à réévaluer"
+        verbose_name_plural = "Clés d'alertes à réévaluer"
+        unique_together = ['organization', 'project', 'medication']
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.organization_id}/{self.project_id}/{self.medication_id}"
+
+
+class MedicationSearchTerm(models.Model):
+    """Index de recherche des médicaments : préfixes et trigrammes normalisés (api.search)"""
+
+    class Meta:
+        verbose_name = "Terme de recherche"
+        verbose_name_plural = "Termes de recherche"
+        unique_together = ['medication', 'term']
+        indexes = [
+            models.Index(fields=['organization', 'term', 'weight', 'medication'], name='medsearch_org_term_idx'),
+        ]
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, null=True, blank=True)
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=16)  # 'p:' + préfixe ou 't:' + trigramme
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.medication_id} {self.term}"
+
+
+class DataVersion(models.Model):
+    """Compteur de version d'un jeu de données, incrémenté à chaque modification (api.versions)"""
+
+    class Meta:
+        verbose_name = "Version de données"
+        verbose_name_plural = "Versions de données"
+
+    key = models.CharField(max_length=100, unique=True)  # Ex: catalog:12
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+
+
+class DashboardStatistic(models.Model):
+    """Compteur du tableau de bord de l'administration (api.dashboard_stats)"""
+
+    class Meta:
+        verbose_name = "Statistique du tableau de bord"
+        verbose_name_plural = "Statistiques du tableau de bord"
+
+    name = models.CharField(max_length=50, unique=True)  # Ex: dispensation_count
+    value = models.BigIntegerField(default=0)
+    refreshed_at = models.DateTimeField()  # Dernier recomptage complet
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class DispensationDailyFact(models.Model):
+    """Dispensations agrégées par jour et par dimension d'analyse (api.dispensation_facts)"""
+
+    class Meta:
+        verbose_name = "Fait de dispensation journalier"
+        verbose_name_plural = "Faits de dispensation journaliers"
+        indexes = [
+            models.Index(fields=['organization', 'day'], name='dispfact_org_day_idx'),
+            models.Index(fields=['health_facility', 'day'], name='dispfact_facility_day_idx'),
+            models.Index(fields=['project', 'day'], name='dispfact_project_day_idx'),
+        ]
+
+    # Dimensions
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    health_facility = models.ForeignKey(HealthFacility, on_delete=models.CASCADE)  # Formation du projet
+    day = models.DateField()
+    destination = models.CharField(max_length=20, choices=Dispensation.DESTINATION_CHOICES)
+    status = models.CharField(max_length=20, choices=Dispensation.STATUS_CHOICES)
+    age_band = models.CharField(max_length=10, blank=True)  # Ex: 0-4, vide si âge inconnu
+    patient_sex = models.CharField(max_length=10, blank=True)
+    is_antenatal = models.BooleanField(default=False)  # Service CPN
+    antibiotic_count = models.PositiveSmallIntegerField(default=0)  # Antibiotiques distincts, plafonné
+    has_antimalarial = models.BooleanField(default=False)
+
+    # Mesures
+    prescriptions = models.PositiveIntegerField(default=0)
+    items = models.PositiveIntegerField(default=0)
+    quantity_dispensed = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.project_id} {self.day} : {self.prescriptions} prescription(s)"
@@ -0,0 +1,86 @@
+"""
+Proposition de commande d'un projet basée sur la CMM.
+
+Pour chaque médicament inclus dans la liste standard du projet :
+stock maximum = CMM x (périodicité + délai de livraison + stock tampon) et
+quantité à commander = stock maximum - solde - quantités en cours de
+livraison. Le calcul tient en un nombre fixe de requêtes quel que soit le
+nombre de lignes.
+"""
+import math
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import F, Sum
+
+from .consumption import compute_cmm
+from .models import ConsumptionData, StandardList, StockBalance, StockEntry
+
+OrderLine = namedtuple('OrderLine', [
+    'medication_id', 'code', 'name', 'unit_price', 'cmm', 'max_stock',
+    'stock_on_hand', 'in_transit', 'quantity_to_order', 'value'
+])
+
+CSV_COLUMNS = [
+    ('code', 'Code'),
+    ('name', 'Désignation'),
+    ('cmm', 'CMM'),
+    ('max_stock', 'Stock maximum'),
+    ('stock_on_hand', 'Stock disponible'),
+    ('in_transit', 'En cours de livraison'),
+    ('quantity_to_order', 'Quantité à commander'),
+    ('unit_price', 'Prix unitaire'),
+    ('value', 'Valeur'),
+]
+
+# Fenêtre de calcul de la CMM acceptée par la proposition de commande (en mois)
+MAX_CMM_MONTHS = 24
+
+
+def coverage_months(project):
+    """Nombre de mois couverts par une commande (périodicité + délai + tampon)"""
+    return Decimal(project.order_frequency_months) + project.delivery_delay_months + project.buffer_stock_months
+
+
+def propose_order(project, months=3):
+    """Lignes de commande du projet, triées par code"""
+    standard_list = StandardList.objects.filter(project=project, is_included=True).values_list(
+        'medication_id', 'medication__code', 'medication__name',
+        'custom_code', 'custom_name', 'medication__unit_price'
+    )
+
+    balances = dict(
+        StockBalance.objects.filter(project=project)
+        .values('medication')
+        .annotate(total=Sum('quantity_available'))
+        .values_list('medication', 'total')
+    )
+
+    cmm = {}
+    results = compute_cmm(ConsumptionData.objects.filter(project=project), windows=(months,))
+    for (_, _, medication_id), result in results.items():
+        cmm[medication_id] = cmm.get(medication_id, 0) + result.cmm[months]
+
+    # Reliquats : quantités commandées non encore livrées
+    in_transit = dict(
+        StockEntry.objects.filter(project=project, quantity_ordered__gt=F('quantity_delivered'))
+        .values('medication')
+        .annotate(total=Sum(F('quantity_ordered') - F('quantity_delivered')))
+        .values_list('medication', 'total')
+    )
+
+    coverage = float(coverage_months(project))
+    lines = []
+    for medication_id, code, name, custom_code, custom_name, unit_price in standard_list:
+        monthly = cmm.get(medication_id, 0)
+        max_stock = math.ceil(monthly * coverage)
+        on_hand = balances.get(medication_id) or 0
+        pending = in_transit.get(medication_id) or 0
+        quantity = max(0, max_stock - on_hand - pending)
+        lines.append(OrderLine(
+            medication_id, custom_code or code, custom_name or name, unit_price,
+            round(monthly, 2), max_stock, on_hand, pending, quantity, unit_price * quantity
+        ))
+
+    lines.sort(key=lambda line: line.code)
+    return lines
@@ -0,0 +1,212 @@
+"""
+Pagination par curseur (keyset) des listes transactionnelles volumineuses.
+
+La page suivante est lue à partir des valeurs de tri du dernier élément
+(WHERE (date, id) < (d, i) ORDER BY date DESC, id DESC LIMIT n) au lieu d'un
+OFFSET : le coût d'une page ne dépend pas de sa profondeur, et aucun
+COUNT(*) n'est exécuté. Le tri est celui de la vue (paramètre ?ordering=
+compris), complété par l'id pour départager les égalités. Le total n'est
+calculé que sur demande (?with_count=true), plafonné à `count_limit`.
+
+Les clients existants qui passent ?page= restent servis par la pagination
+par numéro de page.
+"""
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def _encode_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """Pagination par curseur sur un tri composite départagé par l'id"""
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    count_query_param = 'with_count'
+    count_limit = 10000
+    legacy_pagination_class = PageNumberPagination
+    invalid_cursor_message = 'Curseur invalide'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.legacy = None
+        ordering = self.get_ordering(queryset)
+        if self.legacy_pagination_class.page_query_param in request.query_params or ordering is None:
+            self.legacy = self.legacy_pagination_class()
+            return self.legacy.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = ordering
+        values, reverse = self.decode_cursor(request, queryset.model)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('true', '1'):
+            self.count = queryset[:self.count_limit + 1].count()
+
+        # Page précédente : tri inversé, puis résultats remis dans l'ordre
+        fields = [(name, descending != reverse) for name, descending in ordering]
+        queryset = queryset.order_by(*(f"{'-' if descending else ''}{name}" for name, descending in fields))
+        if values is not None:
+            queryset = queryset.filter(self._after(fields, values))
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        has_next, has_previous = (values is not None, has_more) if reverse else (has_more, values is not None)
+        self.next_values = self._key(rows[-1]) if has_next and rows else None
+        self.previous_values = self._key(rows[0]) if has_previous and rows else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, queryset):
+        """
+        [(champ, décroissant)] du tri du queryset complété par l'id, ou None si
+        un champ ne se prête pas au curseur (relation, champ nullable)
+        """
+        ordering = []
+        for term in queryset.query.order_by or queryset.model._meta.ordering:
+            if not isinstance(term, str):
+                return None
+            name = term.lstrip('-')
+            if name in ('pk', 'id'):
+                continue
+            try:
+                field = queryset.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if field.null or field.is_relation:
+                return None
+            ordering.append((field.attname, term.startswith('-')))
+        ordering.append(('id', ordering[0][1] if ordering else True))
+        return ordering
+
+    def _after(self, fields, values):
+        """Éléments situés après `values` dans l'ordre `fields`"""
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(fields, values):
+            condition |= equal & Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+            equal &= Q(**{name: value})
+        # Borne sur le premier champ redondante : délimite le parcours d'index
+        name, descending = fields[0]
+        return Q(**{f"{name}__{'lte' if descending else 'gte'}": values[0]}) & condition
+
+    def _key(self, instance):
+        return [_encode_value(getattr(instance, name)) for name, _ in self.ordering]
+
+    def decode_cursor(self, request, model):
+        """
+        (valeurs, page précédente) du curseur, (None, False) sans curseur. Les
+        valeurs sont converties par les champs du tri : un curseur altéré
+        donne une 404 plutôt qu'une erreur de requête.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            values, reverse, ordering = cursor['v'], bool(cursor.get('r')), cursor['o']
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if ordering != self._ordering_signature() or not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            values = [model._meta.get_field(name).to_python(value) for (name, _), value in zip(self.ordering, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if None in values:
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def _ordering_signature(self):
+        return [f"{'-' if descending else ''}{name}" for name, descending in self.ordering]
+
+    def encode_cursor(self, values, reverse):
+        cursor = {'v': values, 'o': self._ordering_signature()}
+        if reverse:
+            cursor['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.legacy:
+            return self.legacy.get_next_link()
+        if self.next_values is None:
+            return None
+        return self.encode_cursor(self.next_values, reverse=False)
+
+    def get_previous_link(self):
+        if self.legacy:
+            return self.legacy.get_previous_link()
+        if self.previous_values is None:
+            return None
+        return self.encode_cursor(self.previous_values, reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.legacy:
+            return self.legacy.get_paginated_response(data)
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = min(self.count, self.count_limit)
+            response['count_is_exact'] = self.count <= self.count_limit
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'count_is_exact': {'type': 'boolean'},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param, 'required': False, 'in': 'query',
+                'description': 'Curseur de la page (liens next/previous)', 'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param, 'required': False, 'in': 'query',
+                'description': "Nombre d'éléments par page", 'schema': {'type': 'integer'},
+            },
+            {
+                'name': self.count_query_param, 'required': False, 'in': 'query',
+                'description': f'Inclure le total (plafonné à {self.count_limit})', 'schema': {'type': 'boolean'},
+            },
+        ]
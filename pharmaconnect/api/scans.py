@@ -0,0 +1,100 @@
+"""
+Résolution des codes GS1 scannés en médicament et lot.
+
+Le médicament est retrouvé par son GTIN dans le catalogue en mémoire de
+l'organisation (api.catalog), les lots par l'index (médicament, numéro de
+lot, péremption) de StockEntry, en une requête par tranche de 200 codes.
+"""
+from django.db.models import Q
+
+from .catalog import get_catalog
+from .gs1 import GS1Error, parse_scan
+from .serializers import MedicationSearchSerializer
+
+# Statuts de résolution
+LOT = 'LOT'                  # lot et péremption retrouvés
+BATCH = 'BATCH'              # numéro de lot retrouvé, péremption absente ou différente
+MEDICATION = 'MEDICATION'    # médicament seul
+UNKNOWN = 'UNKNOWN'          # GTIN inconnu de l'organisation
+INVALID = 'INVALID'          # code illisible
+
+PAIRS_PER_QUERY = 200  # borne la profondeur de l'expression SQL
+LOT_FIELDS = ('id', 'project', 'batch_number', 'expiry_date', 'balance__quantity_available')
+
+
+def _lot(row):
+    return {
+        'id': row['id'],
+        'project': row['project'],
+        'batch_number': row['batch_number'],
+        'expiry_date': row['expiry_date'],
+        'quantity_available': row['balance__quantity_available'] or 0,
+    }
+
+
+def resolve_scans(codes, organization_id, stock_entries):
+    """
+    Résultat de chaque code, dans l'ordre. `stock_entries` est le queryset
+    des lots visibles par l'utilisateur.
+    """
+    catalog = get_catalog(organization_id)
+
+    scans = []
+    for code in codes:
+        try:
+            scan = parse_scan(code)
+        except GS1Error as error:
+            scans.append((code, None, None, str(error)))
+            continue
+        medication_id = catalog.medication_id_for_gtin(scan.gtin) if scan.gtin else None
+        scans.append((code, scan, medication_id, None))
+
+    pairs = {
+        (medication_id, scan.batch_number)
+        for _, scan, medication_id, _ in scans
+        if medication_id and scan.batch_number
+    }
+    lots = {}
+    pairs = sorted(pairs)
+    for start in range(0, len(pairs), PAIRS_PER_QUERY):
+        # Une recherche d'index par couple (médicament, lot)
+        condition = Q()
+        for medication_id, batch_number in pairs[start:start + PAIRS_PER_QUERY]:
+            condition |= Q(medication_id=medication_id, batch_number=batch_number)
+        rows = stock_entries.filter(condition).order_by('expiry_date', 'id').values('medication', *LOT_FIELDS)
+        for row in rows:
+            lots.setdefault((row['medication'], row['batch_number']), []).append(row)
+
+    results = []
+    for code, scan, medication_id, error in scans:
+        result = {'code': code}
+        if scan is None:
+            results.append({**result, 'status': INVALID, 'error': error})
+            continue
+
+        result.update({
+            'gtin': scan.gtin,
+            'batch_number': scan.batch_number,
+            'expiry_date': scan.expiry_date,
+            'serial_number': scan.serial_number,
+        })
+        if medication_id is None:
+            error = "Aucun GTIN dans le code" if not scan.gtin else "GTIN inconnu dans le référentiel"
+            results.append({**result, 'status': UNKNOWN, 'error': error})
+            continue
+
+        candidates = lots.get((medication_id, scan.batch_number), [])
+        exact = [row for row in candidates if row['expiry_date'] == scan.expiry_date]
+        if exact:
+            status, matched = LOT, exact
+        elif candidates:
+            status, matched = BATCH, candidates
+        else:
+            status, matched = MEDICATION, []
+        results.append({
+            **result,
+            'status': status,
+            'medication': catalog.representation(medication_id, MedicationSearchSerializer.Meta.fields),
+            'lots': [_lot(row) for row in matched],
+        })
+    return results
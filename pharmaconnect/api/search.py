@@ -0,0 +1,162 @@
+"""
+Index de recherche des médicaments (autocomplétion de la dispensation).
+
+Les champs code, nom, désignation, dosage, classe thérapeutique et code-barres
+sont normalisés (minuscules, sans accents) puis découpés en mots. Chaque mot
+produit ses préfixes ('p:') et, pour le nom et la désignation, ses trigrammes
+('t:') dans MedicationSearchTerm, indexé par (organisation, terme). Une
+recherche lit uniquement les lignes des termes demandés :
+
+- correspondance par préfixe : chaque mot de la requête doit être le début
+  d'un mot du médicament, classement par poids du champ ;
+- correspondance approchée (fautes de frappe) par trigrammes, seulement si
+  aucun médicament ne correspond par préfixe.
+"""
+import math
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+
+from .models import Medication, MedicationSearchTerm
+
+MIN_PREFIX = 2
+MAX_PREFIX = 14  # GTIN-14 complet
+MIN_TRIGRAM_MATCH = 0.6  # part des trigrammes de la requête à retrouver
+
+# Poids des champs indexés ; un mot complet compte double
+FIELD_WEIGHTS = {
+    'code': 8,
+    'barcode_gs1': 8,
+    'name': 6,
+    'designation': 3,
+    'dosage': 2,
+    'therapeutic_class': 2,
+}
+TRIGRAM_FIELDS = ('name', 'designation')
+INDEXED_FIELDS = tuple(FIELD_WEIGHTS)
+
+
+def fold(text):
+    """Texte en minuscules sans accents"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', fold(text))
+
+
+def trigrams(token):
+    padded = f' {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def medication_terms(values):
+    """{terme: poids} d'un médicament à partir de ses champs indexés"""
+    terms = {}
+
+    def add(term, weight):
+        if weight > terms.get(term, 0):
+            terms[term] = weight
+
+    for field, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(values.get(field)):
+            token = token[:MAX_PREFIX]
+            for length in range(min(MIN_PREFIX, len(token)), len(token)):
+                add('p:' + token[:length], weight)
+            add('p:' + token, weight * 2)
+            if field in TRIGRAM_FIELDS:
+                for gram in trigrams(token):
+                    add('t:' + gram, 1)
+    return terms
+
+
+def _term_rows(organization_id, medication_id, values):
+    return [
+        MedicationSearchTerm(
+            organization_id=organization_id, medication_id=medication_id, term=term, weight=weight
+        )
+        for term, weight in medication_terms(values).items()
+    ]
+
+
+@transaction.atomic
+def index_medication(medication):
+    """Remplace les termes de recherche d'un médicament"""
+    MedicationSearchTerm.objects.filter(medication=medication).delete()
+    values = {field: getattr(medication, field) for field in INDEXED_FIELDS}
+    MedicationSearchTerm.objects.bulk_create(_term_rows(medication.organization_id, medication.pk, values))
+
+
+@transaction.atomic
+def rebuild_search_index(organization_id=None, batch_size=5000):
+    """Reconstruit l'index de recherche ; retourne le nombre de médicaments indexés"""
+    medications = Medication.objects.all()
+    terms = MedicationSearchTerm.objects.all()
+    if organization_id is not None:
+        medications = medications.filter(organization_id=organization_id)
+        terms = terms.filter(organization_id=organization_id)
+    terms.delete()
+
+    count = 0
+    rows = []
+    for values in medications.values('id', 'organization_id', *INDEXED_FIELDS).iterator():
+        rows.extend(_term_rows(values['organization_id'], values['id'], values))
+        count += 1
+        if len(rows) >= batch_size:
+            MedicationSearchTerm.objects.bulk_create(rows)
+            rows = []
+    MedicationSearchTerm.objects.bulk_create(rows)
+    return count
+
+
+def _query_words(query):
+    words = []
+    for token in tokenize(query):
+        token = token[:MAX_PREFIX]
+        if len(token) >= MIN_PREFIX and token not in words:
+            words.append(token)
+    return words
+
+
+def search_medication_ids(organization_id, query, medications=None, limit=20):
+    """
+    Identifiants des médicaments de l'organisation correspondant à la
+    requête, les plus pertinents d'abord. `medications` restreint
+    éventuellement la recherche (queryset de médicaments filtré).
+    """
+    words = _query_words(query)
+    if not words:
+        return []
+
+    terms = MedicationSearchTerm.objects.filter(organization_id=organization_id)
+    if medications is not None:
+        terms = terms.filter(medication__in=medications.values('id'))
+
+    # Parcours de l'index (organisation, terme, poids) du mot le plus long, les
+    # autres mots étant vérifiés par médicament : ni regroupement ni tri
+    main, *others = sorted(words, key=len, reverse=True)
+    ranked = terms.filter(term='p:' + main).order_by('-weight', '-medication')
+    for word in others:
+        ranked = ranked.filter(Exists(
+            MedicationSearchTerm.objects.filter(medication=OuterRef('medication'), term='p:' + word)
+        ))
+    ids = list(ranked.values_list('medication', flat=True)[:limit])
+    if ids:
+        return ids
+
+    # Les nombres (dosages, codes-barres) ne sont recherchés que par préfixe
+    grams = {'t:' + gram for word in words if len(word) >= 3 and not word.isdigit() for gram in trigrams(word)}
+    if not grams:
+        return ids
+    fuzzy = (
+        terms.filter(term__in=grams)
+        .values('medication')
+        .annotate(matched=Count('term'))
+        .filter(matched__gte=max(2, math.ceil(len(grams) * MIN_TRIGRAM_MATCH)))
+        .order_by('-matched', '-medication')
+        .values_list('medication', flat=True)[:limit]
+    )
+    return list(fuzzy)
@@ -1,28 +1,31 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
+from drf_spectacular.utils import extend_schema_field
 from .models import (
     User, Organization, Donor, HealthFacility, HealthFacilityDistributor, Project, MedicationCategory,
     Medication, StandardList, MedicationSubstitution, StockEntry,
     PrescriptionPhoto, Dispensation, DispensationItem, Inventory,
     InventoryItem, ConsumptionData, StockoutPeriod, Alert
 )
+from .catalog import get_catalog
+from .fieldsets import SparseFieldsMixin, requested_subfields
 
 
-class OrganizationSerializer(serializers.ModelSerializer):
+class OrganizationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Organization
         fields = '__all__'
         read_only_fields = ['created_at', 'updated_at']
 
 
-class DonorSerializer(serializers.ModelSerializer):
+class DonorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Donor
         fields = '__all__'
         read_only_fields = ['created_at']
 
 
-class HealthFacilitySerializer(serializers.ModelSerializer):
+class HealthFacilitySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     distributors_count = serializers.SerializerMethodField()
     
     class Meta:
@@ -32,10 +35,14 @@ class HealthFacilitySerializer(serializers.ModelSerializer):
     
     def get_distributors_count(self, obj):
         """Retourne le nombre de distributeurs actifs pour cette formation sanitaire"""
-        return obj.distributors.filter(is_active=True).count()
+        # Annoté par HealthFacilityViewSet ; requête individuelle seulement à défaut
+        count = getattr(obj, 'active_distributors_count', None)
+        if count is None:
+            count = obj.distributors.filter(is_active=True).count()
+        return count
 
 
-class HealthFacilityDistributorSerializer(serializers.ModelSerializer):
+class HealthFacilityDistributorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user_full_name = serializers.CharField(source='user.get_full_name', read_only=True)
     user_email = serializers.CharField(source='user.email', read_only=True)
     health_facility_name = serializers.CharField(source='health_facility.name', read_only=True)
@@ -47,7 +54,7 @@ class HealthFacilityDistributorSerializer(serializers.ModelSerializer):
         read_only_fields = ['assigned_date', 'assigned_by']
 
 
-class ProjectSerializer(serializers.ModelSerializer):
+class ProjectSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     donor_name = serializers.CharField(source='donor.name', read_only=True)
     health_facility_name = serializers.CharField(source='health_facility.name', read_only=True)
@@ -58,7 +65,7 @@ class ProjectSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at']
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     health_facility_name = serializers.CharField(source='health_facility.name', read_only=True)
 
@@ -113,7 +120,7 @@ class LoginSerializer(serializers.Serializer):
             raise serializers.ValidationError('Nom d\'utilisateur et mot de passe requis')
 
 
-class MedicationCategorySerializer(serializers.ModelSerializer):
+class MedicationCategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     medications_count = serializers.SerializerMethodField()
 
     class Meta:
@@ -122,10 +129,14 @@ class MedicationCategorySerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at']
 
     def get_medications_count(self, obj):
-        return obj.medications.count()
+        # Annoté par MedicationCategoryViewSet ; requête individuelle seulement à défaut
+        count = getattr(obj, 'medications_total', None)
+        if count is None:
+            count = obj.medications.count()
+        return count
 
 
-class MedicationSerializer(serializers.ModelSerializer):
+class MedicationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     allowed_facilities_names = serializers.StringRelatedField(
         source='allowed_facilities', many=True, read_only=True
@@ -134,10 +145,54 @@ class MedicationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Medication
         fields = '__all__'
-        read_only_fields = ['created_at', 'updated_at']
-
-
-class MedicationSearchSerializer(serializers.ModelSerializer):
+        expandable_fields = ['allowed_facilities_names']
+        # Classification déduite de therapeutic_class (api.classification)
+        read_only_fields = ['created_at', 'updated_at', 'classification', 'is_antibiotic', 'is_antimalarial']
+
+
+@extend_schema_field(MedicationSerializer)
+class CatalogMedicationField(serializers.Field):
+    """
+    Détails du médicament lus dans le catalogue en mémoire de l'organisation
+    (api.catalog) ; lecture en base seulement si le médicament en est absent
+    """
+
+    side_load = 'medications'  # ?include=medications (api.fieldsets)
+
+    def __init__(self, organization='organization_id', **kwargs):
+        self.organization_path = organization.split('.')
+        self.source_columns = ['medication_id', organization]  # api.fieldsets
+        self._catalogs = {}  # un instantané par organisation et par réponse
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self._subfields = None
+
+    def to_representation(self, obj):
+        if self._subfields is None:
+            # ?fields=medication_details.code,... (api.fieldsets)
+            self._subfields = requested_subfields(self) or ()
+
+        organization_id = obj
+        for attribute in self.organization_path:
+            organization_id = getattr(organization_id, attribute)
+
+        if organization_id is not None:
+            catalog = self._catalogs.get(organization_id)
+            if catalog is None:
+                catalog = self._catalogs[organization_id] = get_catalog(organization_id)
+            fields = [field for field in catalog.fields if field in self._subfields] or None
+            data = catalog.representation(obj.medication_id, fields)
+            if data is not None:
+                return data
+        data = MedicationSerializer(obj.medication, context=self.context).data
+        if self._subfields:
+            data = {field: value for field, value in data.items() if field in self._subfields}
+        return data
+
+
+class MedicationSearchSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """Serializer optimisé pour la recherche"""
     category_name = serializers.CharField(source='category.name', read_only=True)
 
@@ -147,18 +202,19 @@ class MedicationSearchSerializer(serializers.ModelSerializer):
                  'unit_price', 'category_name', 'therapeutic_class']
 
 
-class StandardListSerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class StandardListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField()
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
 
     class Meta:
         model = StandardList
         fields = '__all__'
+        expandable_fields = ['medication_details']
         read_only_fields = ['created_at', 'updated_at']
 
 
-class MedicationSubstitutionSerializer(serializers.ModelSerializer):
+class MedicationSubstitutionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     original_medication_name = serializers.CharField(source='original_medication.name', read_only=True)
     substitute_medication_name = serializers.CharField(source='substitute_medication.name', read_only=True)
     organization_name = serializers.CharField(source='organization.name', read_only=True)
@@ -169,24 +225,31 @@ class MedicationSubstitutionSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at']
 
 
-class StockEntrySerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class StockEntrySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField()
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
     reception_percentage = serializers.ReadOnlyField()
+    quantity_available = serializers.IntegerField(source='balance.quantity_available', read_only=True)
     expiry_risk_months = serializers.ReadOnlyField()
     is_expiry_risk = serializers.ReadOnlyField()
 
     class Meta:
         model = StockEntry
         fields = '__all__'
+        source_columns = {
+            'reception_percentage': ['quantity_ordered', 'quantity_delivered'],
+            'expiry_risk_months': ['expiry_date'],
+            'is_expiry_risk': ['expiry_date'],
+        }
+        expandable_fields = ['medication_details']
         read_only_fields = ['created_at']
         extra_kwargs = {
             'organization': {'required': False}  # Le backend l'assignera automatiquement
         }
 
 
-class PrescriptionPhotoSerializer(serializers.ModelSerializer):
+class PrescriptionPhotoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = PrescriptionPhoto
         fields = '__all__'
@@ -197,15 +260,16 @@ class PrescriptionPhotoSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class DispensationItemSerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class DispensationItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField(organization='dispensation.organization_id')
 
     class Meta:
         model = DispensationItem
         fields = '__all__'
+        expandable_fields = ['medication_details']
 
 
-class DispensationSerializer(serializers.ModelSerializer):
+class DispensationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = DispensationItemSerializer(many=True, read_only=True)
     prescription_photo_url = serializers.CharField(source='prescription_photo.photo.url', read_only=True)
     organization_name = serializers.CharField(source='organization.name', read_only=True)
@@ -215,6 +279,7 @@ class DispensationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Dispensation
         fields = '__all__'
+        expandable_fields = ['items']
         read_only_fields = ['dispensation_date', 'created_by']
 
     def create(self, validated_data):
@@ -222,17 +287,66 @@ class DispensationSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class InventoryItemSerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class AllocationLineSerializer(serializers.Serializer):
+    """Ligne de prescription à allouer aux lots"""
+    medication = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class DispensationAllocationSerializer(serializers.Serializer):
+    """Prescription à allouer aux lots en FEFO (api.dispensing)"""
+    items = AllocationLineSerializer(many=True, allow_empty=False)
+    allow_partial = serializers.BooleanField(default=False)
+
+    def validate_items(self, items):
+        medication_ids = {item['medication'] for item in items}
+        known = set(Medication.objects.filter(
+            id__in=medication_ids, organization=self.context['organization']
+        ).values_list('id', flat=True))
+        unknown = medication_ids - known
+        if unknown:
+            raise serializers.ValidationError(f"Médicaments inconnus : {sorted(unknown)}")
+        return items
+
+
+class BulkDispensationItemSerializer(AllocationLineSerializer):
+    """Article d'une dispensation : lot imposé, ou alloué en FEFO si absent"""
+    stock_entry = serializers.IntegerField(required=False, allow_null=True)
+    unit_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+
+
+class BulkDispensationSerializer(serializers.ModelSerializer):
+    """
+    Dispensation complète pour l'enregistrement groupé (api.dispensing) ;
+    les références sont des identifiants vérifiés ensemble pour tout le lot
+    """
+    prescription_photo = serializers.IntegerField()
+    organization = serializers.IntegerField()
+    project = serializers.IntegerField()
+    items = BulkDispensationItemSerializer(many=True, allow_empty=False)
+    allow_partial = serializers.BooleanField(default=False)
+
+    class Meta:
+        model = Dispensation
+        exclude = ['status', 'created_by']
+
+
+class InventoryItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField(organization='inventory.organization_id')
     variance = serializers.ReadOnlyField()
     variance_percentage = serializers.ReadOnlyField()
 
     class Meta:
         model = InventoryItem
         fields = '__all__'
+        source_columns = {
+            'variance': ['theoretical_stock', 'physical_stock'],
+            'variance_percentage': ['theoretical_stock', 'physical_stock'],
+        }
+        expandable_fields = ['medication_details']
 
 
-class InventorySerializer(serializers.ModelSerializer):
+class InventorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = InventoryItemSerializer(many=True, read_only=True)
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
@@ -241,6 +355,7 @@ class InventorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Inventory
         fields = '__all__'
+        expandable_fields = ['items']
         read_only_fields = ['created_at', 'created_by']
 
     def create(self, validated_data):
@@ -248,28 +363,30 @@ class InventorySerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class ConsumptionDataSerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class ConsumptionDataSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField()
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
 
     class Meta:
         model = ConsumptionData
         fields = '__all__'
+        expandable_fields = ['medication_details']
         read_only_fields = ['created_at']
 
 
-class StockoutPeriodSerializer(serializers.ModelSerializer):
-    medication_details = MedicationSerializer(source='medication', read_only=True)
+class StockoutPeriodSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    medication_details = CatalogMedicationField()
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
 
     class Meta:
         model = StockoutPeriod
         fields = '__all__'
+        expandable_fields = ['medication_details']
 
 
-class AlertSerializer(serializers.ModelSerializer):
+class AlertSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     project_name = serializers.CharField(source='project.name', read_only=True)
     medication_name = serializers.CharField(source='medication.name', read_only=True)
@@ -309,12 +426,29 @@ class ReceptionReportSerializer(serializers.Serializer):
     items = StockEntrySerializer(many=True)
 
 
+class AntibioticCountSerializer(serializers.Serializer):
+    """Prescriptions par nombre d'antibiotiques distincts"""
+    antibiotic_count = serializers.IntegerField()
+    total_prescriptions = serializers.IntegerField()
+
+
+class WeeklyAntibioticSerializer(serializers.Serializer):
+    """Indicateurs antibiotiques d'une semaine (lundi)"""
+    week = serializers.DateField()
+    total_prescriptions = serializers.IntegerField()
+    antibiotic_prescriptions = serializers.IntegerField()
+    multitherapy_prescriptions = serializers.IntegerField()
+
+
 class PharmacoepidemioAnalysisSerializer(serializers.Serializer):
     """Serializer pour les analyses pharmacoépidémiologiques"""
     total_prescriptions = serializers.IntegerField()
     antibiotic_prescriptions = serializers.IntegerField()
     antibiotic_percentage = serializers.DecimalField(max_digits=5, decimal_places=2)
     multitherapy_prescriptions = serializers.IntegerField()
+    multitherapy_percentage = serializers.DecimalField(max_digits=5, decimal_places=2)
+    antibiotics_per_prescription = AntibioticCountSerializer(many=True)
+    weekly_antibiotics = WeeklyAntibioticSerializer(many=True)
     malaria_prescriptions = serializers.IntegerField()
     malaria_percentage = serializers.DecimalField(max_digits=5, decimal_places=2)
     pregnant_women_prescriptions = serializers.IntegerField()
@@ -0,0 +1,399 @@
+"""
+Signaux de l'application : maintien des soldes de stock (api.ledger),
+file des clés d'alertes à réévaluer (api.alerts), index spatial des
+formations sanitaires (api.spatial), index de recherche des médicaments
+(api.search), classification thérapeutique (api.classification), version
+du catalogue en mémoire (api.catalog), faits de dispensation journaliers
+(api.dispensation_facts), versions des analyses en cache
+(api.analytics_cache) et statistiques du tableau de bord de
+l'administration (api.dashboard_stats)
+"""
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import classification, dashboard_stats, dispensation_facts, ledger, search, spatial
+from .alerts import enqueue_alert_keys
+from .analytics_cache import touch, STOCK, DISPENSATIONS, ALERTS
+from .catalog import invalidate_catalog
+from .models import (
+    StockEntry, DispensationItem, InventoryItem, ConsumptionData, HealthFacility, Medication,
+    MedicationCategory, Project, Dispensation, StockoutPeriod, Alert, Organization, Inventory, User,
+    DispensationDailyFact, TherapeuticClass
+)
+
+
+def _previous_values(instance, *fields):
+    """Valeurs en base avant modification (None pour une création)"""
+    if instance.pk is None:
+        return None
+    return type(instance).objects.filter(pk=instance.pk).values(*fields).first()
+
+
+def _adjustment(values):
+    return values['physical_stock'] - values['theoretical_stock']
+
+
+def _enqueue_alerts(organization_id, project_id, medication_id, deleted=False):
+    """Met la clé en file de réévaluation des alertes"""
+    keys = [(organization_id, project_id, medication_id)]
+    if deleted:
+        # Après validation : la suppression peut être une cascade du projet ou du médicament
+        transaction.on_commit(lambda: enqueue_alert_keys(keys, existing_only=True))
+    else:
+        enqueue_alert_keys(keys)
+
+
+# Réceptions
+
+@receiver(pre_save, sender=StockEntry)
+def stock_entry_pre_save(sender, instance, **kwargs):
+    instance._ledger_previous = _previous_values(instance, 'quantity_delivered')
+
+
+@receiver(post_save, sender=StockEntry)
+def stock_entry_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        ledger.record_reception(instance)
+    else:
+        ledger.update_reception(instance, getattr(instance, '_ledger_previous', None))
+    _enqueue_alerts(instance.organization_id, instance.project_id, instance.medication_id)
+
+
+@receiver(pre_delete, sender=StockEntry)
+def stock_entry_pre_delete(sender, instance, **kwargs):
+    ledger.remove_reception(instance)
+    _enqueue_alerts(instance.organization_id, instance.project_id, instance.medication_id, deleted=True)
+
+
+# Dispensations
+
+@receiver(pre_save, sender=DispensationItem)
+def dispensation_item_pre_save(sender, instance, **kwargs):
+    instance._ledger_previous = _previous_values(instance, 'stock_entry_id', 'quantity_dispensed')
+
+
+@receiver(post_save, sender=DispensationItem)
+def dispensation_item_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else getattr(instance, '_ledger_previous', None)
+    if previous:
+        ledger.record_dispensed(previous['stock_entry_id'], -previous['quantity_dispensed'])
+    ledger.record_dispensed(instance.stock_entry_id, instance.quantity_dispensed)
+    dispensation = instance.dispensation
+    _enqueue_alerts(dispensation.organization_id, dispensation.project_id, instance.medication_id)
+
+
+@receiver(pre_delete, sender=DispensationItem)
+def dispensation_item_pre_delete(sender, instance, **kwargs):
+    dispensation = instance.dispensation
+    _enqueue_alerts(dispensation.organization_id, dispensation.project_id, instance.medication_id, deleted=True)
+
+
+@receiver(post_delete, sender=DispensationItem)
+def dispensation_item_post_delete(sender, instance, **kwargs):
+    ledger.record_dispensed(instance.stock_entry_id, -instance.quantity_dispensed)
+
+
+# Inventaires
+
+@receiver(pre_save, sender=InventoryItem)
+def inventory_item_pre_save(sender, instance, **kwargs):
+    instance._ledger_previous = _previous_values(
+        instance, 'stock_entry_id', 'theoretical_stock', 'physical_stock'
+    )
+
+
+@receiver(post_save, sender=InventoryItem)
+def inventory_item_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else getattr(instance, '_ledger_previous', None)
+    if previous:
+        ledger.record_adjustment(previous['stock_entry_id'], -_adjustment(previous))
+    ledger.record_adjustment(instance.stock_entry_id, -instance.variance)
+    inventory = instance.inventory
+    _enqueue_alerts(inventory.organization_id, inventory.project_id, instance.medication_id)
+
+
+@receiver(pre_delete, sender=InventoryItem)
+def inventory_item_pre_delete(sender, instance, **kwargs):
+    inventory = instance.inventory
+    _enqueue_alerts(inventory.organization_id, inventory.project_id, instance.medication_id, deleted=True)
+
+
+@receiver(post_delete, sender=InventoryItem)
+def inventory_item_post_delete(sender, instance, **kwargs):
+    ledger.record_adjustment(instance.stock_entry_id, instance.variance)
+
+
+# Consommations
+
+@receiver(post_save, sender=ConsumptionData)
+def consumption_data_post_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _enqueue_alerts(instance.organization_id, instance.project_id, instance.medication_id)
+
+
+@receiver(post_delete, sender=ConsumptionData)
+def consumption_data_post_delete(sender, instance, **kwargs):
+    _enqueue_alerts(instance.organization_id, instance.project_id, instance.medication_id, deleted=True)
+
+
+# Index spatial : mis à jour après validation, la signature évite une reconstruction
+
+def _refresh_facility_index(update):
+    def apply():
+        if spatial.facility_index.signature is not None:
+            update()
+            spatial.refresh_signature()
+    transaction.on_commit(apply)
+
+
+@receiver(post_save, sender=HealthFacility)
+def health_facility_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _refresh_facility_index(lambda: spatial.facility_index.update(instance))
+
+
+@receiver(post_delete, sender=HealthFacility)
+def health_facility_post_delete(sender, instance, **kwargs):
+    facility_id = instance.pk
+    _refresh_facility_index(lambda: spatial.facility_index.remove(facility_id))
+
+
+# Index de recherche des médicaments
+
+@receiver(post_save, sender=Medication)
+def medication_post_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not set(update_fields) & {'organization', *search.INDEXED_FIELDS}:
+        return
+    search.index_medication(instance)
+
+
+# Catalogue des médicaments en mémoire
+
+def _invalidate_catalogs(medications):
+    """Invalide le catalogue des organisations des médicaments donnés"""
+    for organization_id in set(medications.values_list('organization', flat=True)):
+        invalidate_catalog(organization_id)
+
+
+@receiver(pre_save, sender=Medication)
+def medication_pre_save(sender, instance, **kwargs):
+    instance._catalog_previous = _previous_values(instance, 'organization', 'is_antibiotic', 'is_antimalarial')
+
+
+# Classification thérapeutique : classe de référence et indicateurs du médicament
+
+@receiver(pre_save, sender=Medication)
+def medication_classification_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        classification.classify(instance)
+
+
+@receiver(post_save, sender=TherapeuticClass)
+@receiver(post_delete, sender=TherapeuticClass)
+def therapeutic_class_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        classification.classify_medications()
+
+
+@receiver(post_save, sender=Medication)
+def medication_catalog_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_catalog(instance.organization_id)
+    previous = getattr(instance, '_catalog_previous', None)
+    if previous and previous['organization'] != instance.organization_id:
+        invalidate_catalog(previous['organization'])
+
+
+@receiver(post_delete, sender=Medication)
+def medication_post_delete(sender, instance, **kwargs):
+    invalidate_catalog(instance.organization_id)
+
+
+@receiver(m2m_changed, sender=Medication.allowed_facilities.through)
+def medication_facilities_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_catalog(instance.organization_id)
+    elif action == 'pre_clear':
+        _invalidate_catalogs(Medication.objects.filter(allowed_facilities=instance))
+    else:
+        _invalidate_catalogs(Medication.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=MedicationCategory)
+def medication_category_post_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _invalidate_catalogs(Medication.objects.filter(category=instance))
+
+
+@receiver(post_save, sender=HealthFacility)
+def health_facility_catalog_post_save(sender, instance, raw=False, **kwargs):
+    # Les noms des formations autorisées figurent dans le catalogue
+    if not raw:
+        _invalidate_catalogs(Medication.objects.filter(allowed_facilities=instance))
+
+
+@receiver(pre_delete, sender=HealthFacility)
+def health_facility_pre_delete(sender, instance, **kwargs):
+    _invalidate_catalogs(Medication.objects.filter(allowed_facilities=instance))
+
+
+# Faits de dispensation journaliers : jours recalculés après validation
+# (avant les versions des analyses en cache, qui les lisent)
+
+@receiver(pre_save, sender=Dispensation)
+def dispensation_facts_pre_save(sender, instance, **kwargs):
+    instance._facts_previous = _previous_values(instance, 'organization', 'project', 'dispensation_date')
+
+
+@receiver(post_save, sender=Dispensation)
+def dispensation_facts_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    keys = {dispensation_facts.day_key(instance)}
+    previous = getattr(instance, '_facts_previous', None)
+    if previous:
+        keys.add(dispensation_facts.day_key(Dispensation(
+            organization_id=previous['organization'], project_id=previous['project'],
+            dispensation_date=previous['dispensation_date']
+        )))
+    dispensation_facts.mark_days(keys)
+
+
+@receiver(post_delete, sender=Dispensation)
+def dispensation_facts_post_delete(sender, instance, **kwargs):
+    dispensation_facts.mark_days([dispensation_facts.day_key(instance)])
+
+
+@receiver(post_save, sender=DispensationItem)
+@receiver(post_delete, sender=DispensationItem)
+def dispensation_item_facts_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        dispensation_facts.mark_days([dispensation_facts.day_key(instance.dispensation)])
+
+
+@receiver(post_save, sender=Medication)
+def medication_facts_post_save(sender, instance, created, raw=False, **kwargs):
+    previous = getattr(instance, '_catalog_previous', None)
+    if raw or created or not previous:
+        return
+    if (previous['is_antibiotic'], previous['is_antimalarial']) != (instance.is_antibiotic, instance.is_antimalarial):
+        # Indicateurs de classe modifiés : jours des dispensations du médicament
+        dispensation_facts.mark_medication_days([instance.pk])
+
+
+@receiver(post_save, sender=Project)
+def project_facts_post_save(sender, instance, created, raw=False, **kwargs):
+    if not raw and not created:
+        DispensationDailyFact.objects.filter(project=instance).exclude(
+            health_facility=instance.health_facility_id
+        ).update(health_facility=instance.health_facility_id)
+
+
+# Versions des analyses en cache : domaines touchés par modèle
+
+ANALYTICS_DOMAINS = {
+    StockEntry: (STOCK,),
+    DispensationItem: (STOCK, DISPENSATIONS),
+    InventoryItem: (STOCK,),
+    ConsumptionData: (STOCK,),
+    StockoutPeriod: (STOCK,),
+    Project: (STOCK, DISPENSATIONS, ALERTS),  # formation du projet : périmètre des analyses
+    Dispensation: (DISPENSATIONS,),
+    Medication: (DISPENSATIONS, ALERTS),  # classe thérapeutique, nom dans les alertes
+    Alert: (ALERTS,),
+    Organization: (ALERTS,),
+}
+ANALYTICS_PARENTS = {
+    DispensationItem: 'dispensation',
+    InventoryItem: 'inventory',
+}
+
+
+def analytics_data_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    parent = ANALYTICS_PARENTS.get(sender)
+    owner = getattr(instance, parent) if parent else instance
+    organization_id = owner.pk if sender is Organization else owner.organization_id
+    for domain in ANALYTICS_DOMAINS[sender]:
+        touch(domain, [organization_id])
+
+
+for model in ANALYTICS_DOMAINS:
+    post_save.connect(analytics_data_changed, sender=model, dispatch_uid=f'analytics_save_{model.__name__}')
+    post_delete.connect(analytics_data_changed, sender=model, dispatch_uid=f'analytics_delete_{model.__name__}')
+
+
+# Statistiques du tableau de bord de l'administration
+
+COUNTED_MODELS = {
+    Organization: 'organization_count',
+    HealthFacility: 'health_facility_count',
+    Dispensation: 'dispensation_count',
+}
+ACTIVE_COUNTED_MODELS = {
+    Medication: 'medication_count',
+    User: 'active_user_count',
+    Alert: 'active_alert_count',
+}
+RECOUNTED_MODELS = {
+    Project: 'active_project_count',
+    Inventory: 'inventory_count',
+}
+
+
+def statistics_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        dashboard_stats.adjust(COUNTED_MODELS[sender], 1)
+
+
+def statistics_deleted(sender, instance, **kwargs):
+    if sender is Dispensation and instance.dispensation_date < dashboard_stats.window_start():
+        return  # Déjà hors de la fenêtre
+    dashboard_stats.adjust(COUNTED_MODELS[sender], -1)
+
+
+def statistics_active_pre_save(sender, instance, **kwargs):
+    previous = _previous_values(instance, 'is_active')
+    instance._statistics_was_active = bool(previous and previous['is_active'])
+
+
+def statistics_active_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        was_active = getattr(instance, '_statistics_was_active', False)
+        dashboard_stats.adjust(ACTIVE_COUNTED_MODELS[sender], int(instance.is_active) - int(was_active))
+
+
+def statistics_active_deleted(sender, instance, **kwargs):
+    if instance.is_active:
+        dashboard_stats.adjust(ACTIVE_COUNTED_MODELS[sender], -1)
+
+
+def statistics_recount(sender, instance, raw=False, **kwargs):
+    if not raw:
+        dashboard_stats.recount(RECOUNTED_MODELS[sender])
+
+
+for model in COUNTED_MODELS:
+    post_save.connect(statistics_created, sender=model, dispatch_uid=f'statistics_save_{model.__name__}')
+    post_delete.connect(statistics_deleted, sender=model, dispatch_uid=f'statistics_delete_{model.__name__}')
+for model in ACTIVE_COUNTED_MODELS:
+    pre_save.connect(statistics_active_pre_save, sender=model, dispatch_uid=f'statistics_pre_save_{model.__name__}')
+    post_save.connect(statistics_active_saved, sender=model, dispatch_uid=f'statistics_save_{model.__name__}')
+    post_delete.connect(statistics_active_deleted, sender=model, dispatch_uid=f'statistics_delete_{model.__name__}')
+for model in RECOUNTED_MODELS:
+    post_save.connect(statistics_recount, sender=model, dispatch_uid=f'statistics_save_{model.__name__}')
+    post_delete.connect(statistics_recount, sender=model, dispatch_uid=f'statistics_delete_{model.__name__}')
@@ -0,0 +1,246 @@
+"""
+Index spatial en mémoire des formations sanitaires.
+
+Grille régulière (en degrés) construite depuis les coordonnées stockées et
+les emprises des zones de couverture (polygone GeoJSON ou rayon). Aucune
+extension spatiale n'est requise : fonctionne sur SQLite comme sur
+PostgreSQL sans PostGIS.
+
+Chaque processus tient son propre index, mis à jour incrémentalement par
+les signaux de HealthFacility. Avant chaque recherche, une signature
+(nombre de lignes, dernière modification) est comparée à celle de l'index
+pour reconstruire celui-ci si un autre processus a modifié les données.
+"""
+import math
+import threading
+from collections import defaultdict
+
+from django.db.models import Count, Max
+
+from .models import HealthFacility
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+CELL_DEGREES = 0.25
+
+FACILITY_FIELDS = ('id', 'latitude', 'longitude', 'coverage_radius_km', 'coverage_polygon')
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Distance orthodromique en kilomètres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _degree_span(lat, radius_km):
+    """Demi-emprise (latitude, longitude) en degrés d'un cercle de rayon `radius_km`"""
+    lat_span = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    lon_span = 180.0 if cos_lat < 1e-6 else min(180.0, radius_km / (KM_PER_DEGREE * cos_lat))
+    return lat_span, lon_span
+
+
+def parse_polygons(geometry):
+    """
+    Polygones d'une géométrie GeoJSON (Polygon, MultiPolygon, Feature) ou
+    d'une liste brute de coordonnées [lon, lat], sous forme de listes
+    d'anneaux (le premier extérieur, les suivants des trous). Les polygones
+    invalides (coordonnées non numériques ou non finies, anneau extérieur de
+    moins de trois points) sont ignorés, les trous invalides écartés.
+    """
+    if not geometry:
+        return []
+    if isinstance(geometry, dict):
+        if geometry.get('type') == 'Feature':
+            return parse_polygons(geometry.get('geometry'))
+        if geometry.get('type') == 'FeatureCollection':
+            features = geometry.get('features')
+            return [
+                polygon for feature in (features if isinstance(features, list) else [])
+                for polygon in parse_polygons(feature)
+            ]
+        coordinates = geometry.get('coordinates') or []
+        if geometry.get('type') == 'MultiPolygon':
+            polygons = coordinates if isinstance(coordinates, list) else []
+        elif geometry.get('type') == 'Polygon':
+            polygons = [coordinates]
+        else:
+            return []
+    else:
+        # Liste brute : un anneau [[lon, lat], ...] ou un polygone [[[lon, lat], ...], ...]
+        try:
+            polygons = [[geometry]] if isinstance(geometry[0][0], (int, float)) else [geometry]
+        except (IndexError, TypeError, KeyError):
+            return []
+    return [rings for rings in map(_rings, polygons) if rings]
+
+
+def _rings(polygon):
+    """Anneaux [(lon, lat), ...] d'un polygone, None s'il est invalide"""
+    try:
+        outer, *holes = [[(float(point[0]), float(point[1])) for point in ring] for ring in polygon]
+    except (IndexError, TypeError, KeyError, ValueError):
+        return None
+    if not _valid_ring(outer):
+        return None
+    return [outer] + [hole for hole in holes if _valid_ring(hole)]
+
+
+def _valid_ring(ring):
+    return len(ring) >= 3 and all(math.isfinite(lon) and math.isfinite(lat) for lon, lat in ring)
+
+
+def _in_ring(lon, lat, ring):
+    """Test du point dans l'anneau par lancer de rayon"""
+    inside = False
+    j = len(ring) - 1
+    for i, (xi, yi) in enumerate(ring):
+        xj, yj = ring[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _in_polygons(lon, lat, polygons):
+    for outer, *holes in polygons:
+        if _in_ring(lon, lat, outer) and not any(_in_ring(lon, lat, hole) for hole in holes):
+            return True
+    return False
+
+
+class FacilityIndex:
+    """Grille des positions et des zones de couverture des formations sanitaires"""
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.signature = None
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._points = {}
+        self._coverages = {}
+        self._point_cells = defaultdict(set)
+        self._coverage_cells = defaultdict(set)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def _cells(self, lat_min, lon_min, lat_max, lon_max):
+        row_min, col_min = self._cell(lat_min, lon_min)
+        row_max, col_max = self._cell(lat_max, lon_max)
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                yield row, col
+
+    # Construction et mise à jour
+
+    def build(self, rows, signature=None):
+        """Reconstruit l'index depuis des lignes (id, latitude, longitude, rayon, polygone)"""
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(*row)
+            self.signature = signature
+
+    def update(self, facility):
+        """Ajoute ou remplace une formation sanitaire"""
+        with self._lock:
+            self._remove(facility.pk)
+            self._add(*(getattr(facility, field) for field in FACILITY_FIELDS))
+
+    def remove(self, facility_id):
+        with self._lock:
+            self._remove(facility_id)
+
+    def _add(self, facility_id, latitude, longitude, radius_km, polygon):
+        if latitude is not None and longitude is not None:
+            lat, lon = float(latitude), float(longitude)
+            self._points[facility_id] = (lat, lon)
+            self._point_cells[self._cell(lat, lon)].add(facility_id)
+
+        polygons = parse_polygons(polygon)
+        if polygons:
+            points = [point for polygon in polygons for point in polygon[0]]
+            bbox = (
+                min(lat for _, lat in points), min(lon for lon, _ in points),
+                max(lat for _, lat in points), max(lon for lon, _ in points),
+            )
+            coverage = (bbox, None, polygons)
+        elif radius_km and facility_id in self._points:
+            lat, lon = self._points[facility_id]
+            lat_span, lon_span = _degree_span(lat, float(radius_km))
+            bbox = (lat - lat_span, lon - lon_span, lat + lat_span, lon + lon_span)
+            coverage = (bbox, float(radius_km), None)
+        else:
+            return
+
+        self._coverages[facility_id] = coverage
+        for cell in self._cells(*bbox):
+            self._coverage_cells[cell].add(facility_id)
+
+    def _remove(self, facility_id):
+        point = self._points.pop(facility_id, None)
+        if point is not None:
+            self._point_cells[self._cell(*point)].discard(facility_id)
+        coverage = self._coverages.pop(facility_id, None)
+        if coverage is not None:
+            for cell in self._cells(*coverage[0]):
+                self._coverage_cells[cell].discard(facility_id)
+
+    # Recherches
+
+    def nearby(self, lat, lon, radius_km, limit=None):
+        """(id, distance en km) des formations situées à moins de `radius_km`, les plus proches d'abord"""
+        if not all(math.isfinite(value) for value in (lat, lon, radius_km)):
+            raise ValueError("Coordonnées et rayon finis attendus")
+        lat_span, lon_span = _degree_span(lat, radius_km)
+        results = []
+        with self._lock:
+            for cell in self._cells(lat - lat_span, lon - lon_span, lat + lat_span, lon + lon_span):
+                for facility_id in self._point_cells.get(cell, ()):
+                    distance = haversine_km(lat, lon, *self._points[facility_id])
+                    if distance <= radius_km:
+                        results.append((facility_id, distance))
+        results.sort(key=lambda item: item[1])
+        return results[:limit] if limit else results
+
+    def covering(self, lat, lon):
+        """Identifiants des formations dont la zone de couverture contient le point"""
+        results = []
+        with self._lock:
+            for facility_id in self._coverage_cells.get(self._cell(lat, lon), ()):
+                _, radius_km, polygons = self._coverages[facility_id]
+                if polygons is not None:
+                    if _in_polygons(lon, lat, polygons):
+                        results.append(facility_id)
+                elif haversine_km(lat, lon, *self._points[facility_id]) <= radius_km:
+                    results.append(facility_id)
+        return results
+
+
+facility_index = FacilityIndex()
+
+
+def current_signature():
+    """Signature des données : nombre de formations et dernière modification"""
+    state = HealthFacility.objects.aggregate(total=Count('id'), last_update=Max('updated_at'))
+    return state['total'], state['last_update']
+
+
+def get_facility_index():
+    """Index à jour, reconstruit si les données ont changé dans un autre processus"""
+    signature = current_signature()
+    if signature != facility_index.signature:
+        facility_index.build(HealthFacility.objects.values_list(*FACILITY_FIELDS).iterator(), signature)
+    return facility_index
+
+
+def refresh_signature():
+    """Enregistre la signature après une mise à jour incrémentale locale"""
+    if facility_index.signature is not None:
+        facility_index.signature = current_signature()
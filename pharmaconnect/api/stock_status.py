@@ -0,0 +1,92 @@
+"""
+Détection des ruptures, pré-ruptures et surstocks.
+
+Pour chaque (organisation, projet, médicament) : mois de stock = solde / CMM,
+comparé au délai de livraison + stock tampon du projet (seuil de
+pré-rupture) et à la périodicité + délai + tampon (stock maximum). Le calcul
+se fait en un nombre constant de requêtes groupées quel que soit le nombre de
+médicaments.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from .consumption import monthly_consumption
+from .models import ConsumptionData, Project, StockBalance
+
+STOCKOUT = 'STOCKOUT'
+PRE_STOCKOUT = 'PRE_STOCKOUT'
+OVERSTOCK = 'OVERSTOCK'
+OK = 'OK'
+
+StockStatus = namedtuple('StockStatus', [
+    'organization_id', 'project_id', 'medication_id',
+    'quantity', 'cmm', 'months_of_stock', 'min_months', 'max_months', 'status'
+])
+
+
+def scope_queryset(queryset, organization=None, health_facility=None, project=None, medications=None):
+    """Restreint un queryset portant organization/project/medication au périmètre demandé"""
+    if organization is not None:
+        queryset = queryset.filter(organization=organization)
+    if health_facility is not None:
+        queryset = queryset.filter(project__health_facility=health_facility)
+    if project is not None:
+        queryset = queryset.filter(project=project)
+    if medications is not None:
+        queryset = queryset.filter(medication__in=medications)
+    return queryset
+
+
+def _classify(quantity, cmm, min_months, max_months):
+    if quantity <= 0:
+        return None, STOCKOUT
+    if not cmm:
+        return None, OK
+    months_of_stock = quantity / cmm
+    if months_of_stock < min_months:
+        return months_of_stock, PRE_STOCKOUT
+    if months_of_stock > max_months:
+        return months_of_stock, OVERSTOCK
+    return months_of_stock, OK
+
+
+def evaluate_stock_status(months=3, cmm=None, **scope):
+    """
+    Statut de stock de chaque médicament du périmètre (voir scope_queryset).
+
+    `cmm` permet de fournir des CMM déjà calculées, indexées par
+    (organisation, projet, médicament).
+    """
+    balances = {
+        (org_id, project_id, medication_id): quantity
+        for org_id, project_id, medication_id, quantity in scope_queryset(
+            StockBalance.objects.all(), **scope
+        ).values_list('organization', 'project', 'medication', 'quantity_available')
+    }
+    if cmm is None:
+        cmm = monthly_consumption(scope_queryset(ConsumptionData.objects.all(), **scope), months)
+
+    keys = balances.keys() | {key for key, value in cmm.items() if value}
+    project_ids = {project_id for _, project_id, _ in keys}
+    thresholds = {
+        project_id: (
+            delay + buffer,
+            Decimal(frequency) + delay + buffer
+        )
+        for project_id, frequency, delay, buffer in Project.objects.filter(
+            id__in=project_ids
+        ).values_list('id', 'order_frequency_months', 'delivery_delay_months', 'buffer_stock_months')
+    }
+
+    statuses = []
+    for key in keys:
+        org_id, project_id, medication_id = key
+        quantity = balances.get(key, 0)
+        monthly = cmm.get(key, 0)
+        min_months, max_months = (float(value) for value in thresholds[project_id])
+        months_of_stock, status = _classify(quantity, monthly, min_months, max_months)
+        statuses.append(StockStatus(
+            org_id, project_id, medication_id, quantity, monthly,
+            months_of_stock, min_months, max_months, status
+        ))
+    return statuses
@@ -1,3 +1,2023 @@
-from django.test import TestCase
+"""
+Tests de l'API PharmaConnect.
 
-# Create your tests here.
+Les données de référence (organisation, bailleur, formation sanitaire,
+projet, catégorie, utilisateur de coordination) sont créées une fois par
+classe ; les caches tenus dans le processus (catalogue, index spatial,
+réponses d'analyses) sont vidés avant chaque test, les compteurs de
+version (DataVersion) étant remis à zéro avec la base.
+"""
+import base64
+import importlib
+import io
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
+
+from django.apps import apps as django_apps
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import dashboard_stats, dispensation_facts, ledger
+from .alerts import generate_alerts
+from .analytics_cache import cache_metrics
+from .catalog import CatalogCache, catalog_cache, catalog_key, get_catalog, invalidate_catalog
+from .classification import classify_medications, match_class
+from .consumption import compute_cmm
+from .dispensing import (
+    MAX_ATTEMPTS, Allocation, AllocationConflict, InsufficientStock, allocate_fefo, dispense_fefo,
+)
+from .gs1 import GS, GS1Error, parse_elements, parse_scan
+from .inventory_analysis import analyze_items
+from .models import (
+    Alert, ConsumptionData, Dispensation, DispensationDailyFact, DispensationItem, Donor, HealthFacility,
+    HealthFacilityDistributor, Inventory, InventoryItem, LotBalance, Medication, MedicationCategory, Organization,
+    PrescriptionPhoto, Project, StandardList, StockBalance, StockEntry, StockoutPeriod, TherapeuticClass, User,
+)
+from .spatial import facility_index
+from .urls import router
+from .versions import get_version
+
+try:
+    import openpyxl
+except ImportError:  # dépendance optionnelle de l'import XLSX (api.inventory_import)
+    openpyxl = None
+
+
+def create_reference_data(target, suffix=''):
+    """Crée les données de référence et les attache à `target` (classe ou instance de test)"""
+    target.organization = Organization.objects.create(
+        name=f'ONG Test{suffix}', code=f'ONG{suffix}', type='NGO', country='Cameroun'
+    )
+    target.donor = Donor.objects.create(name=f'Bailleur{suffix}', code=f'BAIL{suffix}')
+    target.facility = HealthFacility.objects.create(
+        name=f'CSI Test{suffix}', code=f'CSI{suffix}', type='CSI', level_of_care='PRIMARY',
+        location='Yaoundé', latitude=3.8667, longitude=11.5167,
+    )
+    target.project = Project.objects.create(
+        name=f'Projet{suffix}', code=f'PRJ{suffix}', organization=target.organization, donor=target.donor,
+        health_facility=target.facility, start_date=date(2024, 1, 1), end_date=date(2030, 12, 31),
+    )
+    target.category = MedicationCategory.objects.create(
+        code=f'CAT{suffix}', name='Catégorie', organization=target.organization
+    )
+    target.user = User.objects.create_user(
+        f'coordination{suffix}', password='motdepasse-test', organization=target.organization,
+        health_facility=target.facility, access_level='COORDINATION',
+    )
+    target.photo = PrescriptionPhoto.objects.create(photo='prescriptions/test.jpg', user=target.user)
+
+
+def reset_process_caches():
+    """Vide les caches du processus, qui survivent à la remise à zéro de la base"""
+    catalog_cache.clear()
+    facility_index.signature = None
+    caches['analytics'].clear()
+    cache_metrics.reset()
+    dispensation_facts._pending.__dict__.pop('keys', None)
+
+
+@override_settings(ANALYTICS_CACHES=['analytics'])
+class PharmaConnectTestCase(TestCase):
+    """Données de référence, client authentifié et fabriques d'objets"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data(cls)
+
+    def setUp(self):
+        reset_process_caches()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_medication(self, code, **fields):
+        fields.setdefault('name', f'Médicament {code}')
+        fields.setdefault('category', self.category)
+        return Medication.objects.create(
+            code=code, organization=self.organization, form='Comprimé', packaging='Boîte de 100', **fields
+        )
+
+    def receive(self, medication, quantity, expiry_date=None, batch_number='', project=None, **fields):
+        """Entrée en stock d'un lot (soldes mis à jour par les signaux)"""
+        return StockEntry.objects.create(
+            organization=self.organization, project=project or self.project, medication=medication,
+            delivery_date=fields.pop('delivery_date', date.today() - timedelta(days=30)),
+            quantity_delivered=quantity, expiry_date=expiry_date or date.today() + timedelta(days=365),
+            batch_number=batch_number, **fields
+        )
+
+    def create_dispensation(self, destination='PATIENT', project=None, **fields):
+        fields.setdefault('prescription_photo', self.photo)
+        return Dispensation.objects.create(
+            destination=destination, organization=self.organization, project=project or self.project,
+            created_by=self.user, **fields
+        )
+
+    def record_consumption(self, medication, quantity, weeks=12, project=None):
+        """Consommation hebdomadaire clôturée sur les `weeks` dernières semaines"""
+        monday = date.today() - timedelta(days=date.today().weekday())
+        for offset in range(1, weeks + 1):
+            year, week, _ = (monday - timedelta(weeks=offset)).isocalendar()
+            ConsumptionData.objects.create(
+                organization=self.organization, project=project or self.project, medication=medication,
+                year=year, week_number=week, quantity_consumed=quantity, is_week_closed=True,
+            )
+
+
+class StockSummaryTests(PharmaConnectTestCase):
+    """Ruptures et pré-ruptures de l'analyse stock-summary"""
+
+    url = reverse('stock_summary')
+
+    def test_stockout_and_pre_stockout_counts(self):
+        # Délai 1 mois + tampon 0,5 mois : pré-rupture sous 1,5 mois de stock
+        stockout = self.create_medication('RUP')
+        pre_stockout = self.create_medication('PRE')
+        covered = self.create_medication('OK')
+        for medication in (stockout, pre_stockout, covered):
+            self.record_consumption(medication, 100)
+        self.receive(pre_stockout, 300)
+        self.receive(covered, 1000)
+        self.receive(stockout, 50)
+        dispense_fefo(self.create_dispensation(), [(stockout.id, 50)])
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stockout_items'], 1)
+        self.assertEqual(response.data['pre_stockout_items'], 1)
+
+    def test_consumption_without_stock_is_a_stockout(self):
+        self.record_consumption(self.create_medication('SANS'), 50)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.data['stockout_items'], 1)
+        self.assertEqual(response.data['pre_stockout_items'], 0)
+
+    def test_expired_and_expiry_risk_lots(self):
+        medication = self.create_medication('PER')
+        self.receive(medication, 10, expiry_date=date.today() - timedelta(days=1))
+        self.receive(medication, 10, expiry_date=date.today() + timedelta(days=30))
+        self.receive(medication, 10, expiry_date=date.today() + timedelta(days=300))
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.data['expired_items'], 1)
+        self.assertEqual(response.data['expiry_risk_items'], 1)
+        self.assertEqual(response.data['total_medications'], 1)
+
+
+class LedgerTests(PharmaConnectTestCase):
+    """Soldes par lot et par médicament tenus par api.ledger"""
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('AMX')
+
+    def assertBalancesConsistent(self):
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_receptions_open_lot_and_medication_balances(self):
+        first = self.receive(self.medication, 100)
+        self.receive(self.medication, 40)
+
+        self.assertEqual(LotBalance.objects.get(stock_entry=first).quantity_available, 100)
+        self.assertEqual(StockBalance.objects.get(medication=self.medication).quantity_available, 140)
+        self.assertBalancesConsistent()
+
+    def test_reception_update_and_deletion(self):
+        entry = self.receive(self.medication, 100)
+        entry.quantity_delivered = 80
+        entry.save()
+        self.assertEqual(StockBalance.objects.get(medication=self.medication).quantity_available, 80)
+        self.assertBalancesConsistent()
+
+        entry.delete()
+        self.assertFalse(LotBalance.objects.exists())
+        self.assertEqual(StockBalance.objects.get(medication=self.medication).quantity_available, 0)
+        self.assertBalancesConsistent()
+
+    def test_dispensed_items_and_cancellation(self):
+        entry = self.receive(self.medication, 100)
+        item = DispensationItem.objects.create(
+            dispensation=self.create_dispensation(), medication=self.medication,
+            stock_entry=entry, quantity_dispensed=30,
+        )
+        self.assertEqual(LotBalance.objects.get(stock_entry=entry).quantity_available, 70)
+        self.assertBalancesConsistent()
+
+        item.delete()
+        self.assertEqual(LotBalance.objects.get(stock_entry=entry).quantity_available, 100)
+        self.assertBalancesConsistent()
+
+    def test_withdrawal_beyond_lot_balance_is_refused(self):
+        entry = self.receive(self.medication, 10)
+
+        with self.assertRaises(ledger.InsufficientLotStock):
+            DispensationItem.objects.create(
+                dispensation=self.create_dispensation(), medication=self.medication,
+                stock_entry=entry, quantity_dispensed=11,
+            )
+        self.assertEqual(LotBalance.objects.get(stock_entry=entry).quantity_available, 10)
+        self.assertBalancesConsistent()
+
+    def test_inventory_variances_adjust_balances(self):
+        entry = self.receive(self.medication, 100)
+        inventory = Inventory.objects.create(
+            organization=self.organization, project=self.project, inventory_date=date.today(),
+            month=date.today().month, year=date.today().year, created_by=self.user,
+        )
+        InventoryItem.objects.create(
+            inventory=inventory, medication=self.medication, stock_entry=entry,
+            theoretical_stock=100, physical_stock=95,
+        )
+
+        lot = LotBalance.objects.get(stock_entry=entry)
+        self.assertEqual((lot.quantity_adjusted, lot.quantity_available), (-5, 95))
+        self.assertBalancesConsistent()
+
+    def test_rebuild_restores_drifted_balances(self):
+        self.receive(self.medication, 100)
+        StockBalance.objects.update(quantity_available=1)
+        self.assertEqual(len(ledger.verify_balances()), 1)
+
+        ledger.rebuild_balances()
+
+        self.assertBalancesConsistent()
+
+
+class ConsumptionTests(PharmaConnectTestCase):
+    """CMM glissantes (api.consumption) et analyses de consommation"""
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('CMM')
+        self.monday = date.today() - timedelta(days=date.today().weekday())
+
+    def week_start(self, offset):
+        return self.monday - timedelta(weeks=offset)
+
+    def record_series(self, medication, quantities, project=None, **fields):
+        """Semaine `offset` : quantities[offset - 1], en remontant depuis la semaine dernière"""
+        for offset, quantity in enumerate(quantities, start=1):
+            year, week, _ = self.week_start(offset).isocalendar()
+            ConsumptionData.objects.create(
+                organization=self.organization, project=project or self.project, medication=medication,
+                year=year, week_number=week, quantity_consumed=quantity, is_week_closed=True, **fields
+            )
+
+    def cmm(self, **options):
+        return compute_cmm(ConsumptionData.objects.filter(medication=self.medication), **options)[
+            (self.organization.id, self.project.id, self.medication.id)
+        ]
+
+    def test_rolling_windows(self):
+        # 13 semaines à 30 (3 mois), 13 à 60 (6 mois), rien au-delà
+        self.record_series(self.medication, [30] * 13 + [60] * 13)
+
+        result = self.cmm()
+
+        self.assertEqual(result.weeks, {3: 13, 6: 26, 12: 26})
+        self.assertEqual(result.total, {3: 390, 6: 1170, 12: 1170})
+        self.assertAlmostEqual(result.cmm[3], 130)
+        self.assertAlmostEqual(result.cmm[6], 195)
+        # Moyenne sur les semaines renseignées de la fenêtre
+        self.assertAlmostEqual(result.cmm[12], 195)
+
+    def test_open_and_older_weeks_are_ignored(self):
+        self.record_series(self.medication, [30] * 13)
+        year, week, _ = self.monday.isocalendar()
+        ConsumptionData.objects.create(
+            organization=self.organization, project=self.project, medication=self.medication,
+            year=year, week_number=week, quantity_consumed=500, is_week_closed=False,
+        )
+        year, week, _ = self.week_start(14).isocalendar()
+        ConsumptionData.objects.create(
+            organization=self.organization, project=self.project, medication=self.medication,
+            year=year, week_number=week, quantity_consumed=500, is_week_closed=True,
+        )
+
+        result = self.cmm(windows=(3,))
+
+        self.assertEqual((result.weeks[3], result.total[3]), (13, 390))
+
+    def test_stockout_weeks_are_excluded(self):
+        # Rupture en cours depuis deux semaines : consommation nulle non représentative
+        self.record_series(self.medication, [0, 0] + [39] * 11)
+        StockoutPeriod.objects.create(
+            organization=self.organization, project=self.project, medication=self.medication,
+            start_date=self.week_start(2) + timedelta(days=3),
+        )
+
+        self.assertEqual(self.cmm(windows=(3,)).weeks[3], 11)
+        self.assertAlmostEqual(self.cmm(windows=(3,)).cmm[3], 169)
+        self.assertAlmostEqual(self.cmm(windows=(3,), exclude_stockouts=False).cmm[3], 143)
+
+    def test_closed_stockout_only_excludes_overlapping_weeks(self):
+        self.record_series(self.medication, [39] * 3 + [0] + [39] * 9)
+        StockoutPeriod.objects.create(
+            organization=self.organization, project=self.project, medication=self.medication,
+            start_date=self.week_start(4) + timedelta(days=1), end_date=self.week_start(4) + timedelta(days=5),
+        )
+
+        result = self.cmm(windows=(3,))
+
+        self.assertEqual(result.weeks[3], 12)
+        self.assertAlmostEqual(result.cmm[3], 169)
+
+    def test_monthly_analysis_follows_months(self):
+        self.record_series(self.medication, [30] * 13 + [60] * 13)
+        other = self.create_medication('AUT')
+        self.record_series(other, [13] * 26)
+        url = reverse('consumptiondata-monthly-analysis')
+
+        data = self.client.get(url, {'medication': self.medication.id}).data
+        self.assertEqual(
+            (data['months'], data['total_consumption'], data['weeks_analyzed'], data['monthly_average']),
+            (3, 390, 13, 130)
+        )
+        data = self.client.get(url, {'medication': self.medication.id, 'months': 6}).data
+        self.assertEqual((data['total_consumption'], data['weeks_analyzed'], data['monthly_average']), (1170, 26, 195))
+        # Sans médicament : CMM de chaque médicament additionnées
+        data = self.client.get(url, {'months': 6}).data
+        self.assertEqual((data['total_consumption'], data['monthly_average']), (1508, 251.33))
+
+    def test_monthly_analysis_rejects_invalid_months(self):
+        url = reverse('consumptiondata-monthly-analysis')
+        for months in ('abc', '0', '25', '1.5'):
+            with self.subTest(months=months):
+                response = self.client.get(url, {'months': months})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.data)
+
+    def test_cmm_endpoint_returns_every_medication_of_the_project(self):
+        self.record_series(self.medication, [30] * 13 + [60] * 13)
+        other = self.create_medication('AUT')
+        self.record_series(other, [0, 0] + [39] * 11)
+        StockoutPeriod.objects.create(
+            organization=self.organization, project=self.project, medication=other,
+            start_date=self.week_start(2),
+        )
+        elsewhere = Project.objects.create(
+            name='Autre projet', code='AUT', organization=self.organization, donor=self.donor,
+            health_facility=self.facility, start_date=date(2024, 1, 1), end_date=date(2030, 12, 31),
+        )
+        self.record_series(self.medication, [99] * 13, project=elsewhere)
+        url = reverse('consumptiondata-cmm')
+
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'project': self.project.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                (row['medication_code'], row['cmm_3'], row['weeks_3'], row['cmm_6'], row['cmm_12'], row['weeks_12'])
+                for row in response.data
+            ],
+            [('AUT', 169, 11, 169, 169, 11), ('CMM', 130, 13, 195, 195, 26)]
+        )
+        self.assertEqual(len(self.client.get(url).data), 3)
+
+
+class OrderProposalTests(PharmaConnectTestCase):
+    """Proposition de commande d'un projet (ProjectViewSet.order_proposal)"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('project-order-proposal', args=[self.project.pk])
+
+    def add_to_standard_list(self, count):
+        start = StandardList.objects.count()
+        for number in range(start, start + count):
+            medication = self.create_medication(f'M{number:03}', unit_price=2)
+            StandardList.objects.create(organization=self.organization, project=self.project, medication=medication)
+            self.record_consumption(medication, 30, weeks=4)
+            self.receive(medication, 10)
+
+    def test_quantities_to_order(self):
+        self.add_to_standard_list(1)
+
+        response = self.client.get(self.url, {'months': 1})
+
+        self.assertEqual(response.status_code, 200)
+        line, = response.data['lines']
+        # CMM 130 x 4,5 mois de couverture, moins le stock disponible
+        self.assertEqual(line['cmm'], 130)
+        self.assertEqual(line['quantity_to_order'], 585 - 10)
+
+    def test_query_count_does_not_depend_on_line_count(self):
+        self.add_to_standard_list(1)
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+
+        self.add_to_standard_list(20)
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['total_lines'], 21)
+
+    def test_invalid_months_are_rejected(self):
+        for months in ('abc', '0', '-3', '25', '1.5'):
+            with self.subTest(months=months):
+                response = self.client.get(self.url, {'months': months})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.data)
+
+
+class AlertRuleTests(PharmaConnectTestCase):
+    """Synchronisation des alertes actives par les règles (api.alerts)"""
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('ALR')
+        self.record_consumption(self.medication, 30)
+
+    def stock_alerts(self):
+        return Alert.objects.filter(medication=self.medication, alert_type__in=['STOCKOUT', 'PRE_STOCKOUT'])
+
+    def test_alerts_follow_stock_status(self):
+        generate_alerts(['stock_status'])
+        alert = self.stock_alerts().get()
+        self.assertEqual((alert.alert_type, alert.is_active), ('STOCKOUT', True))
+
+        self.receive(self.medication, 100)
+        report, = generate_alerts(['stock_status'])
+
+        self.assertEqual((report.created, report.resolved), (1, 1))
+        self.assertEqual(self.stock_alerts().get(is_active=True).alert_type, 'PRE_STOCKOUT')
+        self.assertIsNotNone(self.stock_alerts().get(alert_type='STOCKOUT').resolved_at)
+
+    def test_message_is_updated_when_severity_is_unchanged(self):
+        self.receive(self.medication, 100)
+        generate_alerts(['stock_status'])
+        self.receive(self.medication, 50)
+
+        report, = generate_alerts(['stock_status'])
+
+        alert = self.stock_alerts().get()
+        self.assertEqual(report.updated, 1)
+        self.assertEqual(alert.severity, 'HIGH')
+        self.assertIn('Stock disponible : 150', alert.message)
+
+    def test_unchanged_alerts_are_not_rewritten(self):
+        self.receive(self.medication, 100)
+        generate_alerts(['stock_status'])
+
+        report, = generate_alerts(['stock_status'])
+
+        self.assertEqual((report.created, report.updated, report.resolved), (0, 0, 0))
+
+    def test_renamed_medication_keeps_its_alert(self):
+        generate_alerts(['stock_status'])
+        alert = self.stock_alerts().get()
+        self.medication.name = 'Amoxicilline'
+        self.medication.save()
+
+        report, = generate_alerts(['stock_status'])
+
+        self.assertEqual((report.created, report.updated, report.resolved), (0, 1, 0))
+        self.assertEqual(self.stock_alerts().get().pk, alert.pk)
+        self.assertEqual(self.stock_alerts().get().title, 'Rupture : Amoxicilline')
+
+    def test_duplicate_active_alerts_are_resolved(self):
+        generate_alerts(['stock_status'])
+        kept = self.stock_alerts().get()
+        for title in ('Rupture : ancien nom', 'Rupture : autre nom'):
+            Alert.objects.create(
+                organization=self.organization, project=self.project, medication=self.medication,
+                alert_type='STOCKOUT', severity='CRITICAL', title=title, message='Stock épuisé',
+            )
+
+        report, = generate_alerts(['stock_status'])
+
+        self.assertEqual((report.created, report.resolved), (0, 2))
+        self.assertEqual(list(self.stock_alerts().filter(is_active=True)), [kept])
+        self.assertEqual(dashboard_stats.get_statistics()['active_alert_count'], 1)
+
+    def test_service_overconsumption_is_one_alert_per_medication(self):
+        entry = self.receive(self.medication, 1000)
+        for service, recent in (('Pédiatrie', 30), ('Maternité', 20)):
+            for days_ago, quantity in ((10, recent), (60, 10)):
+                dispensation = self.create_dispensation(destination='SERVICE', service_name=service)
+                DispensationItem.objects.create(
+                    dispensation=dispensation, medication=self.medication, stock_entry=entry,
+                    quantity_dispensed=quantity,
+                )
+                # Date renseignée à la création (auto_now_add) : antidatée ensuite
+                Dispensation.objects.filter(pk=dispensation.pk).update(
+                    dispensation_date=timezone.now() - timedelta(days=days_ago)
+                )
+
+        report, = generate_alerts(['service_overconsumption'])
+
+        alert = Alert.objects.get(alert_type='SERVICE_OVERCONSUMPTION')
+        self.assertEqual((report.created, alert.severity), (1, 'HIGH'))
+        self.assertEqual(alert.title, 'Surconsommation de 2 services : Médicament ALR')
+        self.assertTrue(alert.message.startswith('Pédiatrie : 30 unité(s)'))
+        self.assertIn('Maternité : 20 unité(s)', alert.message)
+
+
+
+class AlertAdminTests(PharmaConnectTestCase):
+    """Résolution des alertes depuis l'administration"""
+
+    def test_mark_resolved_refreshes_alert_dashboard(self):
+        medication = self.create_medication('ADM')
+        alerts = [
+            Alert.objects.create(
+                organization=self.organization, project=self.project, medication=medication,
+                alert_type='STOCKOUT', severity='CRITICAL', title=f'Rupture {number}', message='Stock épuisé',
+            )
+            for number in range(2)
+        ]
+        dashboard_url = reverse('alert-dashboard')
+        self.assertEqual(self.client.get(dashboard_url).data['total_active_alerts'], 2)
+        admin = User.objects.create_superuser('admin', 'admin@example.org', 'motdepasse-admin')
+        self.client.force_login(admin)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                # Liste filtrée sur les alertes actives, comme depuis le filtre latéral
+                reverse('admin:api_alert_changelist') + '?is_active__exact=1',
+                {'action': 'mark_resolved', '_selected_action': [alert.pk for alert in alerts]},
+            )
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Alert.objects.filter(is_active=True).exists())
+        self.assertTrue(all(alert.resolved_at for alert in Alert.objects.all()))
+        self.client.force_authenticate(self.user)
+        dashboard = self.client.get(dashboard_url).data
+        self.assertEqual((dashboard['total_active_alerts'], dashboard['critical_alerts']), (0, []))
+
+
+
+class DashboardStatisticsTests(PharmaConnectTestCase):
+    """Instantané des compteurs de l'administration tenu à jour entre deux recomptages"""
+
+    def fresh_counts(self):
+        return {name: queryset().count() for name, queryset in dashboard_stats.STATISTICS.items()}
+
+    def test_snapshot_follows_writes(self):
+        self.assertEqual(dashboard_stats.get_statistics(), self.fresh_counts())
+        with self.captureOnCommitCallbacks(execute=True):
+            medication = self.create_medication('DSH')
+            self.receive(medication, 10)
+            self.record_consumption(medication, 10)
+            self.create_dispensation()
+            self.client.post(reverse('dispensation-bulk'), {'dispensations': [{
+                'prescription_photo': self.photo.id, 'destination': 'PATIENT', 'organization': self.organization.id,
+                'project': self.project.id, 'items': [{'medication': medication.id, 'quantity': 2}],
+            }]}, format='json')
+            generate_alerts()
+            medication.is_active = False
+            medication.save()
+
+        with self.assertNumQueries(1):
+            statistics = dashboard_stats.get_statistics()
+        self.assertEqual((statistics['dispensation_count'], statistics['active_alert_count']), (2, 1))
+        self.assertEqual(statistics, self.fresh_counts())
+
+
+
+class DispensationFactsTests(PharmaConnectTestCase):
+    """Faits de dispensation journaliers et analyses qui les lisent"""
+
+    def setUp(self):
+        super().setUp()
+        self.amoxicillin = self.create_medication('AMX', therapeutic_class='Antibiotique')
+        self.cotrimoxazole = self.create_medication('CTX', therapeutic_class='Antibiotique')
+        self.artemether = self.create_medication('ART', therapeutic_class='Antipaludique')
+        self.paracetamol = self.create_medication('PCM')
+        self.lots = {
+            medication.id: self.receive(medication, 1000)
+            for medication in (self.amoxicillin, self.cotrimoxazole, self.artemether, self.paracetamol)
+        }
+
+    def dispense(self, *medications, **fields):
+        """Dispensation d'une unité de chaque médicament (doublons compris), faits recalculés"""
+        with self.captureOnCommitCallbacks(execute=True):
+            dispensation = self.create_dispensation(status='DELIVERED', **fields)
+            for medication in medications:
+                DispensationItem.objects.create(
+                    dispensation=dispensation, medication=medication,
+                    stock_entry=self.lots[medication.id], quantity_dispensed=1,
+                )
+        return dispensation
+
+    def dispense_mix(self):
+        self.dispense(self.amoxicillin, self.cotrimoxazole, self.amoxicillin)
+        self.dispense(self.amoxicillin, self.artemether, patient_age=3)
+        self.dispense(self.paracetamol, patient_service='CPN')
+        self.dispense(self.paracetamol, destination='SERVICE')
+
+    def facts(self):
+        return sorted(DispensationDailyFact.objects.values_list(*[
+            f'{name}_id' if name in ('organization', 'project', 'health_facility') else name
+            for name in dispensation_facts.DIMENSIONS
+        ], 'prescriptions', 'items', 'quantity_dispensed'))
+
+    def assertFactsMatchRebuild(self):
+        maintained = self.facts()
+        with self.captureOnCommitCallbacks(execute=True):
+            dispensation_facts.rebuild_facts()
+        self.assertEqual(maintained, self.facts())
+
+    def test_facts_follow_writes(self):
+        self.dispense_mix()
+        self.assertEqual(sum(fact[-3] for fact in self.facts()), 4)
+        self.assertFactsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Dispensation.objects.filter(destination='SERVICE').get().delete()
+            DispensationItem.objects.filter(medication=self.cotrimoxazole).delete()
+            # Indicateurs recopiés de la classe thérapeutique reconnue (api.classification)
+            self.paracetamol.therapeutic_class = 'Antibiotique'
+            self.paracetamol.save()
+
+        self.assertEqual(sum(fact[-3] for fact in self.facts()), 3)
+        self.assertFactsMatchRebuild()
+
+    def test_pharmacoepidemio_counts_multitherapy(self):
+        self.dispense_mix()
+        self.dispense(self.amoxicillin, self.cotrimoxazole, self.artemether)
+
+        data = self.client.get(reverse('pharmacoepidemio_analysis')).data
+
+        self.assertEqual(data['total_prescriptions'], 5)
+        self.assertEqual((data['antibiotic_prescriptions'], data['multitherapy_prescriptions']), (3, 2))
+        self.assertEqual((data['malaria_prescriptions'], data['pregnant_women_prescriptions']), (2, 1))
+        self.assertEqual(data['children_under_5_prescriptions'], 1)
+        self.assertEqual(data['multitherapy_percentage'], '40.00')
+        self.assertEqual(
+            [(row['antibiotic_count'], row['total_prescriptions']) for row in data['antibiotics_per_prescription']],
+            [(0, 2), (1, 1), (2, 2)]
+        )
+        week, = data['weekly_antibiotics']
+        monday = date.today() - timedelta(days=date.today().weekday())
+        self.assertEqual(
+            (week['week'], week['total_prescriptions'], week['antibiotic_prescriptions'],
+             week['multitherapy_prescriptions']),
+            (monday.isoformat(), 5, 3, 2)
+        )
+
+    def test_date_filters_are_inclusive_days(self):
+        self.dispense_mix()
+        today = date.today().isoformat()
+        url = reverse('pharmacoepidemio_analysis')
+
+        self.assertEqual(self.client.get(url, {'start_date': today, 'end_date': today}).data['total_prescriptions'], 4)
+        tomorrow = (date.today() + timedelta(days=1)).isoformat()
+        self.assertEqual(self.client.get(url, {'start_date': tomorrow}).data['total_prescriptions'], 0)
+        response = self.client.get(url, {'end_date': 'hier'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_dispensation_statistics(self):
+        self.dispense_mix()
+
+        data = self.client.get(reverse('dispensation-statistics'), {'end_date': date.today().isoformat()}).data
+
+        self.assertEqual(data['total_dispensations'], 4)
+        self.assertEqual(data['by_status'], [{'status': 'DELIVERED', 'count': 4}])
+        self.assertEqual(
+            data['by_destination'], [{'destination': 'PATIENT', 'count': 3}, {'destination': 'SERVICE', 'count': 1}]
+        )
+
+
+class ClassificationTests(PharmaConnectTestCase):
+    """Classes thérapeutiques de référence (api.classification) et indicateurs recopiés"""
+
+    def flags(self, medication):
+        medication.refresh_from_db()
+        code = medication.classification.code if medication.classification else None
+        return code, medication.is_antibiotic, medication.is_antimalarial
+
+    def test_free_text_is_matched_without_accents_or_case(self):
+        for number, (text, expected) in enumerate([
+            ('Antibiotiqué', ('J01', True, False)),
+            ('ANTIBACTÉRIENS', ('J01', True, False)),
+            ('Antipaludéen', ('P01B', False, True)),
+            ('antimalarial', ('P01B', False, True)),
+            ('Antibiotiques', ('J01', True, False)),
+            ('Antalgique', (None, False, False)),
+            ('', (None, False, False)),
+        ]):
+            with self.subTest(text=text):
+                medication = self.create_medication(f'T{number}', therapeutic_class=text)
+                self.assertEqual(self.flags(medication), expected)
+
+        classes = list(TherapeuticClass.objects.all())
+        self.assertIsNone(match_class('   ', classes))
+        self.assertEqual(match_class('Antibiotiques', classes).code, 'J01')
+
+    def test_reclassified_when_its_text_changes(self):
+        medication = self.create_medication('AMX', therapeutic_class='Antibiotique')
+        medication.therapeutic_class = 'Antipaludique'
+        medication.save()
+        self.assertEqual(self.flags(medication), ('P01B', False, True))
+
+        # Indicateurs fournis par le client ignorés
+        response = self.client.patch(
+            reverse('medication-detail', args=[medication.id]), {'is_antibiotic': True, 'is_antimalarial': False}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.flags(medication), ('P01B', False, True))
+
+    def test_reference_class_changes_reclassify_medications(self):
+        medication = self.create_medication('RIF', therapeutic_class='Antituberculeux')
+        other = self.create_medication('PCM', therapeutic_class='Antalgique')
+
+        tuberculosis = TherapeuticClass.objects.create(
+            code='J04', name='Antituberculeux', match_terms='antitubercul', is_antibiotic=True
+        )
+        self.assertEqual(self.flags(medication), ('J04', True, False))
+        self.assertEqual(self.flags(other), (None, False, False))
+
+        tuberculosis.is_antibiotic = False
+        tuberculosis.save()
+        self.assertEqual(self.flags(medication), ('J04', False, False))
+
+        tuberculosis.delete()
+        self.assertEqual(self.flags(medication), (None, False, False))
+        self.assertEqual(classify_medications(), 0)
+
+    def test_flag_changes_recompute_dispensation_facts(self):
+        medication = self.create_medication('RIF', therapeutic_class='Antituberculeux')
+        lot = self.receive(medication, 100)
+        with self.captureOnCommitCallbacks(execute=True):
+            dispensation = self.create_dispensation(status='DELIVERED')
+            DispensationItem.objects.create(
+                dispensation=dispensation, medication=medication, stock_entry=lot, quantity_dispensed=1
+            )
+        self.assertEqual(list(DispensationDailyFact.objects.values_list('antibiotic_count', flat=True)), [0])
+
+        # Reclassement en masse (bulk_update sans signaux) : jours marqués par mark_medication_days
+        with self.captureOnCommitCallbacks(execute=True):
+            TherapeuticClass.objects.create(
+                code='J04', name='Antituberculeux', match_terms='antitubercul', is_antibiotic=True
+            )
+        self.assertEqual(list(DispensationDailyFact.objects.values_list('antibiotic_count', flat=True)), [1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            medication.therapeutic_class = 'Antalgique'
+            medication.save()
+        self.assertEqual(list(DispensationDailyFact.objects.values_list('antibiotic_count', flat=True)), [0])
+
+    def test_migration_backfills_existing_medications(self):
+        migration = importlib.import_module('api.migrations.0016_therapeutic_classes')
+        amoxicillin = self.create_medication('AMX', therapeutic_class='Antibactérien')
+        artemether = self.create_medication('ART', therapeutic_class='Antipaludéen')
+        paracetamol = self.create_medication('PCM', therapeutic_class='Antalgique')
+        # Médicaments antérieurs à la classification
+        Medication.objects.update(classification=None, is_antibiotic=False, is_antimalarial=False)
+
+        migration.classify_existing(django_apps, None)
+
+        self.assertEqual(self.flags(amoxicillin), ('J01', True, False))
+        self.assertEqual(self.flags(artemether), ('P01B', False, True))
+        self.assertEqual(self.flags(paracetamol), (None, False, False))
+        self.assertEqual(list(TherapeuticClass.objects.values_list('code', flat=True)), ['J01', 'P01B'])
+
+class ListQueryCountTests(PharmaConnectTestCase):
+    """
+    Nombre de requêtes des listes du routeur : identique pour une page d'un
+    élément et une page pleine (pas de requête par ligne)
+    """
+
+    page_size = 10
+
+    # Préfixe du routeur -> requêtes attendues (authentification forcée, catalogue chargé)
+    expected_queries = {
+        'organizations': 2,
+        'donors': 2,
+        'health-facilities': 2,
+        'health-facility-distributors': 2,
+        'projects': 2,
+        'users': 2,
+        'medication-categories': 2,
+        'medications': 3,
+        'standard-lists': 3,
+        'stock-entries': 2,
+        'prescription-photos': 2,
+        'dispensations': 3,
+        'inventories': 4,
+        'consumption-data': 2,
+        'alerts': 2,
+    }
+
+    def populate(self, count):
+        """`count` éléments de chaque liste, avec leurs relations"""
+        for number in range(count):
+            donor = Donor.objects.create(name=f'Bailleur {number}', code=f'B{number}')
+            facility = HealthFacility.objects.create(
+                name=f'CSI {number}', code=f'F{number}', type='CSI', level_of_care='PRIMARY',
+                location='Yaoundé', latitude=3.8 + number / 100, longitude=11.5,
+            )
+            user = User.objects.create_user(
+                f'agent{number}', organization=self.organization, health_facility=facility,
+                access_level='FACILITY',
+            )
+            HealthFacilityDistributor.objects.create(user=user, health_facility=facility, assigned_by=self.user)
+            project = Project.objects.create(
+                name=f'Projet {number}', code=f'P{number}', organization=self.organization, donor=donor,
+                health_facility=facility, start_date=date(2024, 1, 1), end_date=date(2030, 12, 31),
+            )
+            category = MedicationCategory.objects.create(
+                code=f'C{number}', name=f'Catégorie {number}', organization=self.organization
+            )
+            medication = self.create_medication(f'M{number}', category=category, therapeutic_class='Antibiotique')
+            medication.allowed_facilities.add(facility)
+            StandardList.objects.create(organization=self.organization, project=project, medication=medication)
+            entry = self.receive(medication, 100, project=project, batch_number=f'L{number}')
+            photo = PrescriptionPhoto.objects.create(photo='prescriptions/test.jpg', user=user)
+            dispensation = self.create_dispensation(project=project, prescription_photo=photo)
+            DispensationItem.objects.create(
+                dispensation=dispensation, medication=medication, stock_entry=entry, quantity_dispensed=1
+            )
+            inventory = Inventory.objects.create(
+                organization=self.organization, project=project, inventory_date=date.today(),
+                month=1, year=2025, created_by=user,
+            )
+            InventoryItem.objects.create(
+                inventory=inventory, medication=medication, stock_entry=entry,
+                theoretical_stock=99, physical_stock=98,
+            )
+            self.record_consumption(medication, 5, weeks=1, project=project)
+            Alert.objects.create(
+                organization=self.organization, project=project, medication=medication,
+                alert_type='STOCKOUT', severity='HIGH', title=f'Rupture {number}', message='Stock épuisé',
+            )
+
+    def assertListQueries(self, rows):
+        for prefix, _, basename in router.registry:
+            with self.subTest(endpoint=prefix, rows=rows):
+                url = reverse(f'{basename}-list')
+                params = {'page_size': self.page_size}
+                # Première requête à blanc : catalogue et index chargés
+                self.client.get(url, params)
+                with self.assertNumQueries(self.expected_queries[prefix]):
+                    response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.data['results'])
+
+    def test_every_router_list_has_a_budget(self):
+        self.assertEqual({prefix for prefix, _, _ in router.registry}, set(self.expected_queries))
+
+    def test_single_row_pages(self):
+        self.populate(1)
+        self.assertListQueries(1)
+
+    def test_full_pages(self):
+        self.populate(self.page_size)
+        self.assertListQueries(self.page_size)
+
+
+class FacilityGeoJSONTests(PharmaConnectTestCase):
+    """Carte GeoJSON diffusée des formations sanitaires et revalidation par ETag"""
+
+    url = reverse('healthfacility-geojson')
+
+    def setUp(self):
+        super().setUp()
+        self.douala = HealthFacility.objects.create(
+            name='CSI Douala', code='DLA', type='CSI', level_of_care='PRIMARY',
+            location='Littoral', latitude=4.0511, longitude=9.7679,
+        )
+        HealthFacility.objects.create(
+            name='CSI sans coordonnées', code='SANS', type='CSI', level_of_care='PRIMARY', location='Centre',
+        )
+
+    def get_features(self, params=None, **headers):
+        response = self.client.get(self.url, params or {}, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+        collection = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        return response['ETag'], collection['features']
+
+    def test_feature_collection(self):
+        _, features = self.get_features()
+
+        self.assertEqual(sorted(feature['properties']['name'] for feature in features), ['CSI Douala', 'CSI Test'])
+        douala, = (feature for feature in features if feature['id'] == self.douala.id)
+        self.assertEqual(douala['geometry'], {'type': 'Point', 'coordinates': [9.7679, 4.0511]})
+
+    def test_if_none_match_returns_not_modified(self):
+        etag, _ = self.get_features()
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"autre", {etag}')
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.get_features(HTTP_IF_NONE_MATCH='"autre"')[0], etag)
+
+    def test_etag_changes_when_a_facility_changes(self):
+        etag, _ = self.get_features()
+        self.douala.name = 'Hôpital de district de Douala'
+        self.douala.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Hôpital de district de Douala', b''.join(response.streaming_content).decode())
+        # Suppression : le nombre de lignes change aussi l'ETag
+        fresh = response['ETag']
+        self.douala.delete()
+        self.assertNotEqual(self.get_features(HTTP_IF_NONE_MATCH=fresh)[0], fresh)
+
+    def test_bbox(self):
+        etag, _ = self.get_features()
+        # Région du Centre autour de Yaoundé
+        bbox_etag, features = self.get_features({'bbox': '11,3.5,12,4.5'})
+
+        self.assertEqual([feature['id'] for feature in features], [self.facility.id])
+        self.assertNotEqual(bbox_etag, etag)
+        # Bornes incluses
+        _, features = self.get_features({'bbox': '9.7679,4.0511,9.7679,4.0511'})
+        self.assertEqual([feature['id'] for feature in features], [self.douala.id])
+
+    def test_invalid_bbox_is_rejected(self):
+        for bbox in (
+            'abc', '11,3.5,12', '11,3.5,12,4.5,1', '11,3.5,,4.5', 'nan,3.5,12,4.5', '11,3.5,inf,4.5',
+            '-inf,-inf,inf,inf', '12,3.5,11,4.5', '11,4.5,12,3.5', '-181,3.5,12,4.5', '11,-91,12,4.5',
+        ):
+            with self.subTest(bbox=bbox):
+                response = self.client.get(self.url, {'bbox': bbox})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.data)
+
+
+class NearbyFacilityTests(PharmaConnectTestCase):
+    """Recherche des formations sanitaires autour d'un point (index api.spatial)"""
+
+    url = reverse('healthfacility-nearby')
+
+    def setUp(self):
+        super().setUp()
+        # Vers le nord depuis Yaoundé : environ 11 km par pas de 0,1 degré
+        for number in range(1, 4):
+            HealthFacility.objects.create(
+                name=f'CSI Nord {number}', code=f'NORD{number}', type='CSI', level_of_care='PRIMARY',
+                location='Centre', latitude=3.8667 + number / 10, longitude=11.5167,
+            )
+
+    def test_nearest_first_within_radius(self):
+        response = self.client.get(self.url, {'lat': 3.8667, 'lon': 11.5167, 'radius_km': 25})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['code'] for row in response.data['results']], ['CSI', 'NORD1', 'NORD2'])
+        self.assertAlmostEqual(response.data['results'][1]['distance_km'], 11.1, delta=0.1)
+
+    def test_limit(self):
+        response = self.client.get(self.url, {'lat': 3.8667, 'lon': 11.5167, 'radius_km': 50, 'limit': 2})
+
+        self.assertEqual([row['code'] for row in response.data['results']], ['CSI', 'NORD1'])
+
+    def test_invalid_radius_and_limit_are_rejected(self):
+        for params in (
+            {'radius_km': 'inf'}, {'radius_km': 'nan'}, {'radius_km': '-1'}, {'radius_km': '0'},
+            {'radius_km': '1e12'}, {'radius_km': 501}, {'limit': 0}, {'limit': 501}, {'limit': 'abc'},
+            {'lat': 'nan'}, {'lat': 91},
+        ):
+            with self.subTest(**params):
+                response = self.client.get(self.url, {'lat': 3.8667, 'lon': 11.5167, **params})
+                self.assertEqual(response.status_code, 400)
+
+    def covering(self, lat, lon):
+        response = self.client.get(reverse('healthfacility-covering'), {'lat': lat, 'lon': lon})
+        self.assertEqual(response.status_code, 200)
+        return sorted(row['code'] for row in response.data['results'])
+
+    def create_zone(self, code, polygon=None, radius_km=None):
+        """Formation à 5° N, 12° E ; mise à jour de l'index après validation comme en production"""
+        with self.captureOnCommitCallbacks(execute=True):
+            return HealthFacility.objects.create(
+                name=f'Zone {code}', code=code, type='CSI', level_of_care='PRIMARY', location='Est',
+                latitude=5, longitude=12, coverage_polygon=polygon, coverage_radius_km=radius_km,
+            )
+
+    def test_covering_polygon_with_hole(self):
+        self.covering(0, 0)
+        self.create_zone('POLY', {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [
+            [[11, 4], [13, 4], [13, 6], [11, 6], [11, 4]],
+            [[11.9, 4.9], [12.1, 4.9], [12.1, 5.1], [11.9, 5.1], [11.9, 4.9]],
+        ]}})
+
+        self.assertEqual(self.covering(4.5, 12.5), ['POLY'])
+        self.assertEqual(self.covering(5, 12), [])
+        self.assertEqual(self.covering(6.5, 12), [])
+
+    def test_covering_radius(self):
+        self.facility.coverage_radius_km = 20
+        self.facility.save()
+
+        # NORD1 à 11 km, NORD2 à 22 km
+        self.assertEqual(self.covering(3.9667, 11.5167), ['CSI'])
+        self.assertEqual(self.covering(4.0667, 11.5167), [])
+
+    def test_invalid_geometry_is_ignored(self):
+        self.covering(0, 0)
+        square = [[11, 4], [13, 4], [13, 6], [11, 6]]
+        invalid = {
+            'EMPTY': {'type': 'Polygon', 'coordinates': [[]]},
+            'TEXT': {'type': 'Polygon', 'coordinates': [[['a', 'b'], [13, 4], [13, 6]]]},
+            'SHORT': [[[1]]],
+            'LINE': {'type': 'Polygon', 'coordinates': [[[11, 4], [13, 6]]]},
+            'NAN': {'type': 'Polygon', 'coordinates': [[[11, 4], [13, 'NaN'], [13, 6]]]},
+            'SCALAR': {'type': 'MultiPolygon', 'coordinates': 5},
+        }
+        # Mise à jour incrémentale après validation
+        for code, polygon in invalid.items():
+            self.create_zone(code, polygon)
+        # Polygone invalide : rayon utilisé ; anneau intérieur invalide écarté
+        self.create_zone('RADIUS', [[]], radius_km=50)
+        self.create_zone('MULTI', {'type': 'MultiPolygon', 'coordinates': [[[]], [square, [[12, 5]]]]})
+
+        self.assertEqual(self.covering(5, 12), ['MULTI', 'RADIUS'])
+        # Reconstruction complète de l'index (modification par un autre processus)
+        facility_index.signature = None
+        self.assertEqual(self.covering(5, 12), ['MULTI', 'RADIUS'])
+        self.assertEqual(self.client.get(self.url, {'lat': 5, 'lon': 12, 'radius_km': 1}).data['count'], 8)
+
+
+class MedicationSearchTests(PharmaConnectTestCase):
+    """Autocomplétion des médicaments (index api.search)"""
+
+    url = reverse('medication-search')
+
+    def setUp(self):
+        super().setUp()
+        self.amoxicillin = self.create_medication('AMX500', name='Amoxicilline', dosage='500mg')
+        self.paracetamol = self.create_medication('PCM500', name='Paracétamol', dosage='500mg')
+        self.create_medication('AMX250', name='Amoxicilline', dosage='250mg')
+
+    def search(self, query):
+        response = self.client.get(self.url, {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [row['code'] for row in response.data]
+
+    def test_prefix_without_accents(self):
+        self.assertEqual(self.search('parace'), ['PCM500'])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.search('amox 500'), ['AMX500'])
+
+    def test_typo_falls_back_to_trigrams(self):
+        self.assertIn('PCM500', self.search('paractamol'))
+
+    def test_renamed_medication_is_reindexed(self):
+        self.paracetamol.name = 'Acétaminophène'
+        self.paracetamol.save()
+
+        self.assertEqual(self.search('acetam'), ['PCM500'])
+        self.assertEqual(self.search('parace'), [])
+
+
+class CatalogCacheTests(PharmaConnectTestCase):
+    """Catalogue des médicaments en mémoire (api.catalog) : versions et éviction"""
+
+    url = reverse('stockentry-list')
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('CAT', name='Amoxicilline')
+        self.receive(self.medication, 100)
+
+    def version(self):
+        return get_version(catalog_key(self.organization.id))
+
+    def nested_details(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'][0]['medication_details']
+
+    def test_medication_edit_bumps_version_and_next_read_is_fresh(self):
+        self.assertEqual(self.nested_details()['name'], 'Amoxicilline')
+        version = self.version()
+
+        self.medication.name = 'Amoxicilline 500 mg'
+        self.medication.save()
+
+        self.assertEqual(self.version(), version + 1)
+        self.assertEqual(self.nested_details()['name'], 'Amoxicilline 500 mg')
+
+    def test_category_and_allowed_facilities_edits_are_seen(self):
+        self.nested_details()
+
+        self.category.name = 'Anti-infectieux'
+        self.category.save()
+        self.medication.allowed_facilities.add(self.facility)
+
+        details = self.nested_details()
+        self.assertEqual(details['category_name'], 'Anti-infectieux')
+        self.assertEqual(details['allowed_facilities_names'], [str(self.facility)])
+
+    def test_other_workers_rebuild_after_a_bump(self):
+        # Deux processus : chacun son cache, la version partagée en base
+        worker = CatalogCache()
+        self.assertEqual(worker.get(self.organization.id).get_by_code('CAT')['name'], 'Amoxicilline')
+
+        self.medication.name = 'Amoxicilline sirop'
+        self.medication.save()
+
+        self.assertEqual(worker.get(self.organization.id).get_by_code('CAT')['name'], 'Amoxicilline sirop')
+
+    def test_unchanged_catalog_costs_one_query(self):
+        catalog = get_catalog(self.organization.id)
+
+        with self.assertNumQueries(1):
+            self.assertIs(get_catalog(self.organization.id), catalog)
+
+    def test_bulk_updates_need_an_explicit_invalidation(self):
+        catalog = get_catalog(self.organization.id)
+        # queryset.update ne déclenche pas de signaux
+        Medication.objects.filter(pk=self.medication.pk).update(name='Renommé en masse')
+        self.assertIs(get_catalog(self.organization.id), catalog)
+
+        invalidate_catalog(self.organization.id)
+
+        self.assertEqual(get_catalog(self.organization.id).get_by_code('CAT')['name'], 'Renommé en masse')
+
+    def test_snapshots_are_bounded_least_recently_used_first(self):
+        cache = CatalogCache(max_size=2)
+        first, second, third = (
+            Organization.objects.create(name=f'ONG {number}', code=f'LRU{number}', type='NGO', country='Cameroun')
+            for number in range(3)
+        )
+        cache.get(first.id)
+        cache.get(second.id)
+        cache.get(first.id)
+
+        cache.get(third.id)
+
+        self.assertEqual(list(cache._snapshots), [first.id, third.id])
+        with self.assertNumQueries(1):
+            cache.get(first.id)
+        # Instantané évincé : reconstruit (version et médicaments, aucun à précharger)
+        with self.assertNumQueries(2):
+            cache.get(second.id)
+        self.assertEqual(list(cache._snapshots), [first.id, second.id])
+
+
+class GS1ParsingTests(SimpleTestCase):
+    """Décodage des chaînes d'éléments GS1 (api.gs1)"""
+
+    def test_bare_gtins(self):
+        for code, gtin in (
+            ('96385074', '00000096385074'),         # EAN-8
+            ('036000291452', '00036000291452'),     # UPC-A
+            ('3400930000007', '03400930000007'),    # EAN-13
+            ('03400930000007', '03400930000007'),   # GTIN-14
+            ('13400930000004', '13400930000004'),   # GTIN-14, indicateur de conditionnement 1
+        ):
+            with self.subTest(code=code):
+                self.assertEqual(parse_elements(code), {'01': gtin})
+                self.assertEqual(parse_scan(code).gtin, gtin)
+
+    def test_human_readable(self):
+        self.assertEqual(
+            parse_elements('(01)03400930000007(17)261231(10)LOT42'),
+            {'01': '03400930000007', '17': '261231', '10': 'LOT42'}
+        )
+
+    def test_raw_stream_with_separators(self):
+        # Identifiant de symbologie DataMatrix, éléments variables terminés par GS (FNC1)
+        scan = parse_scan(f']d20103400930000007{GS}10LOT42{GS}1726123121SERIE{GS}')
+
+        self.assertEqual(scan.elements, {'01': '03400930000007', '10': 'LOT42', '17': '261231', '21': 'SERIE'})
+        self.assertEqual((scan.gtin, scan.batch_number, scan.serial_number), ('03400930000007', 'LOT42', 'SERIE'))
+        self.assertEqual(scan.expiry_date, date(2026, 12, 31))
+        # Dernier élément variable sans séparateur
+        self.assertEqual(parse_elements('01134009300000041726123110AB-12')['10'], 'AB-12')
+
+    def test_dates(self):
+        # Jour 00 : dernier jour du mois
+        self.assertEqual(parse_scan('(01)03400930000007(17)240200').expiry_date, date(2024, 2, 29))
+        self.assertIsNone(parse_scan('(01)03400930000007').expiry_date)
+        for code in ('(01)03400930000007(17)261331', '(01)03400930000007(17)2612', '(11)250230'):
+            with self.subTest(code=code), self.assertRaisesMessage(GS1Error, 'Date GS1 invalide'):
+                parse_scan(code)
+
+    def test_unknown_identifier(self):
+        with self.assertRaisesMessage(GS1Error, "Identifiant d'application inconnu en position 16"):
+            parse_elements('01034009300000074712345')
+        with self.assertRaisesMessage(GS1Error, "Identifiant d'application inconnu : (47)"):
+            parse_elements('(01)03400930000007(47)12345')
+
+    def test_malformed_codes(self):
+        for code, message in (
+            ('', 'Code vide'),
+            ('0103400930', 'Élément (01) tronqué'),
+            ('10' + 'X' * 21, 'Élément (10) trop long'),
+            ('(01)03400930000007(1)LOT', 'Chaîne GS1 mal formée'),
+        ):
+            with self.subTest(code=code), self.assertRaisesMessage(GS1Error, message):
+                parse_elements(code)
+        with self.assertRaisesMessage(GS1Error, 'GTIN invalide'):
+            parse_scan('03400930000008')
+
+
+class GS1ScanTests(PharmaConnectTestCase):
+    """Résolution des codes scannés en médicament et lot (StockEntryViewSet.scan)"""
+
+    url = reverse('stockentry-scan')
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('SCN', barcode_gs1='3400930000007')
+        self.lot = self.receive(self.medication, 40, expiry_date=date(2026, 12, 31), batch_number='LOT42')
+
+    def scan(self, code):
+        response = self.client.get(self.url, {'code': code})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_exact_lot(self):
+        data = self.scan(f']d20103400930000007{GS}10LOT42{GS}17261231')
+
+        self.assertEqual((data['status'], data['medication']['code']), ('LOT', 'SCN'))
+        lot, = data['lots']
+        self.assertEqual((lot['id'], lot['quantity_available']), (self.lot.id, 40))
+
+    def test_partial_matches(self):
+        self.assertEqual(self.scan('(01)03400930000007(10)LOT42(17)270131')['status'], 'BATCH')
+        self.assertEqual(self.scan('(01)03400930000007(10)LOT99')['status'], 'MEDICATION')
+        self.assertEqual(self.scan('03400930000007')['status'], 'MEDICATION')
+        self.assertEqual(self.scan('13400930000004')['status'], 'UNKNOWN')
+        data = self.scan('(01)03400930000008')
+        self.assertEqual((data['status'], data['error']), ('INVALID', 'GTIN invalide (clé de contrôle)'))
+
+    def test_code_is_required(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.data)
+
+    def test_batch(self):
+        codes = ['(01)03400930000007(10)LOT42(17)261231', 'illisible', '3400930000007']
+
+        response = self.client.post(reverse('stockentry-scan-batch'), {'codes': codes}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['status'] for row in response.data['results']], ['LOT', 'INVALID', 'MEDICATION'])
+
+
+class FefoAllocationTests(PharmaConnectTestCase):
+    """Répartition des quantités prescrites sur les lots (premier périmé, premier sorti)"""
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('FEFO')
+        today = date.today()
+        self.expired = self.receive(self.medication, 100, expiry_date=today - timedelta(days=1), batch_number='PER')
+        self.late = self.receive(self.medication, 50, expiry_date=today + timedelta(days=300), batch_number='TARD')
+        self.early = self.receive(self.medication, 30, expiry_date=today + timedelta(days=40), batch_number='TOT')
+
+    def available(self, entry):
+        return LotBalance.objects.get(stock_entry=entry).quantity_available
+
+    def test_earliest_expiry_first_and_expired_lots_skipped(self):
+        dispensation = self.create_dispensation()
+
+        items, shortages = dispense_fefo(dispensation, [(self.medication.id, 40)])
+
+        self.assertEqual(shortages, [])
+        self.assertEqual(
+            [(item.stock_entry_id, item.quantity_dispensed) for item in items],
+            [(self.early.id, 30), (self.late.id, 10)]
+        )
+        self.assertEqual((self.available(self.early), self.available(self.late)), (0, 40))
+        self.assertEqual(self.available(self.expired), 100)
+        dispensation.refresh_from_db()
+        self.assertEqual(dispensation.status, 'DELIVERED')
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_repeated_lines_are_merged(self):
+        items, _ = dispense_fefo(self.create_dispensation(), [(self.medication.id, 10), (self.medication.id, 25)])
+
+        self.assertEqual(sum(item.quantity_dispensed for item in items), 35)
+        self.assertEqual(self.available(self.early), 0)
+
+    def test_shortage_writes_nothing(self):
+        dispensation = self.create_dispensation()
+
+        with self.assertRaises(InsufficientStock) as raised:
+            dispense_fefo(dispensation, [(self.medication.id, 81)])
+
+        shortage, = raised.exception.shortages
+        self.assertEqual((shortage.requested, shortage.available), (81, 80))
+        self.assertFalse(DispensationItem.objects.exists())
+        self.assertEqual((self.available(self.early), self.available(self.late)), (30, 50))
+
+    def test_partial_delivery(self):
+        dispensation = self.create_dispensation()
+
+        items, shortages = dispense_fefo(dispensation, [(self.medication.id, 100)], allow_partial=True)
+
+        self.assertEqual(sum(item.quantity_dispensed for item in items), 80)
+        self.assertEqual(shortages[0].available, 80)
+        dispensation.refresh_from_db()
+        self.assertEqual(dispensation.status, 'PARTIAL')
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_allocate_action(self):
+        dispensation = self.create_dispensation()
+        url = reverse('dispensation-allocate', args=[dispensation.pk])
+
+        response = self.client.post(url, {'items': [{'medication': self.medication.id, 'quantity': 5}]}, format='json')
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.available(self.early), 25)
+
+    def stale_allocation(self, *args, **kwargs):
+        """Allocation lue avant qu'une autre dispensation n'entame le lot"""
+        return [Allocation(self.early.id, self.medication.id, 31, self.early.expiry_date, self.early.unit_price)], []
+
+    def test_conflict_is_retried_on_fresh_balances(self):
+        dispensation = self.create_dispensation()
+
+        fresh = allocate_fefo(self.project.id, [(self.medication.id, 31)])
+        with mock.patch('api.dispensing.allocate_fefo', side_effect=[self.stale_allocation(), fresh]) as allocate:
+            items, _ = dispense_fefo(dispensation, [(self.medication.id, 31)])
+
+        self.assertEqual(allocate.call_count, 2)
+        self.assertEqual(sum(item.quantity_dispensed for item in items), 31)
+        self.assertEqual((self.available(self.early), self.available(self.late)), (0, 49))
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_persistent_conflict_raises_after_max_attempts(self):
+        dispensation = self.create_dispensation()
+
+        with mock.patch('api.dispensing.allocate_fefo', side_effect=self.stale_allocation) as allocate:
+            with self.assertRaises(AllocationConflict):
+                dispense_fefo(dispensation, [(self.medication.id, 31)])
+
+        self.assertEqual(allocate.call_count, MAX_ATTEMPTS)
+        self.assertFalse(DispensationItem.objects.exists())
+        self.assertEqual(self.available(self.early), 30)
+        self.assertEqual(ledger.verify_balances(), [])
+
+
+
+class BulkDispensationTests(PharmaConnectTestCase):
+    """Enregistrement groupé : un résultat par dispensation, 207 si partiel"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('dispensation-bulk')
+        self.medication = self.create_medication('BULK')
+        self.lot = self.receive(self.medication, 20, batch_number='B1')
+
+    def record(self, quantity, **item):
+        return {
+            'prescription_photo': self.photo.id, 'destination': 'PATIENT', 'organization': self.organization.id,
+            'project': self.project.id, 'items': [{'medication': self.medication.id, 'quantity': quantity, **item}],
+        }
+
+    def post(self, records, **options):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, {'dispensations': records, **options}, format='json')
+
+    def available(self):
+        return LotBalance.objects.get(stock_entry=self.lot).quantity_available
+
+    def test_all_created(self):
+        response = self.post([self.record(5), self.record(3, stock_entry=self.lot.id)])
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual((response.data['created'], response.data['rejected']), (2, 0))
+        self.assertEqual(self.available(), 12)
+        self.assertEqual(Dispensation.objects.filter(status='DELIVERED').count(), 2)
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_partial_batch_returns_multi_status(self):
+        invalid = self.record(1)
+        invalid['items'] = []
+
+        response = self.post([self.record(5), invalid, self.record(50)])
+
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual((response.data['created'], response.data['rejected']), (1, 2))
+        created, rejected_input, rejected_stock = response.data['results']
+        self.assertEqual(
+            (created['index'], created['result'], created['status'], created['items']), (0, 'created', 'DELIVERED', 1)
+        )
+        self.assertEqual(Dispensation.objects.get().pk, created['id'])
+        self.assertEqual((rejected_input['index'], rejected_input['result']), (1, 'rejected'))
+        self.assertIn('items', rejected_input['errors'])
+        self.assertEqual((rejected_stock['index'], rejected_stock['result']), (2, 'rejected'))
+        self.assertEqual(
+            rejected_stock['shortages'], [{'medication_id': self.medication.id, 'requested': 50, 'available': 15}]
+        )
+        self.assertEqual(self.available(), 15)
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_all_or_nothing_rolls_back_on_stock_rejection(self):
+        response = self.post([self.record(5), self.record(50)], all_or_nothing=True)
+
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual([result['result'] for result in response.data['results']], ['not_created', 'rejected'])
+        self.assertFalse(Dispensation.objects.exists())
+        self.assertFalse(DispensationItem.objects.exists())
+        self.assertEqual(self.available(), 20)
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_all_or_nothing_skips_writes_on_invalid_input(self):
+        with self.assertNumQueries(0):
+            response = self.client.post(
+                self.url, {'dispensations': [self.record(5), {'items': []}], 'all_or_nothing': True}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual([result['result'] for result in response.data['results']], ['not_created', 'rejected'])
+        self.assertEqual(self.available(), 20)
+
+    def test_unknown_project_is_rejected(self):
+        invalid = self.record(5)
+        invalid['project'] = self.project.id + 1000
+
+        response = self.post([invalid])
+
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertIn('project', response.data['results'][0]['errors'])
+        self.assertFalse(Dispensation.objects.exists())
+
+
+
+class KeysetPaginationTests(PharmaConnectTestCase):
+    """Pagination par curseur des entrées en stock (tri départagé par l'id)"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('stockentry-list')
+        medication = self.create_medication('PAGE')
+        today = date.today()
+        # Dates de livraison répétées : l'id départage les égalités
+        self.entries = [
+            self.receive(
+                medication, 10, delivery_date=today - timedelta(days=number % 7),
+                expiry_date=today + timedelta(days=100 + number), batch_number=f'P{number:02}',
+            )
+            for number in range(23)
+        ]
+
+    def walk(self, url, link='next', **params):
+        """Identifiants de toutes les pages en suivant les liens `link`"""
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200, response.data)
+            pages.append([row['id'] for row in response.data['results']])
+            if not response.data[link]:
+                return pages, response
+            response = self.client.get(response.data[link])
+
+    def test_walk_forward_then_back(self):
+        expected = [
+            entry.id for entry in sorted(self.entries, key=lambda entry: (entry.delivery_date, entry.id), reverse=True)
+        ]
+
+        pages, last = self.walk(self.url, page_size=5)
+
+        self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 3])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertNotIn('count', last.data)
+        self.assertIsNone(last.data['next'])
+
+        back, first = self.walk(last.data['previous'], link='previous')
+        self.assertEqual(back, pages[-2::-1])
+        self.assertIsNone(first.data['previous'])
+
+    def test_view_ordering_is_followed(self):
+        pages, _ = self.walk(self.url, page_size=10, ordering='expiry_date')
+
+        self.assertEqual(sum(pages, []), [entry.id for entry in self.entries])
+
+    def test_deep_pages_cost_the_same(self):
+        response = self.client.get(self.url, {'page_size': 2})
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'page_size': 2})
+        for _ in range(8):
+            response = self.client.get(response.data['next'])
+        with self.assertNumQueries(2):
+            self.client.get(response.data['next'])
+
+    def test_count_on_request(self):
+        response = self.client.get(self.url, {'page_size': 5, 'with_count': 'true'})
+
+        self.assertEqual((response.data['count'], response.data['count_is_exact']), (23, True))
+
+    def test_invalid_cursors(self):
+        other_ordering = self.client.get(self.url, {'page_size': 5, 'ordering': 'expiry_date'}).data['next']
+        cursor = other_ordering.split('cursor=')[1].split('&')[0]
+
+        # Structure valide, valeurs altérées : date ou id non convertibles, valeur nulle
+        ordering = ['-delivery_date', '-id']
+        tampered = [
+            base64.urlsafe_b64encode(json.dumps({'v': values, 'o': ordering}).encode()).decode('ascii')
+            for values in (['2024-01-01', 'garbage'], ['pas-une-date', 1], [None, 1], ['2024-01-01', [1]], 'ab')
+        ]
+
+        for value in ('pas-un-curseur', 'e30=', 'W10=', cursor, *tampered):
+            with self.subTest(cursor=value):
+                response = self.client.get(self.url, {'cursor': value})
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(response.data['detail'], 'Curseur invalide')
+
+    def test_page_number_clients_keep_legacy_pagination(self):
+        response = self.client.get(self.url, {'page': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['count'], len(response.data['results'])), (23, 23))
+
+
+class SparseFieldsTests(PharmaConnectTestCase):
+    """Forme des réponses choisie par le client (?fields=, ?expand=) et requêtes adaptées"""
+
+    def setUp(self):
+        super().setUp()
+        self.medication = self.create_medication('SPARSE')
+        self.entry = self.receive(self.medication, 10, batch_number='L1', supplier='Fournisseur')
+        self.dispensation = self.create_dispensation()
+        DispensationItem.objects.create(
+            dispensation=self.dispensation, medication=self.medication, stock_entry=self.entry, quantity_dispensed=2
+        )
+
+    def get(self, basename, params, queries):
+        """Première ligne et requête principale de la liste, catalogue déjà chargé"""
+        url = reverse(f'{basename}-list')
+        self.client.get(url, params)
+        with self.assertNumQueries(queries), CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'][0], context.captured_queries[0]['sql']
+
+    def test_fields_restrict_keys_and_columns(self):
+        full, full_sql = self.get('stockentry', {}, 2)
+        row, sql = self.get('stockentry', {'fields': 'id,batch_number,quantity_available'}, 1)
+
+        self.assertEqual(row, {'id': self.entry.id, 'batch_number': 'L1', 'quantity_available': 8})
+        self.assertIn('"api_stockentry"."supplier"', full_sql)
+        self.assertEqual(full['supplier'], 'Fournisseur')
+        # Seules les colonnes lues (et celles du tri) sont sélectionnées, le solde par jointure
+        self.assertNotIn('"api_stockentry"."supplier"', sql)
+        self.assertNotIn('"api_stockentry"."expiry_date"', sql)
+        self.assertIn('"api_lotbalance"."quantity_available"', sql)
+
+    def test_dotted_paths_restrict_nested_objects(self):
+        row, sql = self.get('stockentry', {'fields': 'id,medication_details.name'}, 2)
+
+        self.assertEqual(row, {'id': self.entry.id, 'medication_details': {'name': 'Médicament SPARSE'}})
+        self.assertIn('"api_stockentry"."medication_id"', sql)
+        self.assertNotIn('JOIN', sql)
+
+        row, _ = self.get('dispensation', {'fields': 'id,items.quantity_dispensed'}, 2)
+
+        self.assertEqual(row, {'id': self.dispensation.id, 'items': [{'quantity_dispensed': 2}]})
+
+    def test_expand_controls_nested_objects(self):
+        full, _ = self.get('dispensation', {}, 3)
+        self.assertIn('medication_details', full['items'][0])
+
+        # Articles sans détails du médicament : catalogue non consulté
+        row, _ = self.get('dispensation', {'expand': 'items'}, 2)
+        self.assertEqual(row['items'][0]['quantity_dispensed'], 2)
+        self.assertNotIn('medication_details', row['items'][0])
+
+        # ?expand= vide : aucun objet imbriqué, articles non préchargés
+        row, _ = self.get('dispensation', {'expand': ''}, 1)
+        self.assertNotIn('items', row)
+        self.assertEqual(row['project_name'], 'Projet')
+
+        row, _ = self.get('dispensation', {'expand': 'items.medication_details'}, 3)
+        self.assertEqual(row['items'][0]['medication_details']['code'], 'SPARSE')
+
+    def test_unknown_fields_are_ignored(self):
+        row, _ = self.get('stockentry', {'fields': 'id,inexistant,medication_details'}, 2)
+        self.assertEqual(set(row), {'id', 'medication_details'})
+
+        # Aucun champ connu : lignes vides, seules les colonnes du curseur sont lues
+        row, sql = self.get('stockentry', {'fields': 'inexistant'}, 1)
+        self.assertEqual(row, {})
+        self.assertNotIn('"api_stockentry"."batch_number"', sql)
+
+    def test_retrieve_follows_fields(self):
+        response = self.client.get(
+            reverse('stockentry-detail', args=[self.entry.id]), {'fields': 'id,project_name'}
+        )
+
+        self.assertEqual(response.data, {'id': self.entry.id, 'project_name': 'Projet'})
+
+
+class SideLoadTests(PharmaConnectTestCase):
+    """Médicaments regroupés dans `included` (?include=medications)"""
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('stockentry-list')
+        self.first, self.second = self.create_medication('SIDE1'), self.create_medication('SIDE2')
+        today = date.today()
+        # Lots du plus récent au plus ancien : first, second, first, second, first
+        self.entries = [
+            self.receive(
+                medication, 10, batch_number=f'S{number}', delivery_date=today - timedelta(days=number)
+            )
+            for number, medication in enumerate([self.first, self.second] * 2 + [self.first])
+        ]
+
+    def details(self):
+        """medication_details rendus ligne par ligne, par identifiant"""
+        rows = self.client.get(self.url).data['results']
+        return {str(row['medication']): row['medication_details'] for row in rows}
+
+    def test_each_medication_is_included_once(self):
+        expected = self.details()
+        self.client.get(self.url, {'include': 'medications'})
+        # Lots, version du catalogue et organisation des médicaments de la page
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'include': 'medications'})
+
+        rows = response.data['results']
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all('medication_details' not in row for row in rows))
+        self.assertEqual([row['medication'] for row in rows], [entry.medication_id for entry in self.entries])
+        self.assertEqual(response.data['included'], {'medications': expected})
+        self.assertEqual(set(expected), {str(self.first.id), str(self.second.id)})
+
+    def test_included_follows_the_page(self):
+        response = self.client.get(self.url, {'include': 'medications', 'page_size': 1})
+        self.assertEqual(set(response.data['included']['medications']), {str(self.first.id)})
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['id'], self.entries[1].id)
+        self.assertEqual(set(response.data['included']['medications']), {str(self.second.id)})
+
+        response = self.client.get(self.url, {'include': 'medications', 'page_size': 3})
+        self.assertEqual(set(response.data['included']['medications']), {str(self.first.id), str(self.second.id)})
+
+        # Pagination par numéro de page
+        response = self.client.get(self.url, {'include': 'medications', 'page': 1})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(len(response.data['included']['medications']), 2)
+
+    def test_nested_items_are_side_loaded(self):
+        dispensation = self.create_dispensation()
+        for entry in self.entries[:2]:
+            DispensationItem.objects.create(
+                dispensation=dispensation, medication=entry.medication, stock_entry=entry, quantity_dispensed=1
+            )
+
+        response = self.client.get(reverse('dispensation-list'), {'include': 'medications'})
+
+        items = response.data['results'][0]['items']
+        self.assertEqual([item['medication'] for item in items], [self.first.id, self.second.id])
+        self.assertTrue(all('medication_details' not in item for item in items))
+        self.assertEqual(response.data['included']['medications'], self.details())
+
+    def test_combined_with_fields(self):
+        response = self.client.get(self.url, {'include': 'medications', 'fields': 'id,medication', 'page_size': 2})
+
+        self.assertEqual(response.data['results'][0], {'id': self.entries[0].id, 'medication': self.first.id})
+        self.assertEqual(len(response.data['included']['medications']), 2)
+
+    def test_only_known_includes_on_lists(self):
+        response = self.client.get(self.url, {'include': 'inexistant'})
+        self.assertNotIn('included', response.data)
+        self.assertIn('medication_details', response.data['results'][0])
+
+        response = self.client.get(reverse('stockentry-detail', args=[self.entries[0].id]), {'include': 'medications'})
+        self.assertIn('medication_details', response.data)
+        self.assertNotIn('included', response.data)
+
+
+class InventoryImportTests(PharmaConnectTestCase):
+    """Import des feuilles de comptage CSV et XLSX : rapport par ligne, écarts au grand livre"""
+
+    def setUp(self):
+        super().setUp()
+        self.amoxicillin = self.create_medication('AMX')
+        self.paracetamol = self.create_medication('PCM')
+        self.lot = self.receive(self.amoxicillin, 40, batch_number='L1', expiry_date=date(2030, 6, 30))
+        self.receive(self.paracetamol, 25)
+        self.inventory = Inventory.objects.create(
+            organization=self.organization, project=self.project, inventory_date=date.today(),
+            month=date.today().month, year=date.today().year, created_by=self.user,
+        )
+        self.url = reverse('inventory-import-items', args=[self.inventory.pk])
+
+    def upload(self, name, content, **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, {'file': SimpleUploadedFile(name, content), **data})
+
+    def csv_sheet(self, *rows):
+        lines = ['Code médicament;N° lot;Quantité comptée;Date péremption', *rows]
+        return '\r\n'.join(lines).encode('latin-1')
+
+    def xlsx_sheet(self, *rows):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(['code', 'batch_number', 'physical_stock', 'expiry_date'])
+        for row in rows:
+            sheet.append(row)
+        content = io.BytesIO()
+        workbook.save(content)
+        return content.getvalue()
+
+    def available(self, medication):
+        return StockBalance.objects.get(medication=medication).quantity_available
+
+    def test_csv_rows_are_reported_one_by_one(self):
+        response = self.upload('comptage.csv', self.csv_sheet(
+            'AMX;L1;35;30/06/2030',
+            'PCM;;27;',
+            'INCONNU;;5;',
+            'PCM;;-3;',
+            'AMX;L9;5;',
+            'AMX;L1;34;',
+            'PCM;;2;31/02/2030',
+            ';;;',
+            'PCM;;1,5;',
+        ))
+
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual((response.data['created'], response.data['rejected']), (2, 6))
+        self.assertFalse(response.data['errors_truncated'])
+        errors = {row['row']: row['errors'] for row in response.data['errors']}
+        self.assertEqual(sorted(errors), [4, 5, 6, 7, 8, 10])
+        self.assertEqual(errors[4], {'code': ['Médicament inconnu : INCONNU']})
+        self.assertEqual(list(errors[5]), ['physical_stock'])
+        self.assertEqual(errors[6], {'batch_number': ['Lot introuvable pour ce médicament : L9']})
+        self.assertEqual(errors[7], {'non_field_errors': ['Article déjà compté ligne 2.']})
+        self.assertEqual(list(errors[8]), ['expiry_date'])
+        self.assertEqual(list(errors[10]), ['physical_stock'])
+
+        item = InventoryItem.objects.get(stock_entry=self.lot)
+        self.assertEqual((item.theoretical_stock, item.physical_stock), (40, 35))
+        self.assertEqual(LotBalance.objects.get(stock_entry=self.lot).quantity_available, 35)
+        # Article sans lot : stock théorique lu dans StockBalance, sans effet sur les soldes
+        item = InventoryItem.objects.get(medication=self.paracetamol)
+        self.assertEqual((item.theoretical_stock, item.physical_stock), (25, 27))
+        self.assertEqual((self.available(self.amoxicillin), self.available(self.paracetamol)), (35, 25))
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_variances_are_applied_per_lot(self):
+        lots = [self.receive(self.amoxicillin, 20, batch_number=f'V{number}') for number in range(4)]
+
+        response = self.upload('comptage.csv', self.csv_sheet('AMX;V0;18;', 'AMX;V1;18;', 'AMX;V2;23;', 'AMX;V3;20;'))
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(
+            [LotBalance.objects.get(stock_entry=lot).quantity_available for lot in lots], [18, 18, 23, 20]
+        )
+        self.assertEqual(self.available(self.amoxicillin), 40 + 79)
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_rows_already_in_the_inventory_are_rejected(self):
+        self.upload('comptage.csv', self.csv_sheet('PCM;;27;'))
+
+        response = self.upload('comptage.csv', self.csv_sheet('PCM;;20;', 'AMX;L1;40;'))
+
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual(response.data['errors'], [
+            {'row': 2, 'errors': {'non_field_errors': ["Article déjà saisi dans l'inventaire."]}}
+        ])
+        self.assertEqual(InventoryItem.objects.get(medication=self.paracetamol).physical_stock, 27)
+
+    def test_all_or_nothing_rolls_back(self):
+        response = self.upload(
+            'comptage.csv', self.csv_sheet('AMX;L1;35;', 'PCM;;27;', 'INCONNU;;5;'), all_or_nothing='true'
+        )
+
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual(
+            (response.data['created'], response.data['not_created'], response.data['rejected']), (0, 2, 1)
+        )
+        self.assertFalse(InventoryItem.objects.exists())
+        self.assertEqual((self.available(self.amoxicillin), self.available(self.paracetamol)), (40, 25))
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_ambiguous_batch_needs_expiry_date(self):
+        other = self.receive(self.amoxicillin, 10, batch_number='L1', expiry_date=date(2031, 1, 31))
+
+        response = self.upload('comptage.csv', self.csv_sheet('AMX;L1;8;', 'AMX;L1;9;31/01/2031'))
+
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual(
+            response.data['errors'],
+            [{'row': 2, 'errors': {'batch_number': ['Lot ambigu : préciser la date de péremption.']}}]
+        )
+        self.assertEqual(InventoryItem.objects.get().stock_entry, other)
+
+    @skipIf(openpyxl is None, "openpyxl non installé")
+    def test_xlsx_cells_keep_their_types(self):
+        response = self.upload('comptage.xlsx', self.xlsx_sheet(
+            ['AMX', 'L1', 38, datetime(2030, 6, 30)],
+            ['PCM', None, 20.0, None],
+            ['PCM', None, 'beaucoup', None],
+            [None, None, None, None],
+            ['AMX', 'L1', 1, 'pas une date'],
+        ))
+
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual((response.data['created'], response.data['rejected']), (2, 2))
+        self.assertEqual([row['row'] for row in response.data['errors']], [4, 6])
+        self.assertEqual(list(response.data['errors'][0]['errors']), ['physical_stock'])
+        self.assertEqual(list(response.data['errors'][1]['errors']), ['expiry_date'])
+        self.assertEqual(InventoryItem.objects.get(medication=self.paracetamol).physical_stock, 20)
+        self.assertEqual(self.available(self.amoxicillin), 38)
+        self.assertEqual(ledger.verify_balances(), [])
+
+    def test_unreadable_files(self):
+        cases = [
+            ('comptage.pdf', b'%PDF', 'Format non pris en charge (CSV ou XLSX)'),
+            ('comptage.xlsx', b'pas un classeur', 'Fichier XLSX illisible'),
+            ('comptage.csv', b'code;lot\r\nAMX;L1', 'Colonnes obligatoires absentes : physical_stock'),
+            ('comptage.csv', self.csv_sheet(), 'Aucun article dans la feuille'),
+        ]
+        for name, content, error in cases:
+            with self.subTest(name=name, error=error):
+                response = self.upload(name, content)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data['error'], error)
+        self.assertEqual(self.client.post(self.url, {}).status_code, 400)
+        self.assertFalse(InventoryItem.objects.exists())
+
+
+class InventoryAnalysisTests(PharmaConnectTestCase):
+    """Analyse des écarts d'un inventaire : agrégat en une requête, articles en écart"""
+
+    def setUp(self):
+        super().setUp()
+        amoxicillin = self.create_medication('AMX', unit_price=Decimal('2.00'))
+        paracetamol = self.create_medication('PCM', unit_price=Decimal('5.00'))
+        lot = self.receive(amoxicillin, 100, unit_price=Decimal('1.50'))
+        self.inventory = Inventory.objects.create(
+            organization=self.organization, project=self.project, inventory_date=date.today(),
+            month=date.today().month, year=date.today().year, created_by=self.user,
+        )
+        # (médicament, lot, théorique, physique) : manquant valorisé au prix du lot,
+        # article sans écart, excédent puis manquant au prix du médicament
+        self.items = [
+            InventoryItem.objects.create(
+                inventory=self.inventory, medication=medication, stock_entry=stock_entry,
+                theoretical_stock=theoretical, physical_stock=physical,
+            )
+            for medication, stock_entry, theoretical, physical in [
+                (amoxicillin, lot, 100, 90),
+                (amoxicillin, lot, 50, 50),
+                (paracetamol, None, 20, 25),
+                (paracetamol, None, 8, 0),
+            ]
+        ]
+        self.url = reverse('inventory-analysis', args=[self.inventory.pk])
+
+    def test_totals(self):
+        data = analyze_items(InventoryItem.objects.filter(inventory=self.inventory))
+
+        self.assertEqual(data, {
+            'total_items': 4,
+            'positive_variances': 2,
+            'negative_variances': 1,
+            'positive_variance_percentage': 50.0,
+            'negative_variance_percentage': 25.0,
+            'total_variance': 13,
+            'variance_value': Decimal('30.00'),
+            'shortage_value': Decimal('55.00'),
+            'surplus_value': Decimal('25.00'),
+        })
+        self.assertEqual(data['total_variance'], sum(item.variance for item in self.items))
+
+    def test_empty_inventory(self):
+        data = analyze_items(InventoryItem.objects.none())
+
+        self.assertEqual((data['total_items'], data['total_variance'], data['variance_value']), (0, 0, 0))
+        self.assertEqual(data['positive_variance_percentage'], 0)
+
+    def test_figures_only(self):
+        # Inventaire et agrégat
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {'items': 'false'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['variance_value'], Decimal('30.00'))
+        self.assertNotIn('items_with_variance', response.data)
+
+    def test_items_with_variance(self):
+        self.client.get(self.url)
+        # Inventaire, agrégat, articles en écart et version du catalogue
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+
+        rows = response.data['items_with_variance']
+        expected = [self.items[0], self.items[2], self.items[3]]
+        self.assertEqual([row['id'] for row in rows], [item.id for item in expected])
+        self.assertEqual([row['variance'] for row in rows], [item.variance for item in expected])
+        self.assertEqual(rows[0]['medication_details']['code'], 'AMX')
+        self.assertEqual(response.data['shortage_value'], Decimal('55.00'))
+
+    def test_stream(self):
+        expected = self.client.get(self.url).data
+
+        # Inventaire, agrégat, version du catalogue et lecture des lignes par lots
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'stream': 'true'})
+            data = json.loads(b''.join(response.streaming_content))
+
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(data['total_variance'], expected['total_variance'])
+        self.assertEqual(float(data['variance_value']), 30.0)
+        rows = data['items_with_variance']
+        self.assertEqual([row['id'] for row in rows], [row['id'] for row in expected['items_with_variance']])
+        self.assertEqual(
+            [(row['medication_code'], row['variance'], float(row['unit_price']), float(row['variance_value']))
+             for row in rows],
+            [('AMX', 10, 1.5, 15.0), ('PCM', -5, 5.0, -25.0), ('PCM', 8, 5.0, 40.0)]
+        )
+        self.assertEqual([row['variance_percentage'] for row in rows], [10 / 90 * 100, -20.0, 0])
+
+@override_settings(ANALYTICS_CACHES=['analytics'])
+class ConcurrentDispensationTests(TransactionTestCase):
+    """
+    Dispensations FEFO simultanées sur des lots partagés : chaque fil a sa
+    connexion et ses transactions validées réellement. SQLite sérialise les
+    écritures (base verrouillée) : les tentatives sont rejouées comme le
+    ferait un client.
+    """
+
+    THREADS = 4
+    PER_THREAD = 10
+
+    def setUp(self):
+        reset_process_caches()
+        create_reference_data(self)
+        self.medication = Medication.objects.create(
+            code='CONC', name='Médicament partagé', organization=self.organization, category=self.category,
+            form='Comprimé', packaging='Boîte de 100',
+        )
+        # 30 unités sur trois lots pour 40 demandées
+        for number, quantity in enumerate((12, 10, 8)):
+            StockEntry.objects.create(
+                organization=self.organization, project=self.project, medication=self.medication,
+                delivery_date=date.today(), quantity_delivered=quantity,
+                expiry_date=date.today() + timedelta(days=60 * (number + 1)), batch_number=f'C{number}',
+            )
+
+    def dispense_one(self):
+        dispensation = None
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            try:
+                if dispensation is None:
+                    dispensation = Dispensation.objects.create(
+                        prescription_photo=self.photo, destination='PATIENT', organization=self.organization,
+                        project=self.project, created_by=self.user,
+                    )
+                elif dispensation.items.exists():
+                    # Erreur levée après validation : la sortie est acquise
+                    return 'servie'
+                dispense_fefo(dispensation, [(self.medication.id, 1)])
+                return 'servie'
+            except InsufficientStock:
+                return 'rupture'
+            except (OperationalError, AllocationConflict):
+                # Attente aléatoire : les verrous de table partagés n'attendent pas
+                time.sleep(random.uniform(0.001, 0.01))
+        raise AssertionError("Base toujours verrouillée après 60 s")
+
+    def test_concurrent_dispensations_keep_balances_exact(self):
+        outcomes = []
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(self.PER_THREAD):
+                    outcomes.append(self.dispense_one())
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual((outcomes.count('servie'), outcomes.count('rupture')), (30, 10))
+        dispensed = DispensationItem.objects.filter(medication=self.medication).values_list('quantity_dispensed', flat=True)
+        self.assertEqual(sum(dispensed), 30)
+        self.assertFalse(LotBalance.objects.filter(quantity_available__lt=0).exists())
+        self.assertEqual(set(LotBalance.objects.values_list('quantity_available', flat=True)), {0})
+        self.assertEqual(ledger.verify_balances(), [])
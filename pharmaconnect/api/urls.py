@@ -31,6 +31,7 @@ urlpatterns = [
     # Analyses avancées
     path('analytics/stock-summary/', views.stock_summary, name='stock_summary'),
     path('analytics/pharmacoepidemio/', views.pharmacoepidemio_analysis, name='pharmacoepidemio_analysis'),
+    path('analytics/cache-stats/', views.analytics_cache_stats, name='analytics_cache_stats'),
     
     # Inclure toutes les routes du router
     path('', include(router.urls)),
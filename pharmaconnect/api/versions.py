@@ -0,0 +1,23 @@
+"""
+Compteurs de version des données servant à invalider les caches en mémoire
+des différents processus : chaque modification incrémente la version de sa
+clé, les caches comparent la version lue à celle de leur copie.
+"""
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DataVersion
+
+
+def get_version(key):
+    return DataVersion.objects.filter(key=key).values_list('version', flat=True).first() or 0
+
+
+def bump_version(key):
+    """Incrémente la version de la clé (créée au besoin)"""
+    versions = DataVersion.objects.filter(key=key)
+    if versions.update(version=F('version') + 1, updated_at=timezone.now()):
+        return
+    _, created = DataVersion.objects.get_or_create(key=key, defaults={'version': 1})
+    if not created:
+        versions.update(version=F('version') + 1, updated_at=timezone.now())
@@ -1,20 +1,27 @@
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.authtoken.models import Token
+from rest_framework.utils.encoders import JSONEncoder
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth import login
-from django.db.models import Q, Sum, Count, Avg, F
+from django.http import StreamingHttpResponse, HttpResponseNotModified
+from django.db.models import Q, Sum, Count, Avg, F, Max
 from django.db.models.functions import Coalesce
 from datetime import datetime, timedelta
 from decimal import Decimal
+import csv
+import hashlib
+import itertools
+import json
+import math
 
 from .models import (
     User, Organization, Donor, HealthFacility, HealthFacilityDistributor, Project, MedicationCategory,
-    Medication, StandardList, MedicationSubstitution, StockEntry,
+    Medication, StandardList, MedicationSubstitution, StockEntry, LotBalance,
     PrescriptionPhoto, Dispensation, DispensationItem, Inventory,
-    InventoryItem, ConsumptionData, StockoutPeriod, Alert
+    InventoryItem, ConsumptionData, StockoutPeriod, Alert, DispensationDailyFact
 )
 from .serializers import (
     UserSerializer, UserCreateSerializer, LoginSerializer, OrganizationSerializer,
@@ -25,8 +32,47 @@ from .serializers import (
     InventorySerializer, InventoryItemSerializer, ConsumptionDataSerializer,
     StockoutPeriodSerializer, AlertSerializer, StockSummarySerializer,
     ConsumptionAnalysisSerializer, ReceptionReportSerializer,
-    PharmacoepidemioAnalysisSerializer
+    PharmacoepidemioAnalysisSerializer, DispensationAllocationSerializer, BulkDispensationSerializer
 )
+from .consumption import compute_cmm, DEFAULT_WINDOWS
+from .orders import propose_order, coverage_months, CSV_COLUMNS as ORDER_CSV_COLUMNS, MAX_CMM_MONTHS
+from .stock_status import evaluate_stock_status, STOCKOUT, PRE_STOCKOUT
+from .spatial import get_facility_index
+from .search import search_medication_ids, fold, MIN_PREFIX
+from .catalog import get_catalog
+from .scans import resolve_scans
+from .pagination import KeysetPagination
+from .fieldsets import SparseFieldsViewSetMixin
+from .analytics_cache import cached_analytics, cache_metrics, STOCK, DISPENSATIONS, ALERTS
+from .inventory_analysis import analyze_items, variance_rows
+from .inventory_import import import_count_sheet, ImportFormatError
+from .dispensation_facts import (
+    filter_days, antibiotic_distribution, weekly_antibiotic_series, UNDER_FIVE, ANTIBIOTIC_FACTS,
+    MULTITHERAPY_FACTS
+)
+from .dispensing import dispense_fefo, create_dispensations, InsufficientStock, AllocationConflict
+
+
+MAX_SCANS_PER_BATCH = 1000
+MAX_DISPENSATIONS_PER_BATCH = 200
+MAX_NEARBY_RADIUS_KM = 500
+MAX_NEARBY_LIMIT = 500
+
+
+class _Echo:
+    """Pseudo-fichier renvoyant chaque ligne écrite par csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(header, rows, filename):
+    """Réponse CSV diffusée ligne par ligne"""
+    writer = csv.writer(_Echo(), delimiter=';')
+    content = itertools.chain([writer.writerow(header)], (writer.writerow(row) for row in rows))
+    response = StreamingHttpResponse(content, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 
 @api_view(['POST'])
@@ -72,7 +118,7 @@ def logout_view(request):
                        status=status.HTTP_400_BAD_REQUEST)
 
 
-class OrganizationViewSet(viewsets.ModelViewSet):
+class OrganizationViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les organisations"""
     queryset = Organization.objects.all()
     serializer_class = OrganizationSerializer
@@ -98,7 +144,9 @@ class OrganizationViewSet(viewsets.ModelViewSet):
     def users(self, request, pk=None):
         """Obtenir les utilisateurs d'une organisation"""
         organization = self.get_object()
-        users = User.objects.filter(organization=organization)
+        users = User.objects.filter(organization=organization).select_related(
+            'organization', 'health_facility'
+        )
         serializer = UserSerializer(users, many=True)
         return Response(serializer.data)
 
@@ -106,12 +154,14 @@ class OrganizationViewSet(viewsets.ModelViewSet):
     def projects(self, request, pk=None):
         """Obtenir les projets d'une organisation"""
         organization = self.get_object()
-        projects = Project.objects.filter(organization=organization)
+        projects = Project.objects.filter(organization=organization).select_related(
+            'organization', 'donor', 'health_facility'
+        )
         serializer = ProjectSerializer(projects, many=True)
         return Response(serializer.data)
 
 
-class DonorViewSet(viewsets.ModelViewSet):
+class DonorViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les bailleurs"""
     queryset = Donor.objects.all()
     serializer_class = DonorSerializer
@@ -122,9 +172,11 @@ class DonorViewSet(viewsets.ModelViewSet):
     ordering = ['name']
 
 
-class HealthFacilityViewSet(viewsets.ModelViewSet):
+class HealthFacilityViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les formations sanitaires"""
-    queryset = HealthFacility.objects.all()
+    queryset = HealthFacility.objects.annotate(
+        active_distributors_count=Count('distributors', filter=Q(distributors__is_active=True))
+    )
     serializer_class = HealthFacilitySerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, DjangoFilterBackend, filters.OrderingFilter]
@@ -140,7 +192,7 @@ class HealthFacilityViewSet(viewsets.ModelViewSet):
         distributors = HealthFacilityDistributor.objects.filter(
             health_facility=health_facility,
             is_active=True
-        ).select_related('user')
+        ).select_related('user', 'health_facility', 'assigned_by')
         
         serializer = HealthFacilityDistributorSerializer(distributors, many=True)
         return Response(serializer.data)
@@ -159,8 +211,131 @@ class HealthFacilityViewSet(viewsets.ModelViewSet):
             'results': serializer.data
         })
 
+    @action(detail=False, methods=['get'])
+    def geojson(self, request):
+        """
+        Carte des formations sanitaires en GeoJSON (FeatureCollection diffusée).
+        
+        Filtre optionnel ?bbox=lon_min,lat_min,lon_max,lat_max (bornes finies,
+        minimums inférieurs aux maximums) ; l'ETag permet aux clients de
+        revalider leur copie (304 Not Modified).
+        """
+        facilities = self.filter_queryset(HealthFacility.objects.all()).filter(
+            latitude__isnull=False,
+            longitude__isnull=False
+        )
+        
+        bbox = request.query_params.get('bbox')
+        if bbox:
+            try:
+                lon_min, lat_min, lon_max, lat_max = (Decimal(value) for value in bbox.split(','))
+                # NaN : comparaison refusée (InvalidOperation) ; infinis hors bornes
+                if not (-180 <= lon_min <= lon_max <= 180 and -90 <= lat_min <= lat_max <= 90):
+                    raise ValueError
+            except (ValueError, ArithmeticError):
+                return Response(
+                    {'error': 'bbox attendu sous la forme lon_min,lat_min,lon_max,lat_max'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            facilities = facilities.filter(
+                longitude__gte=lon_min, longitude__lte=lon_max,
+                latitude__gte=lat_min, latitude__lte=lat_max
+            )
+        
+        # ETag fort : nombre de lignes et dernière modification du périmètre demandé
+        state = facilities.order_by().aggregate(total=Count('id'), last_update=Max('updated_at'))
+        signature = f"{state['total']}:{state['last_update']}:{request.GET.urlencode()}"
+        etag = '"%s"' % hashlib.sha1(signature.encode()).hexdigest()
+        if etag in [value.strip() for value in request.headers.get('If-None-Match', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        
+        rows = facilities.values_list('id', 'name', 'type', 'latitude', 'longitude')
+        
+        def features():
+            yield '{"type": "FeatureCollection", "features": ['
+            for index, (facility_id, name, facility_type, latitude, longitude) in enumerate(rows.iterator()):
+                feature = json.dumps({
+                    'type': 'Feature',
+                    'id': facility_id,
+                    'geometry': {'type': 'Point', 'coordinates': [float(longitude), float(latitude)]},
+                    'properties': {'id': facility_id, 'name': name, 'type': facility_type}
+                }, ensure_ascii=False)
+                yield feature if index == 0 else ',' + feature
+            yield ']}'
+        
+        response = StreamingHttpResponse(features(), content_type='application/geo+json')
+        response['ETag'] = etag
+        return response
+
+    def _point(self, request):
+        """Point (lat, lon) lu dans les paramètres de la requête"""
+        lat = float(request.query_params['lat'])
+        lon = float(request.query_params['lon'])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError
+        return lat, lon
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Formations sanitaires à moins de ?radius_km (10 par défaut, au plus
+        MAX_NEARBY_RADIUS_KM) du point ?lat=&lon=, les plus proches d'abord
+        (?limit, au plus MAX_NEARBY_LIMIT)
+        """
+        try:
+            lat, lon = self._point(request)
+            radius_km = float(request.query_params.get('radius_km', 10))
+            limit = int(request.query_params.get('limit', MAX_NEARBY_LIMIT))
+            if not (math.isfinite(radius_km) and 0 < radius_km <= MAX_NEARBY_RADIUS_KM):
+                raise ValueError
+            if not 0 < limit <= MAX_NEARBY_LIMIT:
+                raise ValueError
+        except (KeyError, ValueError):
+            return Response(
+                {'error': (
+                    f'Paramètres lat, lon requis ; radius_km entre 0 et {MAX_NEARBY_RADIUS_KM} km, '
+                    f'limit entre 1 et {MAX_NEARBY_LIMIT}'
+                )},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        candidates = get_facility_index().nearby(lat, lon, radius_km)
+        distances = dict(candidates)
+        queryset = self.filter_queryset(self.get_queryset())
+        facilities = []
+        # Les plus proches d'abord, par paquets : une requête suffit sauf si les filtres en écartent
+        for start in range(0, len(candidates), MAX_NEARBY_LIMIT):
+            chunk = [facility_id for facility_id, _ in candidates[start:start + MAX_NEARBY_LIMIT]]
+            facilities.extend(sorted(queryset.filter(id__in=chunk), key=lambda facility: distances[facility.id]))
+            if len(facilities) >= limit:
+                break
+        facilities = facilities[:limit]
+        results = self.get_serializer(facilities, many=True).data
+        for facility, data in zip(facilities, results):
+            data['distance_km'] = round(distances[facility.id], 3)
+        return Response({'count': len(results), 'results': results})
+
+    @action(detail=False, methods=['get'])
+    def covering(self, request):
+        """Formations sanitaires dont la zone de couverture (polygone ou rayon) contient le point ?lat=&lon="""
+        try:
+            lat, lon = self._point(request)
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Paramètres lat et lon requis'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        facilities = self.filter_queryset(self.get_queryset()).filter(
+            id__in=get_facility_index().covering(lat, lon)
+        )
+        serializer = self.get_serializer(facilities, many=True)
+        return Response({'count': len(serializer.data), 'results': serializer.data})
+
 
-class HealthFacilityDistributorViewSet(viewsets.ModelViewSet):
+class HealthFacilityDistributorViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour la gestion des distributeurs des formations sanitaires"""
     queryset = HealthFacilityDistributor.objects.select_related('user', 'health_facility', 'assigned_by').all()
     serializer_class = HealthFacilityDistributorSerializer
@@ -212,7 +387,7 @@ class HealthFacilityDistributorViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class ProjectViewSet(viewsets.ModelViewSet):
+class ProjectViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les projets"""
     queryset = Project.objects.select_related('organization', 'donor', 'health_facility').all()
     serializer_class = ProjectSerializer
@@ -237,8 +412,44 @@ class ProjectViewSet(viewsets.ModelViewSet):
         
         return queryset
 
+    @action(detail=True, methods=['get'])
+    def order_proposal(self, request, pk=None):
+        """Proposition de commande basée sur la CMM (JSON ou CSV avec ?export=csv)"""
+        project = self.get_object()
+        try:
+            months = int(request.query_params.get('months', 3))
+            if not 1 <= months <= MAX_CMM_MONTHS:
+                raise ValueError
+        except ValueError:
+            return Response(
+                {'error': f'Le paramètre months doit être un entier entre 1 et {MAX_CMM_MONTHS}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        lines = propose_order(project, months)
+        
+        if request.query_params.get('export') == 'csv':
+            rows = (
+                [getattr(line, field) for field, _ in ORDER_CSV_COLUMNS]
+                for line in lines
+            )
+            return stream_csv(
+                [label for _, label in ORDER_CSV_COLUMNS], rows,
+                f'commande_{project.code}.csv'
+            )
+        
+        return Response({
+            'project': project.id,
+            'project_name': project.name,
+            'cmm_months': months,
+            'coverage_months': coverage_months(project),
+            'total_lines': len(lines),
+            'lines_to_order': sum(1 for line in lines if line.quantity_to_order > 0),
+            'total_value': sum(line.value for line in lines),
+            'lines': [line._asdict() for line in lines]
+        })
+
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les utilisateurs"""
     queryset = User.objects.select_related('organization', 'health_facility').all()
     serializer_class = UserSerializer
@@ -286,9 +497,9 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class MedicationCategoryViewSet(viewsets.ModelViewSet):
+class MedicationCategoryViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les catégories de médicaments"""
-    queryset = MedicationCategory.objects.all()
+    queryset = MedicationCategory.objects.annotate(medications_total=Count('medications'))
     serializer_class = MedicationCategorySerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
@@ -313,7 +524,7 @@ class MedicationCategoryViewSet(viewsets.ModelViewSet):
         serializer.save(organization=self.request.user.organization)
 
 
-class MedicationViewSet(viewsets.ModelViewSet):
+class MedicationViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les médicaments"""
     queryset = Medication.objects.select_related('category', 'organization').prefetch_related('allowed_facilities').all()
     serializer_class = MedicationSerializer
@@ -342,20 +553,19 @@ class MedicationViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def search(self, request):
-        """Recherche optimisée de médicaments"""
+        """
+        Recherche de médicaments pour l'autocomplétion (index api.search) :
+        préfixes des mots, sans accents, tolérante aux fautes de frappe
+        """
         query = request.query_params.get('q', '')
         category = request.query_params.get('category', '')
         facility_type = request.query_params.get('facility_type', '')
         
-        queryset = self.get_queryset()
+        organization = request.user.organization
+        if not organization:
+            return Response([])
         
-        if query:
-            queryset = queryset.filter(
-                Q(code__icontains=query) |
-                Q(name__icontains=query) |
-                Q(dosage__icontains=query) |
-                Q(therapeutic_class__icontains=query)
-            )
+        queryset = Medication.objects.filter(organization=organization)
         
         if category:
             queryset = queryset.filter(category_id=category)
@@ -363,9 +573,22 @@ class MedicationViewSet(viewsets.ModelViewSet):
         if facility_type:
             queryset = queryset.filter(allowed_facilities__type=facility_type)
         
-        queryset = queryset.distinct()[:20]  # Limiter à 20 résultats
-        serializer = MedicationSearchSerializer(queryset, many=True)
-        return Response(serializer.data)
+        limit = 20  # Limiter à 20 résultats
+        if len(fold(query).strip()) < MIN_PREFIX:
+            # Sans requête (ou requête d'un caractère) : premiers médicaments par code
+            if query:
+                queryset = queryset.filter(Q(code__istartswith=query) | Q(name__istartswith=query))
+            ids = list(queryset.distinct().order_by('code').values_list('id', flat=True)[:limit])
+        else:
+            ids = search_medication_ids(
+                organization.id, query, queryset if category or facility_type else None, limit
+            )
+        
+        # Détails lus dans le catalogue en mémoire de l'organisation
+        catalog = get_catalog(organization.id)
+        fields = MedicationSearchSerializer.Meta.fields
+        results = [catalog.representation(medication_id, fields) for medication_id in ids]
+        return Response([result for result in results if result is not None])
 
     @action(detail=True, methods=['get'])
     def substitutions(self, request, pk=None):
@@ -376,17 +599,15 @@ class MedicationViewSet(viewsets.ModelViewSet):
         substitutions = MedicationSubstitution.objects.filter(
             original_medication=medication,
             organization=user.organization
-        ).select_related('substitute_medication')
+        ).select_related('original_medication', 'substitute_medication', 'organization')
         
         serializer = MedicationSubstitutionSerializer(substitutions, many=True)
         return Response(serializer.data)
 
 
-class StandardListViewSet(viewsets.ModelViewSet):
+class StandardListViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les listes standard"""
-    queryset = StandardList.objects.select_related(
-        'organization', 'project', 'medication__category'
-    ).all()
+    queryset = StandardList.objects.select_related('organization', 'project').all()
     serializer_class = StandardListSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, DjangoFilterBackend, filters.OrderingFilter]
@@ -439,12 +660,11 @@ class StandardListViewSet(viewsets.ModelViewSet):
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class StockEntryViewSet(viewsets.ModelViewSet):
+class StockEntryViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les entrées en stock"""
-    queryset = StockEntry.objects.select_related(
-        'organization', 'project', 'medication'
-    ).all()
+    queryset = StockEntry.objects.select_related('organization', 'project', 'balance').all()
     serializer_class = StockEntrySerializer
+    pagination_class = KeysetPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, DjangoFilterBackend, filters.OrderingFilter]
     search_fields = ['medication__name', 'medication__code', 'supplier', 'batch_number']
@@ -505,7 +725,8 @@ class StockEntryViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def expiry_alerts(self, request):
         """Alertes de péremption"""
-        queryset = self.get_queryset()
+        # Seuls les lots ayant encore du stock sont concernés
+        queryset = self.get_queryset().filter(balance__quantity_available__gt=0)
         today = datetime.now().date()
         
         # Produits expirés
@@ -525,8 +746,55 @@ class StockEntryViewSet(viewsets.ModelViewSet):
             'at_risk_items': StockEntrySerializer(at_risk[:10], many=True).data
         })
 
+    @action(detail=False, methods=['get'])
+    def scan(self, request):
+        """
+        Résout un code GS1 scanné (?code=) en médicament et lot :
+        GTIN (01), lot (10), péremption (17)
+        """
+        code = request.query_params.get('code', '')
+        if not code:
+            return Response({'error': 'Paramètre code requis'}, status=status.HTTP_400_BAD_REQUEST)
+        if not request.user.organization_id:
+            return Response({'error': 'Aucune organisation assignée'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        result, = resolve_scans([code], request.user.organization_id, self._scan_queryset(request))
+        return Response(result)
 
-class PrescriptionPhotoViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'])
+    def scan_batch(self, request):
+        """Résout une liste de codes GS1 ({"codes": [...]}) pour la réception d'une livraison"""
+        codes = request.data.get('codes')
+        if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+            return Response({'error': 'codes doit être une liste de chaînes'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(codes) > MAX_SCANS_PER_BATCH:
+            return Response(
+                {'error': f'{MAX_SCANS_PER_BATCH} codes au maximum par appel'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not request.user.organization_id:
+            return Response({'error': 'Aucune organisation assignée'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        results = resolve_scans(codes, request.user.organization_id, self._scan_queryset(request))
+        return Response({'count': len(results), 'results': results})
+
+    def _scan_queryset(self, request):
+        """
+        Lots visibles par l'utilisateur, éventuellement restreints à ?project=.
+        Les médicaments venant du catalogue de l'organisation, le filtre sur
+        l'organisation est implicite : il détournerait SQLite de l'index
+        (médicament, lot, péremption).
+        """
+        queryset = StockEntry.objects.all()
+        if request.user.access_level == 'FACILITY':
+            queryset = queryset.filter(project__health_facility=request.user.health_facility)
+        project_id = request.query_params.get('project') or request.data.get('project')
+        if project_id:
+            queryset = queryset.filter(project_id=project_id)
+        return queryset
+
+
+class PrescriptionPhotoViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les photos d'ordonnances"""
     queryset = PrescriptionPhoto.objects.all()
     serializer_class = PrescriptionPhotoSerializer
@@ -540,12 +808,13 @@ class PrescriptionPhotoViewSet(viewsets.ModelViewSet):
         return super().get_queryset().filter(user=self.request.user)
 
 
-class DispensationViewSet(viewsets.ModelViewSet):
+class DispensationViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les dispensations"""
     queryset = Dispensation.objects.select_related(
         'prescription_photo', 'organization', 'project', 'created_by'
-    ).prefetch_related('items__medication').all()
+    ).prefetch_related('items').all()
     serializer_class = DispensationSerializer
+    pagination_class = KeysetPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [filters.SearchFilter, DjangoFilterBackend, filters.OrderingFilter]
     search_fields = ['patient_name', 'prescription_number', 'prescriber_name']
@@ -565,24 +834,114 @@ class DispensationViewSet(viewsets.ModelViewSet):
         
         return queryset
 
-    @action(detail=False, methods=['get'])
-    def statistics(self, request):
-        """Statistiques de dispensation"""
-        queryset = self.get_queryset()
-        
-        # Filtres par date
-        start_date = request.query_params.get('start_date')
-        end_date = request.query_params.get('end_date')
-        
-        if start_date:
-            queryset = queryset.filter(dispensation_date__gte=start_date)
-        if end_date:
-            queryset = queryset.filter(dispensation_date__lte=end_date)
+    @action(detail=True, methods=['post'])
+    def allocate(self, request, pk=None):
+        """
+        Ajoute les articles d'une prescription ({"items": [{"medication", "quantity"}]})
+        en répartissant les quantités sur les lots non périmés, premier périmé
+        premier sorti. Sans "allow_partial", rien n'est enregistré si le stock
+        d'un médicament est insuffisant.
+        """
+        dispensation = self.get_object()
+        serializer = DispensationAllocationSerializer(
+            data=request.data, context={'organization': dispensation.organization}
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
-        total_dispensations = queryset.count()
-        by_status = queryset.values('status').annotate(count=Count('id'))
-        by_destination = queryset.values('destination').annotate(count=Count('id'))
+        lines = [(item['medication'], item['quantity']) for item in serializer.validated_data['items']]
+        try:
+            _, shortages = dispense_fefo(
+                dispensation, lines, allow_partial=serializer.validated_data['allow_partial']
+            )
+        except InsufficientStock as error:
+            return Response({
+                'error': 'Stock insuffisant',
+                'shortages': [shortage._asdict() for shortage in error.shortages]
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except AllocationConflict as error:
+            return Response({'error': str(error)}, status=status.HTTP_409_CONFLICT)
         
+        data = self.get_serializer(self.get_queryset().get(pk=dispensation.pk)).data
+        data['shortages'] = [shortage._asdict() for shortage in shortages]
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Enregistre en une requête une dispensation et ses articles, ou
+        plusieurs ({"dispensations": [...], "all_or_nothing": false}). Un
+        article sans "stock_entry" est alloué aux lots en FEFO. Retourne un
+        résultat par dispensation (created, rejected ou not_created).
+        """
+        if isinstance(request.data, dict) and 'dispensations' in request.data:
+            records = request.data['dispensations']
+            all_or_nothing = request.data.get('all_or_nothing') in (True, 'true', '1')
+        else:
+            records = [request.data]
+            all_or_nothing = False
+        if not isinstance(records, list) or not records:
+            return Response({'error': 'Liste "dispensations" requise'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(records) > MAX_DISPENSATIONS_PER_BATCH:
+            return Response({
+                'error': f'Maximum {MAX_DISPENSATIONS_PER_BATCH} dispensations par requête'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        results = {}
+        valid = []
+        for index, record in enumerate(records):
+            serializer = BulkDispensationSerializer(data=record)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {'index': index, 'result': 'rejected', 'errors': serializer.errors}
+
+        user = request.user
+        projects = Project.objects.all()
+        if user.access_level == 'COORDINATION':
+            projects = projects.filter(organization=user.organization)
+        elif user.access_level == 'FACILITY':
+            projects = projects.filter(health_facility=user.health_facility)
+
+        if results and all_or_nothing:
+            results.update({index: {'index': index, 'result': 'not_created'} for index, _ in valid})
+        elif valid:
+            results.update(create_dispensations(valid, user, projects, all_or_nothing=all_or_nothing))
+
+        results = [results[index] for index in range(len(records))]
+        created = sum(result['result'] == 'created' for result in results)
+        if created == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'created': created,
+            'rejected': sum(result['result'] == 'rejected' for result in results),
+            'results': results
+        }, status=response_status)
+
+    @action(detail=False, methods=['get'])
+    @cached_analytics('dispensation_statistics', [DISPENSATIONS])
+    def statistics(self, request):
+        """Statistiques de dispensation (faits journaliers, dates incluses)"""
+        facts = DispensationDailyFact.objects.all()
+        user = request.user
+        if user.access_level == 'COORDINATION':
+            facts = facts.filter(organization=user.organization)
+        elif user.access_level == 'FACILITY':
+            facts = facts.filter(health_facility=user.health_facility)
+
+        try:
+            facts = filter_days(facts, request.query_params.get('start_date'), request.query_params.get('end_date'))
+        except ValueError:
+            return Response({'error': 'Date invalide (AAAA-MM-JJ)'}, status=status.HTTP_400_BAD_REQUEST)
+
+        total_dispensations = facts.aggregate(total=Sum('prescriptions'))['total'] or 0
+        by_status = facts.values('status').annotate(count=Sum('prescriptions')).order_by('status')
+        by_destination = facts.values('destination').annotate(count=Sum('prescriptions')).order_by('destination')
+
         return Response({
             'total_dispensations': total_dispensations,
             'by_status': list(by_status),
@@ -590,11 +949,11 @@ class DispensationViewSet(viewsets.ModelViewSet):
         })
 
 
-class InventoryViewSet(viewsets.ModelViewSet):
+class InventoryViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les inventaires"""
     queryset = Inventory.objects.select_related(
         'organization', 'project', 'created_by'
-    ).prefetch_related('items__medication').all()
+    ).prefetch_related('items').all()
     serializer_class = InventorySerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
@@ -606,6 +965,9 @@ class InventoryViewSet(viewsets.ModelViewSet):
         """Filtrer selon l'utilisateur connecté"""
         queryset = super().get_queryset()
         user = self.request.user
+        if self.action in ('analysis', 'import_items'):
+            # Articles agrégés ou écrits en base : pas de préchargement
+            queryset = queryset.prefetch_related(None)
         
         if user.access_level == 'COORDINATION':
             return queryset.filter(organization=user.organization)
@@ -616,40 +978,76 @@ class InventoryViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def analysis(self, request, pk=None):
-        """Analyse d'inventaire"""
+        """
+        Analyse d'inventaire : compteurs et valorisation des écarts en une
+        requête ; articles en écart sérialisés, omis (?items=false) ou
+        diffusés en lignes compactes (?stream=true)
+        """
         inventory = self.get_object()
-        items = inventory.items.all()
-        
-        total_items = items.count()
-        positive_variances = items.filter(
-            theoretical_stock__gt=F('physical_stock')
-        ).count()
-        negative_variances = items.filter(
-            theoretical_stock__lt=F('physical_stock')
-        ).count()
-        
-        total_variance = sum(item.variance for item in items)
-        
-        return Response({
-            'total_items': total_items,
-            'positive_variances': positive_variances,
-            'negative_variances': negative_variances,
-            'positive_variance_percentage': (positive_variances / total_items * 100) if total_items > 0 else 0,
-            'negative_variance_percentage': (negative_variances / total_items * 100) if total_items > 0 else 0,
-            'total_variance': total_variance,
-            'items_with_variance': InventoryItemSerializer(
-                items.exclude(theoretical_stock=F('physical_stock')), 
-                many=True
-            ).data
-        })
+        items = InventoryItem.objects.filter(inventory=inventory)
+        data = analyze_items(items)
+
+        if request.query_params.get('items') in ('false', '0'):
+            return Response(data)
+
+        if request.query_params.get('stream') in ('true', '1'):
+            catalog = get_catalog(inventory.organization_id)
+
+            def content():
+                yield json.dumps(data, cls=JSONEncoder)[:-1] + ', "items_with_variance": ['
+                for index, row in enumerate(variance_rows(items)):
+                    medication = catalog.representation(row['medication'], ['code', 'name']) or {}
+                    row['medication_code'] = medication.get('code')
+                    row['medication_name'] = medication.get('name')
+                    line = json.dumps(row, cls=JSONEncoder, ensure_ascii=False)
+                    yield line if index == 0 else ',' + line
+                yield ']}'
+
+            return StreamingHttpResponse(content(), content_type='application/json')
+
+        # Articles relus sans préchargement : détails du médicament depuis le catalogue
+        data['items_with_variance'] = InventoryItemSerializer(
+            items.exclude(theoretical_stock=F('physical_stock')).select_related('inventory').order_by('id'),
+            many=True,
+            context=self.get_serializer_context()
+        ).data
+        return Response(data)
+
+    @action(detail=True, methods=['post'])
+    def import_items(self, request, pk=None):
+        """
+        Importe une feuille de comptage (fichier CSV ou XLSX "file") : une
+        ligne par article (code, lot, stock physique, péremption), stock
+        théorique lu dans les soldes. Retourne les compteurs et les lignes
+        rejetées ; "all_or_nothing" annule l'import au premier rejet.
+        """
+        inventory = self.get_object()
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'Fichier "file" requis (CSV ou XLSX)'}, status=status.HTTP_400_BAD_REQUEST)
+        all_or_nothing = request.data.get('all_or_nothing') in ('true', '1')
 
+        try:
+            report = import_count_sheet(inventory, upload, all_or_nothing=all_or_nothing)
+        except ImportFormatError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        if not report.created and not report.rejected:
+            return Response({'error': 'Aucun article dans la feuille'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if report.created and not report.rejected:
+            response_status = status.HTTP_201_CREATED
+        elif report.created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(report.as_dict(), status=response_status)
 
-class ConsumptionDataViewSet(viewsets.ModelViewSet):
+
+class ConsumptionDataViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les données de consommation"""
-    queryset = ConsumptionData.objects.select_related(
-        'organization', 'project', 'medication'
-    ).all()
+    queryset = ConsumptionData.objects.select_related('organization', 'project').all()
     serializer_class = ConsumptionDataSerializer
+    pagination_class = KeysetPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['organization', 'project', 'medication', 'week_number', 'year', 'is_week_closed']
@@ -691,28 +1089,65 @@ class ConsumptionDataViewSet(viewsets.ModelViewSet):
         """Analyse mensuelle de consommation (CMM)"""
         queryset = self.get_queryset()
         medication_id = request.query_params.get('medication')
-        months = int(request.query_params.get('months', 3))
-        
+        try:
+            months = int(request.query_params.get('months', 3))
+            if not 1 <= months <= MAX_CMM_MONTHS:
+                raise ValueError
+        except ValueError:
+            return Response(
+                {'error': f'Le paramètre months doit être un entier entre 1 et {MAX_CMM_MONTHS}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         if medication_id:
             queryset = queryset.filter(medication_id=medication_id)
         
-        # Calculer la CMM sur X mois
-        queryset = queryset.filter(is_week_closed=True)
-        total_consumption = queryset.aggregate(
-            total=Sum('quantity_consumed')
-        )['total'] or 0
-        
-        weeks_count = queryset.count()
-        monthly_average = (total_consumption / weeks_count * 4.33) if weeks_count > 0 else 0
+        # CMM sur les X derniers mois, hors semaines de rupture
+        results = compute_cmm(queryset, windows=(months,)).values()
+        total_consumption = sum(result.total[months] for result in results)
+        weeks_count = max((result.weeks[months] for result in results), default=0)
+        monthly_average = sum(result.cmm[months] for result in results)
         
         return Response({
+            'months': months,
             'total_consumption': total_consumption,
             'weeks_analyzed': weeks_count,
             'monthly_average': round(monthly_average, 2)
         })
 
+    @action(detail=False, methods=['get'])
+    def cmm(self, request):
+        """CMM glissantes (3, 6 et 12 mois) de tous les médicaments d'un projet"""
+        queryset = self.get_queryset()
+        project_id = request.query_params.get('project')
+        
+        if project_id:
+            queryset = queryset.filter(project_id=project_id)
+        
+        results = compute_cmm(queryset)
+        medications = Medication.objects.only('code', 'name').in_bulk(
+            {medication_id for _, _, medication_id in results}
+        )
+        
+        data = []
+        for (org_id, project, medication_id), result in results.items():
+            medication = medications.get(medication_id)
+            row = {
+                'project': project,
+                'medication': medication_id,
+                'medication_code': medication.code if medication else None,
+                'medication_name': medication.name if medication else None,
+            }
+            for months in DEFAULT_WINDOWS:
+                row[f'cmm_{months}'] = round(result.cmm[months], 2)
+                row[f'weeks_{months}'] = result.weeks[months]
+            data.append(row)
+        
+        data.sort(key=lambda row: (row['project'], row['medication_code'] or ''))
+        return Response(data)
+
 
-class AlertViewSet(viewsets.ModelViewSet):
+class AlertViewSet(SparseFieldsViewSetMixin, viewsets.ModelViewSet):
     """ViewSet pour les alertes"""
     queryset = Alert.objects.select_related(
         'organization', 'project', 'medication'
@@ -748,6 +1183,7 @@ class AlertViewSet(viewsets.ModelViewSet):
         return Response({'message': 'Alerte résolue avec succès'})
 
     @action(detail=False, methods=['get'])
+    @cached_analytics('alert_dashboard', [ALERTS])
     def dashboard(self, request):
         """Dashboard des alertes"""
         queryset = self.get_queryset().filter(is_active=True)
@@ -767,36 +1203,42 @@ class AlertViewSet(viewsets.ModelViewSet):
 # Vues pour les analyses avancées
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_analytics('stock_summary', [STOCK], daily=True)
 def stock_summary(request):
     """Résumé global des stocks"""
     user = request.user
     
-    # Filtrer selon l'accès utilisateur
+    # Filtrer selon l'accès utilisateur (soldes de lots maintenus par api.ledger)
     if user.access_level == 'COORDINATION':
-        stock_entries = StockEntry.objects.filter(organization=user.organization)
+        scope = {'organization': user.organization}
+        lots = LotBalance.objects.filter(organization=user.organization)
     elif user.access_level == 'FACILITY':
-        stock_entries = StockEntry.objects.filter(project__health_facility=user.health_facility)
+        scope = {'health_facility': user.health_facility}
+        lots = LotBalance.objects.filter(project__health_facility=user.health_facility)
     else:
-        stock_entries = StockEntry.objects.none()
+        scope = None
+        lots = LotBalance.objects.none()
     
     today = datetime.now().date()
     
     # Calculer les métriques
-    total_medications = stock_entries.values('medication').distinct().count()
-    total_value = stock_entries.aggregate(
-        total=Sum(F('quantity_delivered') * F('unit_price'))
+    total_medications = lots.values('medication').distinct().count()
+    total_value = lots.aggregate(
+        total=Sum(F('quantity_available') * F('stock_entry__unit_price'))
     )['total'] or 0
     
-    expired_items = stock_entries.filter(expiry_date__lt=today).count()
+    lots_in_stock = lots.filter(quantity_available__gt=0)
+    expired_items = lots_in_stock.filter(expiry_date__lt=today).count()
     risk_date = today + timedelta(days=60)
-    expiry_risk_items = stock_entries.filter(
+    expiry_risk_items = lots_in_stock.filter(
         expiry_date__gte=today,
         expiry_date__lt=risk_date
     ).count()
     
-    # Calculer ruptures et pré-ruptures (logique simplifiée)
-    stockout_items = 0  # À implémenter selon la logique métier
-    pre_stockout_items = 0  # À implémenter selon la logique métier
+    # Ruptures et pré-ruptures : mois de stock (solde / CMM) comparés aux délais du projet
+    statuses = evaluate_stock_status(**scope) if scope is not None else []
+    stockout_items = sum(1 for item in statuses if item.status == STOCKOUT)
+    pre_stockout_items = sum(1 for item in statuses if item.status == PRE_STOCKOUT)
     
     data = {
         'total_medications': total_medications,
@@ -813,62 +1255,61 @@ def stock_summary(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_analytics('pharmacoepidemio_analysis', [DISPENSATIONS])
 def pharmacoepidemio_analysis(request):
-    """Analyses pharmacoépidémiologiques"""
+    """Analyses pharmacoépidémiologiques (faits journaliers, dates incluses)"""
     user = request.user
     
     # Filtrer selon l'accès utilisateur
     if user.access_level == 'COORDINATION':
-        dispensations = Dispensation.objects.filter(organization=user.organization)
+        facts = DispensationDailyFact.objects.filter(organization=user.organization)
     elif user.access_level == 'FACILITY':
-        dispensations = Dispensation.objects.filter(project__health_facility=user.health_facility)
+        facts = DispensationDailyFact.objects.filter(health_facility=user.health_facility)
     else:
-        dispensations = Dispensation.objects.none()
+        facts = DispensationDailyFact.objects.none()
     
     # Filtres par date
-    start_date = request.query_params.get('start_date')
-    end_date = request.query_params.get('end_date')
-    
-    if start_date:
-        dispensations = dispensations.filter(dispensation_date__gte=start_date)
-    if end_date:
-        dispensations = dispensations.filter(dispensation_date__lte=end_date)
-    
-    total_prescriptions = dispensations.count()
-    
-    # Prescriptions d'antibiotiques (logique simplifiée)
-    antibiotic_prescriptions = dispensations.filter(
-        items__medication__therapeutic_class__icontains='antibiotique'
-    ).distinct().count()
-    
-    # Prescriptions antipaludiques
-    malaria_prescriptions = dispensations.filter(
-        items__medication__therapeutic_class__icontains='antipaludique'
-    ).distinct().count()
-    
-    # Prescriptions femmes enceintes
-    pregnant_women_prescriptions = dispensations.filter(
-        patient_service__icontains='CPN'
-    ).count()
+    try:
+        facts = filter_days(facts, request.query_params.get('start_date'), request.query_params.get('end_date'))
+    except ValueError:
+        return Response({'error': 'Date invalide (AAAA-MM-JJ)'}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Prescriptions enfants < 5 ans
-    children_under_5_prescriptions = dispensations.filter(
-        patient_age__lt=5
-    ).count()
+    totals = facts.aggregate(
+        total=Sum('prescriptions'),
+        antibiotic=Sum('prescriptions', filter=ANTIBIOTIC_FACTS),
+        # Multithérapies : au moins deux antibiotiques distincts
+        multitherapy=Sum('prescriptions', filter=MULTITHERAPY_FACTS),
+        malaria=Sum('prescriptions', filter=Q(has_antimalarial=True)),
+        # Femmes enceintes : service CPN
+        pregnant_women=Sum('prescriptions', filter=Q(is_antenatal=True)),
+        children_under_5=Sum('prescriptions', filter=Q(age_band=UNDER_FIVE)),
+    )
+    total_prescriptions = totals['total'] or 0
+    antibiotic_prescriptions = totals['antibiotic'] or 0
+    malaria_prescriptions = totals['malaria'] or 0
     
-    # Multithérapies antibiotiques (logique simplifiée)
-    multitherapy_prescriptions = 0  # À implémenter selon la logique métier
+    multitherapy_prescriptions = totals['multitherapy'] or 0
     
     data = {
         'total_prescriptions': total_prescriptions,
         'antibiotic_prescriptions': antibiotic_prescriptions,
         'antibiotic_percentage': (antibiotic_prescriptions / total_prescriptions * 100) if total_prescriptions > 0 else 0,
         'multitherapy_prescriptions': multitherapy_prescriptions,
+        'multitherapy_percentage': (multitherapy_prescriptions / total_prescriptions * 100) if total_prescriptions > 0 else 0,
+        'antibiotics_per_prescription': antibiotic_distribution(facts),
+        'weekly_antibiotics': weekly_antibiotic_series(facts),
         'malaria_prescriptions': malaria_prescriptions,
         'malaria_percentage': (malaria_prescriptions / total_prescriptions * 100) if total_prescriptions > 0 else 0,
-        'pregnant_women_prescriptions': pregnant_women_prescriptions,
-        'children_under_5_prescriptions': children_under_5_prescriptions
+        'pregnant_women_prescriptions': totals['pregnant_women'] or 0,
+        'children_under_5_prescriptions': totals['children_under_5'] or 0
     }
     
     serializer = PharmacoepidemioAnalysisSerializer(data)
     return Response(serializer.data)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def analytics_cache_stats(request):
+    """Succès et échecs du cache des analyses par vue (processus courant)"""
+    return Response(cache_metrics.snapshot())
@@ -0,0 +1,11 @@
+"""
+Mesures de performance reproductibles, sur une base SQLite jetable.
+
+Chaque module se lance depuis le dossier du projet, par exemple :
+
+    python -m benchmarks.alerts --scale 5000
+
+Les données sont générées dans un fichier temporaire supprimé à la fin ;
+`--db chemin` conserve la base pour relancer la mesure sans la régénérer
+(les données ne sont créées que si la base est vide).
+"""
@@ -0,0 +1,88 @@
+"""
+Génération des alertes (api.alerts) sur `--scale` médicaments d'un projet :
+un quart en rupture, un quart en pré-rupture, un quart avec un lot proche
+de la péremption, 12 semaines de consommation chacun.
+
+Mesure la première synchronisation (création des alertes), une
+réévaluation sans changement, puis le traitement d'un lot de `--keys`
+clés de la file incrémentale.
+
+    python -m benchmarks.alerts --scale 5000
+"""
+from benchmarks.common import is_seeded, measure, reference_data, setup, step
+
+args = setup(__doc__.strip().splitlines()[0], scale=5000, keys=(500, "clés traitées par la file (défaut 500)"))
+
+from datetime import date, timedelta  # noqa: E402
+
+from api import ledger  # noqa: E402
+from api.alerts import enqueue_alert_keys, generate_alerts, process_alert_queue  # noqa: E402
+from api.models import Alert, ConsumptionData, Medication, StockEntry  # noqa: E402
+
+
+def seed(scale):
+    organization, project, category, _ = reference_data()
+    today = date.today()
+    Medication.objects.bulk_create(
+        Medication(
+            code=f'ALR{number:06}', name=f'Médicament {number}', organization=organization,
+            category=category, form='Comprimé', packaging='Boîte de 100',
+        )
+        for number in range(scale)
+    )
+    medications = list(Medication.objects.filter(organization=organization).values_list('id', flat=True))
+
+    # Profils : rupture, pré-rupture (1 mois de stock), péremption proche, couvert
+    entries = []
+    for number, medication_id in enumerate(medications):
+        profile = number % 4
+        if profile == 0:
+            continue
+        entries.append(StockEntry(
+            organization=organization, project=project, medication_id=medication_id,
+            delivery_date=today - timedelta(days=60), quantity_delivered=130 if profile == 1 else 500,
+            expiry_date=today + timedelta(days=30 if profile == 2 else 400), batch_number=f'L{number}',
+        ))
+    StockEntry.objects.bulk_create(entries, batch_size=2000)
+
+    monday = today - timedelta(days=today.weekday())
+    weeks = [(monday - timedelta(weeks=offset)).isocalendar()[:2] for offset in range(1, 13)]
+    ConsumptionData.objects.bulk_create(
+        (
+            ConsumptionData(
+                organization=organization, project=project, medication_id=medication_id,
+                year=year, week_number=week, quantity_consumed=30, is_week_closed=True,
+            )
+            for medication_id in medications for year, week in weeks
+        ),
+        batch_size=5000
+    )
+    # bulk_create ne déclenche pas les signaux : soldes recalculés
+    ledger.rebuild_balances()
+    return organization, project, medications
+
+
+if is_seeded():
+    organization, project, _, _ = reference_data()
+    medications = list(Medication.objects.filter(organization=organization).values_list('id', flat=True))
+else:
+    with step(f"Génération ({args.scale} médicaments)"):
+        organization, project, medications = seed(args.scale)
+
+Alert.objects.all().delete()
+with step("Première synchronisation (création)"):
+    reports = generate_alerts()
+for report in reports:
+    print(f"  {report.rule:<25} {report.candidates:>7} actives, +{report.created}, -{report.resolved}")
+
+measure("Réévaluation sans changement", generate_alerts, max(1, args.repeat // 4))
+
+keys = [(organization.id, project.id, medication_id) for medication_id in medications[:args.keys]]
+
+
+def process_keys():
+    enqueue_alert_keys(keys)
+    process_alert_queue(batch_size=len(keys))
+
+
+measure(f"File incrémentale ({len(keys)} clés)", process_keys, args.repeat)
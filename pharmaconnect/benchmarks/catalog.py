@@ -0,0 +1,85 @@
+"""
+Détails des médicaments imbriqués dans /stock-entries/ (api.catalog) sur
+`--scale` médicaments d'une organisation, deux lots chacun.
+
+Mesure une page de `--page-size` lots de bout en bout, catalogue chargé,
+comparée à la même page sérialisée avec MedicationSerializer imbriqué
+(médicament, catégorie et formations autorisées lus en base, comme avant
+le catalogue), puis la reconstruction du catalogue après une
+modification de médicament.
+
+    python -m benchmarks.catalog --scale 5000
+"""
+from benchmarks.common import (
+    api_client, create_medications, insert_lots, is_seeded, measure, reference_data, setup, step,
+)
+
+args = setup(__doc__.strip().splitlines()[0], scale=5000, page_size=(50, "lots par page (défaut 50)"))
+
+from api.catalog import get_catalog, invalidate_catalog  # noqa: E402
+from api.models import Medication, StockEntry  # noqa: E402
+from api.serializers import MedicationSerializer, StockEntrySerializer  # noqa: E402
+
+
+class NestedStockEntrySerializer(StockEntrySerializer):
+    """medication_details lus en base, sérialiseur imbriqué d'avant le catalogue"""
+    medication_details = MedicationSerializer(source='medication', read_only=True)
+
+
+seeded = is_seeded()
+organization, project, category, user = reference_data()
+if not seeded:
+    with step(f"Génération ({args.scale} médicaments, {2 * args.scale} lots)"):
+        medication_ids = create_medications(organization, category, args.scale, 'CAT')
+        insert_lots(project, medication_ids, 2)
+        # Formations autorisées : une relation à précharger par médicament
+        allowed = Medication.allowed_facilities.through
+        allowed.objects.bulk_create(
+            (
+                allowed(medication_id=medication_id, healthfacility_id=project.health_facility_id)
+                for medication_id in medication_ids
+            ),
+            batch_size=5000
+        )
+        invalidate_catalog(organization.id)
+
+client = api_client(user)
+params = {'page_size': args.page_size}
+page = client.get('/api/stock-entries/', params).data['results']
+assert len(page) == args.page_size and page[0]['medication_details']['allowed_facilities_names']
+print(f"{StockEntry.objects.count()} lots, {len(get_catalog(organization.id))} médicaments au catalogue")
+
+measure(
+    f"/stock-entries/ ({args.page_size} lots, catalogue)", lambda: client.get('/api/stock-entries/', params),
+    args.repeat
+)
+
+entries = StockEntry.objects.filter(organization=organization).order_by('-delivery_date', '-id')
+
+
+def nested():
+    rows = entries.select_related('organization', 'project', 'balance', 'medication__category').prefetch_related(
+        'medication__allowed_facilities'
+    )[:args.page_size]
+    return NestedStockEntrySerializer(rows, many=True).data
+
+
+def from_catalog():
+    rows = entries.select_related('organization', 'project', 'balance')[:args.page_size]
+    return StockEntrySerializer(rows, many=True).data
+
+
+assert [row['medication_details'] for row in nested()] == [row['medication_details'] for row in from_catalog()]
+measure("  sérialisation, catalogue", from_catalog, args.repeat)
+measure("  sérialisation, médicaments lus en base", nested, args.repeat)
+
+
+def after_change():
+    invalidate_catalog(organization.id)
+    client.get('/api/stock-entries/', params)
+
+
+measure(
+    f"/stock-entries/ après une modification (catalogue de {args.scale} médicaments reconstruit)", after_change,
+    max(1, args.repeat // 4)
+)
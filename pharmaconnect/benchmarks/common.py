@@ -0,0 +1,221 @@
+"""
+Amorçage commun des mesures : arguments, base jetable, données de
+référence et chronométrage.
+"""
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date
+
+import django
+
+
+def setup(description, scale, **options):
+    """
+    Lit les arguments (--scale, --repeat, --db, plus `options` :
+    {nom: (défaut, aide)}), prépare la base et initialise Django.
+    Retourne les arguments lus.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--scale', type=int, default=scale, help=f"volume de données (défaut {scale})")
+    parser.add_argument('--repeat', type=int, default=20, help="répétitions par mesure (défaut 20)")
+    parser.add_argument('--db', help="base SQLite à conserver ou réutiliser (défaut : fichier temporaire)")
+    for name, (default, text) in options.items():
+        parser.add_argument(f'--{name}', type=type(default), default=default, help=text)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pharmaconnect-benchmark-')
+    os.environ['BENCHMARK_DIR'] = directory
+    os.environ['BENCHMARK_DB'] = os.path.abspath(args.db) if args.db else os.path.join(directory, 'db.sqlite3')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    django.setup()
+
+    from django.core.management import call_command
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    call_command('migrate', verbosity=0)
+    return args
+
+
+def is_seeded():
+    from api.models import Organization
+    return Organization.objects.filter(code='BENCH').exists()
+
+
+def reference_data():
+    """(organisation, projet, catégorie, utilisateur) des mesures, créés au besoin"""
+    from api.models import Donor, HealthFacility, MedicationCategory, Organization, Project, User
+
+    organization, _ = Organization.objects.get_or_create(
+        code='BENCH', defaults={'name': 'ONG Benchmark', 'type': 'NGO', 'country': 'Cameroun'}
+    )
+    donor, _ = Donor.objects.get_or_create(code='BENCH', defaults={'name': 'Bailleur Benchmark'})
+    facility, _ = HealthFacility.objects.get_or_create(code='BENCH', defaults={
+        'name': 'CSI Benchmark', 'type': 'CSI', 'level_of_care': 'PRIMARY', 'location': 'Yaoundé',
+        'latitude': 3.8667, 'longitude': 11.5167,
+    })
+    project, _ = Project.objects.get_or_create(code='BENCH', defaults={
+        'name': 'Projet Benchmark', 'organization': organization, 'donor': donor, 'health_facility': facility,
+        'start_date': date(2024, 1, 1), 'end_date': date(2030, 12, 31),
+    })
+    category, _ = MedicationCategory.objects.get_or_create(
+        code='BENCH', organization=organization, defaults={'name': 'Catégorie Benchmark'}
+    )
+    user = User.objects.filter(username='benchmark').first() or User.objects.create_user(
+        'benchmark', password='benchmark', organization=organization, health_facility=facility,
+        access_level='COORDINATION',
+    )
+    return organization, project, category, user
+
+
+def api_client(user):
+    from rest_framework.test import APIClient
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+@contextmanager
+def step(label):
+    """Affiche la durée d'une étape unique (génération, reconstruction)"""
+    started = time.perf_counter()
+    yield
+    print(f"{label} : {time.perf_counter() - started:.2f} s", flush=True)
+
+
+def measure(label, function, repeat):
+    """
+    Exécute `function` une fois à blanc puis `repeat` fois ; affiche la
+    médiane, le p95 et le nombre de requêtes SQL du dernier appel
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    function()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    with CaptureQueriesContext(connection) as queries:
+        function()
+    durations.sort()
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    print(
+        f"{label} : médiane {statistics.median(durations) * 1000:.1f} ms, "
+        f"p95 {p95 * 1000:.1f} ms, {len(queries)} requête(s)",
+        flush=True
+    )
+    return durations
+
+
+def measure_each(label, function, inputs):
+    """Chronomètre `function(valeur)` pour chaque valeur ; médiane et p95 par appel"""
+    inputs = list(inputs)
+    function(inputs[0])
+    durations = []
+    for value in inputs:
+        started = time.perf_counter()
+        function(value)
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    print(
+        f"{label} : médiane {statistics.median(durations) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms "
+        f"par appel ({len(durations)} appels)",
+        flush=True
+    )
+    return durations
+
+
+def create_medications(organization, category, count, prefix, **fields):
+    """`count` médicaments (codes `prefix` + numéro, GTIN-13 valides) ; leurs identifiants"""
+    from api.gs1 import gtin_check_digit
+    from api.models import Medication
+
+    def gtin(number):
+        digits = f'{600000000000 + number}'
+        return digits + gtin_check_digit(digits)
+
+    Medication.objects.bulk_create(
+        (
+            Medication(
+                code=f'{prefix}{number:06}', name=f'Médicament {prefix} {number}', organization=organization,
+                category=category, form='Comprimé', packaging='Boîte de 100', barcode_gs1=gtin(number), **fields
+            )
+            for number in range(count)
+        ),
+        batch_size=2000
+    )
+    return list(
+        Medication.objects.filter(organization=organization, code__startswith=prefix)
+        .order_by('id').values_list('id', flat=True)
+    )
+
+
+def insert_lots(project, medication_ids, lots_per_medication, quantity=100):
+    """
+    Insère en SQL `lots_per_medication` lots par médicament (lot L<numéro>,
+    péremptions étalées sur deux ans) puis recalcule les soldes
+    """
+    from django.db import connection
+    from api import ledger
+
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE benchmark_medication (position INTEGER PRIMARY KEY, id INTEGER)")
+        cursor.executemany(
+            "INSERT INTO benchmark_medication VALUES (%s, %s)", list(enumerate(medication_ids))
+        )
+        cursor.execute(
+            """
+            WITH RECURSIVE lot(number) AS (
+                SELECT 0 UNION ALL SELECT number + 1 FROM lot WHERE number + 1 < %s
+            )
+            INSERT INTO api_stockentry (
+                organization_id, project_id, medication_id, delivery_date, quantity_ordered,
+                quantity_delivered, expiry_date, unit_price, supplier, batch_number, created_at
+            )
+            SELECT %s, %s, medication.id, date('now', '-30 days'), 0, %s,
+                   date('now', '+' || (30 + (lot.number * 7 + medication.position) %% 700) || ' days'),
+                   1, '', 'L' || (lot.number * %s + medication.position), datetime('now')
+            FROM benchmark_medication AS medication CROSS JOIN lot
+            """,
+            [lots_per_medication, project.organization_id, project.id, quantity, len(medication_ids)]
+        )
+        cursor.execute("DROP TABLE benchmark_medication")
+    ledger.rebuild_balances()
+
+
+def insert_dispensations(organization, project, user, count, per_minute=100):
+    """
+    Insère en SQL `count` dispensations livrées, `per_minute` par minute en
+    remontant depuis maintenant (dates en partie identiques si entier,
+    toutes distinctes sinon)
+    """
+    from django.db import connection
+    from api.models import PrescriptionPhoto
+
+    photo = PrescriptionPhoto.objects.create(photo='prescriptions/benchmark.jpg', user=user)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH RECURSIVE row(number) AS (
+                SELECT 0 UNION ALL SELECT number + 1 FROM row WHERE number + 1 < %s
+            )
+            INSERT INTO api_dispensation (
+                prescription_photo_id, destination, organization_id, project_id, dispensation_date, status,
+                patient_name, patient_sex, prescription_number, prescriber_name, patient_phone,
+                patient_service, service_name, patient_unique_id, care_type, notes, created_by_id
+            )
+            SELECT %s, 'PATIENT', %s, %s, datetime('now', '-' || (number / %s) || ' minutes'), 'DELIVERED',
+                   'Patient ' || number, '', '', '', '', '', '', '', '', '', %s
+            FROM row
+            """,
+            [count, photo.id, organization.id, project.id, per_minute, user.id]
+        )
@@ -0,0 +1,51 @@
+"""
+Compteurs du tableau de bord de l'administration (api.dashboard_stats) sur
+`--scale` dispensations récentes d'une organisation.
+
+Mesure la lecture de l'instantané contre les huit COUNT exécutés
+auparavant à chaque page, le recomptage complet (refresh_admin_statistics)
+et la page d'accueil de l'administration de bout en bout.
+
+    python -m benchmarks.dashboard_stats --scale 1000000
+"""
+from benchmarks.common import insert_dispensations, is_seeded, measure, reference_data, setup, step
+
+args = setup(__doc__.strip().splitlines()[0], scale=1000000)
+
+import logging  # noqa: E402
+
+from django.test import Client  # noqa: E402
+
+from api import dashboard_stats  # noqa: E402
+from api.models import DashboardStatistic, User  # noqa: E402
+
+seeded = is_seeded()
+organization, project, _, user = reference_data()
+if not seeded:
+    # Étalées sur moins de 30 jours : toutes comptées dans la fenêtre des dispensations récentes
+    with step(f"Génération ({args.scale} dispensations)"):
+        insert_dispensations(organization, project, user, args.scale, per_minute=max(5, args.scale // 40000))
+
+DashboardStatistic.objects.all().delete()
+with step("Premier calcul (compteurs absents)"):
+    statistics = dashboard_stats.get_statistics()
+print(f"  {statistics}")
+assert statistics == {name: queryset().count() for name, queryset in dashboard_stats.STATISTICS.items()}
+
+measure(
+    "Huit COUNT (ancien)",
+    lambda: {name: queryset().count() for name, queryset in dashboard_stats.STATISTICS.items()},
+    max(1, args.repeat // 4)
+)
+measure("Lecture de l'instantané", dashboard_stats.get_statistics, args.repeat)
+measure("Recomptage complet", dashboard_stats.refresh_statistics, max(1, args.repeat // 4))
+
+admin = User.objects.filter(username='benchmark-admin').first() or User.objects.create_superuser(
+    'benchmark-admin', 'admin@example.org', 'benchmark'
+)
+# Liens du menu jazzmin non résolus dans cette configuration : avertissements tus
+logging.getLogger('jazzmin').setLevel(logging.ERROR)
+client = Client()
+client.force_login(admin)
+assert client.get('/admin/').status_code == 200
+measure("Page d'accueil de l'administration", lambda: client.get('/admin/'), args.repeat)
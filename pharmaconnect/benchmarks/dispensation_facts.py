@@ -0,0 +1,125 @@
+"""
+Analyses des dispensations (api.dispensation_facts) sur `--scale`
+dispensations d'une organisation étalées sur un an, d'un à trois articles
+chacune parmi des antibiotiques, antipaludiques et autres médicaments.
+
+Mesure la reconstruction des faits journaliers, le recalcul d'un jour
+chargé, puis pharmacoepidemio et statistics de bout en bout sur 30 et
+365 jours, comparés aux requêtes sur dispensations et articles
+utilisées auparavant (icontains sur la classe, COUNT DISTINCT).
+
+    python -m benchmarks.dispensation_facts --scale 300000
+"""
+from benchmarks.common import (
+    api_client, create_medications, insert_dispensations, insert_lots, is_seeded, measure, reference_data, setup,
+    step,
+)
+
+args = setup(__doc__.strip().splitlines()[0], scale=300000)
+
+from datetime import datetime, time, timedelta  # noqa: E402
+
+from django.db import connection  # noqa: E402
+from django.db.models import Count  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from api import dispensation_facts  # noqa: E402
+from api.models import Dispensation, DispensationItem  # noqa: E402
+
+seeded = is_seeded()
+organization, project, category, user = reference_data()
+if not seeded:
+    with step(f"Génération ({args.scale} dispensations et leurs articles)"):
+        medication_ids = (
+            create_medications(organization, category, 10, 'AB', therapeutic_class='Antibiotique', is_antibiotic=True)
+            + create_medications(
+                organization, category, 5, 'AP', therapeutic_class='Antipaludique', is_antimalarial=True
+            )
+            + create_medications(organization, category, 25, 'AU', therapeutic_class='Antalgique')
+        )
+        insert_lots(project, medication_ids, 1, quantity=10 ** 9)
+        # Étalées sur un an
+        insert_dispensations(organization, project, user, args.scale, per_minute=args.scale / (365 * 24 * 60))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE api_dispensation SET patient_age = id %% 70, "
+                "patient_service = CASE WHEN id %% 10 = 0 THEN 'CPN' ELSE '' END WHERE organization_id = %s",
+                [organization.id]
+            )
+            # Un à trois articles par dispensation, médicaments tirés selon l'id
+            cursor.execute("CREATE TEMP TABLE benchmark_medication (position INTEGER PRIMARY KEY, id INTEGER)")
+            cursor.executemany("INSERT INTO benchmark_medication VALUES (%s, %s)", list(enumerate(medication_ids)))
+            cursor.execute(
+                """
+                INSERT INTO api_dispensationitem (
+                    dispensation_id, medication_id, stock_entry_id, quantity_dispensed, unit_price
+                )
+                SELECT dispensation.id, medication.id, lot.id, 1 + slot.number, 1
+                FROM api_dispensation AS dispensation
+                CROSS JOIN (SELECT 0 AS number UNION ALL SELECT 1 UNION ALL SELECT 2) AS slot
+                JOIN benchmark_medication AS medication
+                  ON medication.position = (dispensation.id * 31 + slot.number * 17) %% %s
+                JOIN api_stockentry AS lot ON lot.project_id = dispensation.project_id AND lot.medication_id = medication.id
+                WHERE dispensation.organization_id = %s AND slot.number <= dispensation.id %% 3
+                """,
+                [len(medication_ids), organization.id]
+            )
+            cursor.execute("DROP TABLE benchmark_medication")
+    with step("Reconstruction des faits (rebuild_dispensation_facts)"):
+        rows = dispensation_facts.rebuild_facts()
+    print(f"  {rows} lignes de faits")
+
+print(
+    f"{Dispensation.objects.count()} dispensations, {DispensationItem.objects.count()} articles, "
+    f"{dispensation_facts.DispensationDailyFact.objects.count()} lignes de faits"
+)
+
+busiest = Dispensation.objects.order_by('-id').first()
+with step("Recalcul d'un jour (refresh_days)"):
+    dispensation_facts.refresh_days([dispensation_facts.day_key(busiest)])
+
+
+def legacy_analysis(since):
+    """Requêtes des deux vues avant les faits journaliers"""
+    dispensations = Dispensation.objects.filter(organization=organization, dispensation_date__gte=since)
+    results = {
+        'total_prescriptions': dispensations.count(),
+        'antibiotic_prescriptions': dispensations.filter(
+            items__medication__therapeutic_class__icontains='antibiotique'
+        ).distinct().count(),
+        'malaria_prescriptions': dispensations.filter(
+            items__medication__therapeutic_class__icontains='antipaludique'
+        ).distinct().count(),
+        'pregnant_women_prescriptions': dispensations.filter(patient_service__icontains='CPN').count(),
+        'children_under_5_prescriptions': dispensations.filter(patient_age__lt=5).count(),
+    }
+    list(dispensations.values('status').annotate(count=Count('id')))
+    list(dispensations.values('destination').annotate(count=Count('id')))
+    return results
+
+
+# Réponses recalculées à chaque appel : cache des analyses désactivé
+override_settings(ANALYTICS_CACHES=[]).enable()
+client = api_client(user)
+
+
+def analyses(params):
+    client.get('/api/analytics/pharmacoepidemio/', params)
+    client.get('/api/dispensations/statistics/', params)
+
+
+for days in (30, 365):
+    start = timezone.localdate() - timedelta(days=days - 1)
+    since = timezone.make_aware(datetime.combine(start, time.min))
+    params = {'start_date': start.isoformat()}
+    print(f"Période de {days} jours")
+    data = client.get('/api/analytics/pharmacoepidemio/', params).data
+    legacy = legacy_analysis(since)
+    assert {name: data[name] for name in legacy} == legacy, (data, legacy)
+    print(
+        f"  {data['total_prescriptions']} prescriptions, {data['antibiotic_prescriptions']} avec antibiotique, "
+        f"{data['multitherapy_prescriptions']} multithérapies"
+    )
+    measure("  faits journaliers (deux vues)", lambda: analyses(params), args.repeat)
+    measure("  requêtes d'origine", lambda: legacy_analysis(since), max(1, args.repeat // 10))
@@ -0,0 +1,141 @@
+"""
+Import des feuilles de comptage (api.inventory_import) : feuille de
+`--scale` lignes, dont cinq erronées, sur `--scale / 5` médicaments
+comptant six lots chacun.
+
+Mesure l'import CSV puis XLSX dans un inventaire vide (durée, requêtes,
+pic d'allocation Python), comparé à la création article par article
+(modèle et signaux) sur `--rows` lignes.
+
+    python -m benchmarks.inventory_import --scale 50000
+"""
+from benchmarks.common import (
+    create_medications, insert_lots, is_seeded, reference_data, setup, step,
+)
+
+args = setup(
+    __doc__.strip().splitlines()[0], scale=50000, rows=(2000, "lignes créées une à une pour comparaison (défaut 2000)")
+)
+
+import io  # noqa: E402
+import time  # noqa: E402
+import tracemalloc  # noqa: E402
+from datetime import date  # noqa: E402
+
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from api import ledger  # noqa: E402
+from api.catalog import get_catalog  # noqa: E402
+from api.inventory_import import import_count_sheet  # noqa: E402
+from api.models import Inventory, InventoryItem, LotBalance  # noqa: E402
+
+LOTS_PER_MEDICATION = 6
+
+seeded = is_seeded()
+organization, project, category, user = reference_data()
+if not seeded:
+    medication_count = max(1, args.scale // 5)
+    with step(f"Génération ({medication_count} médicaments, {medication_count * LOTS_PER_MEDICATION} lots)"):
+        medication_ids = create_medications(organization, category, medication_count, 'INV')
+        insert_lots(project, medication_ids, LOTS_PER_MEDICATION)
+
+lots = list(
+    LotBalance.objects.filter(project=project).order_by('stock_entry_id')
+    .values_list('medication__code', 'stock_entry__batch_number', 'quantity_available')[:args.scale]
+)
+# Écarts de comptage de 0 à -6 unités
+rows = [[code, batch, max(available - number % 7, 0), ''] for number, (code, batch, available) in enumerate(lots)]
+# Erreurs : code inconnu, quantité invalide, lot inconnu, date invalide, doublon
+rows[10][0] = 'INCONNU'
+rows[20][2] = 'beaucoup'
+rows[30][1] = 'LOT-INCONNU'
+rows[40][3] = '31/02/2030'
+rows[50] = list(rows[49])
+header = ['Code médicament', 'N° lot', 'Quantité comptée', 'Date péremption']
+
+
+def csv_sheet():
+    lines = [';'.join(map(str, row)) for row in [header, *rows]]
+    return '\r\n'.join(lines).encode('utf-8')
+
+
+def xlsx_sheet():
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in [header, *rows]:
+        sheet.append(row)
+    content = io.BytesIO()
+    workbook.save(content)
+    return content.getvalue()
+
+
+# Un inventaire par mois et projet : vidé entre deux mesures
+inventory, _ = Inventory.objects.get_or_create(
+    organization=organization, project=project, month=date.today().month, year=date.today().year,
+    defaults={'inventory_date': date.today(), 'created_by': user},
+)
+
+
+def discard():
+    """Supprime les articles de l'inventaire en SQL et recalcule les soldes pour la mesure suivante"""
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM api_inventoryitem WHERE inventory_id = %s", [inventory.pk])
+    ledger.rebuild_balances()
+
+
+def run_import(label, name, content, trace=False):
+    """Import chronométré ; avec `trace`, pic d'allocation Python (tracemalloc ralentit l'import)"""
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        report = import_count_sheet(inventory, SimpleUploadedFile(name, content))
+    elapsed = time.perf_counter() - started
+    detail = f"{elapsed:.2f} s, {len(queries)} requête(s)"
+    if trace:
+        detail = f"pic {tracemalloc.get_traced_memory()[1] / 2 ** 20:.0f} Mo"
+        tracemalloc.stop()
+    print(f"{label} : {detail}, {report.created} créés, {report.rejected} rejetés", flush=True)
+    assert (report.created, report.rejected) == (len(rows) - 5, 5), report.as_dict()
+    discard()
+
+
+discard()
+get_catalog(organization.id)
+print(f"Feuille de {len(rows)} lignes, {LotBalance.objects.filter(project=project).count()} lots")
+run_import("Import CSV", 'comptage.csv', csv_sheet())
+run_import("Import CSV, mémoire", 'comptage.csv', csv_sheet(), trace=True)
+try:
+    content = xlsx_sheet()
+except ImportError:
+    print("Import XLSX : openpyxl non installé")
+else:
+    run_import("Import XLSX", 'comptage.xlsx', content)
+
+sample = rows[:args.rows]
+catalog = get_catalog(organization.id)
+entries = dict(
+    LotBalance.objects.filter(project=project, stock_entry__batch_number__in=[row[1] for row in sample])
+    .values_list('stock_entry__batch_number', 'stock_entry_id')
+)
+started = time.perf_counter()
+with transaction.atomic():
+    for code, batch, physical_stock, _ in sample:
+        if code in catalog.by_code and batch in entries and isinstance(physical_stock, int):
+            InventoryItem.objects.get_or_create(
+                inventory=inventory, medication_id=catalog.by_code[code].id, stock_entry_id=entries[batch],
+                defaults={'theoretical_stock': physical_stock + 3, 'physical_stock': physical_stock},
+            )
+elapsed = time.perf_counter() - started
+print(
+    f"Création une à une ({len(sample)} lignes) : {elapsed:.2f} s, "
+    f"soit {elapsed * len(rows) / len(sample):.0f} s extrapolées à {len(rows)} lignes"
+)
+discard()
+discrepancies = ledger.verify_balances()
+print(f"Écarts du grand livre : {len(discrepancies)}")
+assert not discrepancies
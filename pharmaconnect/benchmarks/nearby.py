@@ -0,0 +1,73 @@
+"""
+Recherche des formations sanitaires proches d'un point (api.spatial) sur
+`--scale` formations réparties au hasard sur le Cameroun.
+
+Mesure la construction de l'index, la recherche dans l'index seul et
+l'action nearby de bout en bout pour plusieurs rayons, comparées à un
+parcours complet des coordonnées.
+
+    python -m benchmarks.nearby --scale 50000
+"""
+from benchmarks.common import api_client, is_seeded, measure, reference_data, setup, step
+
+args = setup(__doc__.strip().splitlines()[0], scale=50000)
+
+import random  # noqa: E402
+
+from api.models import HealthFacility  # noqa: E402
+from api.spatial import facility_index, get_facility_index, haversine_km  # noqa: E402
+
+if not is_seeded():
+    with step(f"Génération ({args.scale} formations)"):
+        generator = random.Random(0)
+        HealthFacility.objects.bulk_create(
+            (
+                HealthFacility(
+                    name=f'CSI {number}', code=f'NB{number:06}', type='CSI', level_of_care='PRIMARY',
+                    location='Cameroun', latitude=round(generator.uniform(2.0, 12.0), 6),
+                    longitude=round(generator.uniform(9.0, 16.0), 6),
+                )
+                for number in range(args.scale)
+            ),
+            batch_size=2000
+        )
+_, _, _, user = reference_data()
+client = api_client(user)
+
+
+def rebuild():
+    facility_index.signature = None
+    get_facility_index()
+
+
+with step("Construction de l'index"):
+    rebuild()
+
+points = [(3.8667, 11.5167), (4.05, 9.7), (9.3, 13.4)]
+
+
+def full_scan(radius_km):
+    rows = list(HealthFacility.objects.values_list('id', 'latitude', 'longitude'))
+    for lat, lon in points:
+        sorted(
+            (distance, facility_id) for facility_id, latitude, longitude in rows
+            if (distance := haversine_km(lat, lon, float(latitude), float(longitude))) <= radius_km
+        )
+
+
+for radius_km in (10, 50, 500):
+    found = len(get_facility_index().nearby(*points[0], radius_km))
+    print(f"Rayon {radius_km} km : {found} formation(s) autour de Yaoundé")
+    measure(
+        f"  index seul ({len(points)} points)",
+        lambda: [facility_index.nearby(lat, lon, radius_km) for lat, lon in points], args.repeat
+    )
+    measure(
+        f"  action nearby ({len(points)} points)",
+        lambda: [
+            client.get('/api/health-facilities/nearby/', {'lat': lat, 'lon': lon, 'radius_km': radius_km, 'limit': 50})
+            for lat, lon in points
+        ],
+        args.repeat
+    )
+    measure(f"  parcours complet ({len(points)} points)", lambda: full_scan(radius_km), max(1, args.repeat // 4))
@@ -0,0 +1,49 @@
+"""
+Pagination des dispensations (api.pagination) sur `--scale` dispensations
+d'une organisation, cent par minute (dates en partie identiques).
+
+Mesure une page de 50 lignes à plusieurs profondeurs : curseur (keyset)
+contre numéro de page (COUNT(*) + OFFSET), de bout en bout.
+
+    python -m benchmarks.pagination --scale 1000000
+"""
+from benchmarks.common import api_client, insert_dispensations, is_seeded, measure, reference_data, setup, step
+
+args = setup(__doc__.strip().splitlines()[0], scale=1000000)
+
+import base64  # noqa: E402
+import json  # noqa: E402
+
+from api.models import Dispensation  # noqa: E402
+
+PAGE_SIZE = 50
+
+seeded = is_seeded()
+organization, project, _, user = reference_data()
+if not seeded:
+    with step(f"Génération ({args.scale} dispensations)"):
+        insert_dispensations(organization, project, user, args.scale)
+
+total = Dispensation.objects.filter(organization=organization).count()
+client = api_client(user)
+ordering = Dispensation.objects.filter(organization=organization).order_by('-dispensation_date', '-id')
+
+
+def cursor_at(offset):
+    """Curseur de la page commençant à `offset`, tel que le renvoie le lien next"""
+    dispensation_date, dispensation_id = ordering.values_list('dispensation_date', 'id')[offset - 1]
+    cursor = {'v': [dispensation_date.isoformat(), dispensation_id], 'o': ['-dispensation_date', '-id']}
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode()).decode('ascii')
+
+
+print(f"{total} dispensations, pages de {PAGE_SIZE}")
+for offset in sorted({0, total // 10, total // 2, total - PAGE_SIZE}):
+    print(f"Profondeur {offset}")
+    params = {'page_size': PAGE_SIZE}
+    if offset:
+        params['cursor'] = cursor_at(offset)
+    response = client.get('/api/dispensations/', params)
+    assert response.status_code == 200 and len(response.data['results']) == PAGE_SIZE, response.status_code
+    measure("  curseur", lambda: client.get('/api/dispensations/', params), args.repeat)
+    page = {'page': offset // PAGE_SIZE + 1}
+    measure("  numéro de page", lambda: client.get('/api/dispensations/', page), max(1, args.repeat // 4))
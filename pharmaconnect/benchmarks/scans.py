@@ -0,0 +1,50 @@
+"""
+Résolution des scans GS1 (api.scans) sur `--scale` lots répartis sur
+`--scale / 100` médicaments d'une organisation.
+
+Mesure le scan unitaire (?code=) appel par appel et le scan groupé d'une
+livraison de 1000 codes (scan_batch), de bout en bout.
+
+    python -m benchmarks.scans --scale 1000000
+"""
+from benchmarks.common import (
+    api_client, create_medications, insert_lots, is_seeded, measure, measure_each, reference_data, setup, step,
+)
+
+args = setup(__doc__.strip().splitlines()[0], scale=1000000)
+
+import random  # noqa: E402
+
+from api.models import Medication, StockEntry  # noqa: E402
+
+LOTS_PER_MEDICATION = 100
+
+organization, project, category, user = reference_data()
+if not StockEntry.objects.exists():
+    medication_count = max(1, args.scale // LOTS_PER_MEDICATION)
+    with step(f"Génération ({medication_count} médicaments, {medication_count * LOTS_PER_MEDICATION} lots)"):
+        medication_ids = create_medications(organization, category, medication_count, 'SC')
+        insert_lots(project, medication_ids, LOTS_PER_MEDICATION)
+
+generator = random.Random(0)
+last_id = StockEntry.objects.order_by('-id').values_list('id', flat=True).first()
+sample = StockEntry.objects.filter(
+    id__in=generator.sample(range(1, last_id + 1), min(last_id, 2000))
+).values_list('medication__barcode_gs1', 'expiry_date', 'batch_number')
+codes = [f'(01){gtin.zfill(14)}(17){expiry:%y%m%d}(10){batch}' for gtin, expiry, batch in sample]
+print(f"{Medication.objects.count()} médicaments, {last_id} lots, {len(codes)} codes tirés au hasard")
+
+client = api_client(user)
+statuses = {client.get('/api/stock-entries/scan/', {'code': code}).data['status'] for code in codes[:20]}
+assert statuses == {'LOT'}, statuses
+
+measure_each(
+    "Scan unitaire", lambda code: client.get('/api/stock-entries/scan/', {'code': code}),
+    codes[:max(args.repeat, 100)]
+)
+batch = codes[:1000]
+measure(
+    f"Scan groupé ({len(batch)} codes)",
+    lambda: client.post('/api/stock-entries/scan_batch/', {'codes': batch}, format='json'),
+    max(1, args.repeat // 4)
+)
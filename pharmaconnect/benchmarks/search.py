@@ -0,0 +1,80 @@
+"""
+Recherche de médicaments pour l'autocomplétion (api.search) sur `--scale`
+médicaments d'une organisation.
+
+Mesure, requête par requête (`--repeat` requêtes par type), l'action
+search pour des préfixes de 2 à 6 lettres, des requêtes de deux mots et
+des fautes de frappe, comparée au filtre icontains sur quatre colonnes
+utilisé auparavant.
+
+    python -m benchmarks.search --scale 50000
+"""
+from benchmarks.common import api_client, is_seeded, measure_each, reference_data, setup, step
+
+args = setup(__doc__.strip().splitlines()[0], scale=50000)
+
+import itertools  # noqa: E402
+import random  # noqa: E402
+
+from django.db.models import Q  # noqa: E402
+
+from api.models import Medication  # noqa: E402
+from api.search import rebuild_search_index  # noqa: E402
+from api.serializers import MedicationSearchSerializer  # noqa: E402
+
+STEMS = [
+    'Amoxi', 'Paracé', 'Métro', 'Cipro', 'Artémé', 'Luméfa', 'Ibupro', 'Cotrimo', 'Doxy', 'Azithro',
+    'Gentami', 'Ceftri', 'Fluco', 'Oméprazo', 'Salbuta', 'Prédniso', 'Diazé', 'Furosé', 'Métfor', 'Glibencla',
+]
+SUFFIXES = ['cilline', 'tamol', 'nidazole', 'floxacine', 'ther', 'ntrine', 'fène', 'xazole', 'cycline', 'mycine']
+FORMS = ['Comprimé', 'Sirop', 'Injectable', 'Gélule', 'Suspension']
+DOSAGES = ['100mg', '250mg', '500mg', '1g', '5mg/ml']
+
+organization, _, category, user = reference_data()
+generator = random.Random(0)
+names = [stem.lower() + suffix for stem, suffix in itertools.product(STEMS, SUFFIXES)]
+
+if not is_seeded() or not Medication.objects.filter(organization=organization).exists():
+    with step(f"Génération ({args.scale} médicaments)"):
+        Medication.objects.bulk_create(
+            (
+                Medication(
+                    code=f'SR{number:06}', organization=organization, category=category,
+                    name=f'{generator.choice(names).capitalize()} {number}',
+                    dosage=generator.choice(DOSAGES), form=generator.choice(FORMS), packaging='Boîte',
+                    therapeutic_class=generator.choice(['Antibiotique', 'Antalgique', 'Antipaludique']),
+                )
+                for number in range(args.scale)
+            ),
+            batch_size=2000
+        )
+    with step("Index de recherche (rebuild_search_index)"):
+        rebuild_search_index(organization.id)
+
+client = api_client(user)
+
+
+def typo(word):
+    position = generator.randrange(1, len(word) - 1)
+    return word[:position] + word[position + 1] + word[position] + word[position + 2:]
+
+
+queries = {
+    'préfixes de 2 à 6 lettres': [generator.choice(names)[:generator.randint(2, 6)] for _ in range(args.repeat)],
+    'deux mots': [f'{generator.choice(names)[:5]} {generator.choice(DOSAGES)}' for _ in range(args.repeat)],
+    'fautes de frappe': [typo(generator.choice(names)) for _ in range(args.repeat)],
+}
+
+
+def legacy_search(query):
+    queryset = Medication.objects.filter(organization=organization).filter(
+        Q(code__icontains=query) | Q(name__icontains=query)
+        | Q(dosage__icontains=query) | Q(therapeutic_class__icontains=query)
+    ).distinct()[:20]
+    return MedicationSearchSerializer(queryset, many=True).data
+
+
+for label, words in queries.items():
+    print(f"Requêtes : {label}")
+    measure_each("  action search", lambda q: client.get('/api/medications/search/', {'q': q}), words)
+    measure_each("  icontains (ancien)", legacy_search, words)
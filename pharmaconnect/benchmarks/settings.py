@@ -0,0 +1,21 @@
+"""Réglages des mesures : base, médias et cache partagé dans des emplacements jetables"""
+import os
+
+from pharmaconnect.settings import *  # noqa: F401,F403
+from pharmaconnect.settings import CACHES
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['BENCHMARK_DB'],
+    }
+}
+
+MEDIA_ROOT = os.path.join(os.environ['BENCHMARK_DIR'], 'media')
+
+CACHES = dict(CACHES)
+CACHES['analytics_shared'] = dict(
+    CACHES['analytics_shared'], LOCATION=os.path.join(os.environ['BENCHMARK_DIR'], 'cache')
+)
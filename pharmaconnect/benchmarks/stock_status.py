@@ -0,0 +1,104 @@
+"""
+Statuts de stock (api.stock_status) sur `--scale` médicaments suivis dans
+`--projects` projets d'une organisation : un quart en rupture, un quart en
+pré-rupture, un quart couvert, un quart en surstock, une semaine de
+consommation clôturée par couple projet/médicament.
+
+Mesure evaluate_stock_status pour un projet puis pour toute
+l'organisation (même nombre de requêtes), et stock_summary de bout en bout.
+
+    python -m benchmarks.stock_status --scale 10000 --projects 200
+"""
+from benchmarks.common import (
+    api_client, create_medications, is_seeded, measure, reference_data, setup, step,
+)
+
+args = setup(__doc__.strip().splitlines()[0], scale=10000, projects=(200, "projets de l'organisation (défaut 200)"))
+
+from collections import Counter  # noqa: E402
+from datetime import date, timedelta  # noqa: E402
+
+from django.db import connection  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from api import ledger  # noqa: E402
+from api.models import Project  # noqa: E402
+from api.stock_status import evaluate_stock_status  # noqa: E402
+
+# Quantité reçue selon le profil (position % 4) pour une CMM de 130 : rupture,
+# un mois de stock, quatre mois, quinze mois
+QUANTITIES = (0, 130, 520, 2000)
+
+
+def seed(organization, project, category):
+    medication_ids = create_medications(organization, category, args.scale, 'STS')
+    Project.objects.bulk_create(
+        Project(
+            name=f'Projet Benchmark {number}', code=f'BENCH{number:04}', organization=organization,
+            donor=project.donor, health_facility=project.health_facility,
+            start_date=project.start_date, end_date=project.end_date,
+        )
+        for number in range(1, args.projects)
+    )
+    project_ids = list(Project.objects.filter(organization=organization).values_list('id', flat=True))
+    year, week, _ = (date.today() - timedelta(weeks=1)).isocalendar()
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE benchmark_medication (position INTEGER PRIMARY KEY, id INTEGER)")
+        cursor.executemany("INSERT INTO benchmark_medication VALUES (%s, %s)", list(enumerate(medication_ids)))
+        cursor.execute("CREATE TEMP TABLE benchmark_project (id INTEGER PRIMARY KEY)")
+        cursor.executemany("INSERT INTO benchmark_project VALUES (%s)", [(project_id,) for project_id in project_ids])
+        cursor.execute(
+            f"""
+            INSERT INTO api_stockentry (
+                organization_id, project_id, medication_id, delivery_date, quantity_ordered,
+                quantity_delivered, expiry_date, unit_price, supplier, batch_number, created_at
+            )
+            SELECT %s, project.id, medication.id, date('now', '-30 days'), 0,
+                   CASE (medication.position + project.id) %% 4
+                       {' '.join(f'WHEN {profile} THEN {quantity}' for profile, quantity in enumerate(QUANTITIES))}
+                   END,
+                   date('now', '+400 days'), 1, '', 'L' || project.id || '-' || medication.position, datetime('now')
+            FROM benchmark_medication AS medication CROSS JOIN benchmark_project AS project
+            WHERE (medication.position + project.id) %% 4 != 0
+            """,
+            [organization.id]
+        )
+        cursor.execute(
+            """
+            INSERT INTO api_consumptiondata (
+                organization_id, project_id, medication_id, week_number, year, quantity_consumed,
+                is_week_closed, created_at
+            )
+            SELECT %s, project.id, medication.id, %s, %s, 30, 1, datetime('now')
+            FROM benchmark_medication AS medication CROSS JOIN benchmark_project AS project
+            """,
+            [organization.id, week, year]
+        )
+        cursor.execute("DROP TABLE benchmark_medication")
+        cursor.execute("DROP TABLE benchmark_project")
+    ledger.rebuild_balances()
+
+
+seeded = is_seeded()
+organization, project, category, user = reference_data()
+if not seeded:
+    with step(f"Génération ({args.scale} médicaments x {args.projects} projets)"):
+        seed(organization, project, category)
+
+statuses = evaluate_stock_status(organization=organization)
+print(f"{len(statuses)} couples projet/médicament : {dict(sorted(Counter(item.status for item in statuses).items()))}")
+
+measure(
+    f"Un projet ({args.scale} médicaments)", lambda: evaluate_stock_status(project=project), args.repeat
+)
+measure(
+    f"Organisation ({len(statuses)} couples)",
+    lambda: evaluate_stock_status(organization=organization), max(1, args.repeat // 10)
+)
+
+# Réponse recalculée à chaque appel : cache des analyses désactivé
+override_settings(ANALYTICS_CACHES=[]).enable()
+client = api_client(user)
+data = client.get('/api/analytics/stock-summary/').data
+print(f"stock_summary : {data['stockout_items']} ruptures, {data['pre_stockout_items']} pré-ruptures")
+measure("stock_summary de bout en bout", lambda: client.get('/api/analytics/stock-summary/'), max(1, args.repeat // 10))
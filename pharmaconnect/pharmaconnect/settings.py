@@ -101,6 +101,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'api.admin.admin_statistics',
             ],
         },
     },
@@ -188,6 +189,33 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# En-têtes lisibles par le frontend (X-Cache : cache des analyses)
+CORS_EXPOSE_HEADERS = ['X-Cache']
+
+# Catalogue des médicaments en mémoire : nombre d'organisations conservées par processus
+CATALOG_CACHE_SIZE = 32
+
+# Caches : les réponses analytiques (api.analytics_cache) sont lues en mémoire
+# locale puis dans des fichiers partagés par tous les processus
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'analytics': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'analytics',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+    'analytics_shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'analytics',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+ANALYTICS_CACHES = ['analytics', 'analytics_shared']
+
 # ====================================
 # JAZZMIN CONFIGURATION - Interface en français
 # ====================================